@@ -0,0 +1 @@
+Add an option to run v2 state resolution for large rooms in a pool of worker processes.
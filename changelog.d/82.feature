@@ -0,0 +1 @@
+Add an optional background process which compresses the state group tables, reducing their size and speeding up reading state.
@@ -0,0 +1 @@
+Add Prometheus metrics, an admin API and optional input dumps for profiling slow state resolutions.
@@ -0,0 +1 @@
+Add experimental support for reusing the room entries of users' previous initial syncs, to speed up initial syncs for users in lots of rooms.
@@ -0,0 +1 @@
+Add an experimental variant of `/sync` which only returns a window of the user's joined rooms, ordered by recency.
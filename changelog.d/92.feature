@@ -0,0 +1 @@
+Add an option to coalesce and stagger waking up clients waiting for events in large rooms.
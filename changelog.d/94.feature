@@ -0,0 +1 @@
+Persist the room members sent to clients which lazy-load members, so they aren't re-sent after a restart.
@@ -0,0 +1 @@
+Add an optional cache of encoded /sync responses, to answer clients retrying a request without recalculating it.
@@ -0,0 +1 @@
+Add per-stage timing of /sync requests, and an admin API to get the slowest recent syncs with optional CPU profiles.
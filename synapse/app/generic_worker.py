@@ -89,6 +89,7 @@ from synapse.replication.tcp.streams import (
     ToDeviceStream,
 )
 from synapse.rest.admin import register_servlets_for_media_repo
+from synapse.rest.admin.sync import SlowSyncsRestServlet
 from synapse.rest.client.v1 import events
 from synapse.rest.client.v1.initial_sync import InitialSyncRestServlet
 from synapse.rest.client.v1.login import LoginRestServlet
@@ -128,6 +129,7 @@ from synapse.rest.key.v2 import KeyApiV2Resource
 from synapse.server import HomeServer, cache_in_self
 from synapse.storage.databases.main.censor_events import CensorEventsStore
 from synapse.storage.databases.main.client_ips import ClientIpWorkerStore
+from synapse.storage.databases.main.lazy_loaded_members import LazyLoadedMembersStore
 from synapse.storage.databases.main.media_repository import MediaRepositoryStore
 from synapse.storage.databases.main.metrics import ServerMetricsStore
 from synapse.storage.databases.main.monthly_active_users import (
@@ -136,6 +138,7 @@ from synapse.storage.databases.main.monthly_active_users import (
 from synapse.storage.databases.main.presence import UserPresenceState
 from synapse.storage.databases.main.search import SearchWorkerStore
 from synapse.storage.databases.main.stats import StatsStore
+from synapse.storage.databases.main.sync_snapshots import SyncSnapshotStore
 from synapse.storage.databases.main.transactions import TransactionWorkerStore
 from synapse.storage.databases.main.ui_auth import UIAuthWorkerStore
 from synapse.storage.databases.main.user_directory import UserDirectoryStore
@@ -459,6 +462,8 @@ class GenericWorkerSlavedStore(
     # rather than going via the correct worker.
     UserDirectoryStore,
     StatsStore,
+    SyncSnapshotStore,
+    LazyLoadedMembersStore,
     UIAuthWorkerStore,
     SlavedDeviceInboxStore,
     SlavedDeviceStore,
@@ -506,6 +511,15 @@ class GenericWorkerServer(HomeServer):
         # We always include a health resource.
         resources = {"/health": HealthResource()}
 
+        # The admin servlets served by this listener, if any.
+        admin_resource = None  # type: Optional[JsonResource]
+
+        def get_admin_resource() -> JsonResource:
+            nonlocal admin_resource
+            if admin_resource is None:
+                admin_resource = JsonResource(self, canonical_json=False)
+            return admin_resource
+
         for res in listener_config.http_options.resources:
             for name in res.names:
                 if name == "metrics":
@@ -554,6 +568,10 @@ class GenericWorkerServer(HomeServer):
                     groups.register_servlets(self, resource)
 
                     resources.update({CLIENT_API_PREFIX: resource})
+
+                    # The slow syncs are kept by the process which calculated
+                    # them, so we serve them from the workers handling /sync.
+                    SlowSyncsRestServlet(self).register(get_admin_resource())
                 elif name == "federation":
                     resources.update({FEDERATION_PREFIX: TransportLayerServer(self)})
                 elif name == "media":
@@ -562,15 +580,10 @@ class GenericWorkerServer(HomeServer):
 
                         # We need to serve the admin servlets for media on the
                         # worker.
-                        admin_resource = JsonResource(self, canonical_json=False)
-                        register_servlets_for_media_repo(self, admin_resource)
+                        register_servlets_for_media_repo(self, get_admin_resource())
 
                         resources.update(
-                            {
-                                MEDIA_PREFIX: media_repo,
-                                LEGACY_MEDIA_PREFIX: media_repo,
-                                "/_synapse/admin": admin_resource,
-                            }
+                            {MEDIA_PREFIX: media_repo, LEGACY_MEDIA_PREFIX: media_repo}
                         )
                     else:
                         logger.warning(
@@ -596,6 +609,9 @@ class GenericWorkerServer(HomeServer):
                 if name == "replication":
                     resources[REPLICATION_PREFIX] = ReplicationRestResource(self)
 
+        if admin_resource is not None:
+            resources["/_synapse/admin"] = admin_resource
+
         root_resource = create_resource_tree(resources, OptionsResource())
 
         _base.listen_tcp(
@@ -137,6 +137,135 @@ class ServerConfig(Config):
         # Whether to enable user presence.
         self.use_presence = config.get("use_presence", True)
 
+        # The number of worker processes to run v2 state resolution for large
+        # rooms in. If zero, state resolution is done in the main process.
+        self.state_resolution_processes = config.get("state_resolution_processes", 0)
+        if (
+            not isinstance(self.state_resolution_processes, int)
+            or self.state_resolution_processes < 0
+        ):
+            raise ConfigError("state_resolution_processes must be a positive integer")
+
+        state_res_profiling_config = config.get("state_resolution_profiling")
+        if state_res_profiling_config is None:
+            state_res_profiling_config = {}
+
+        # Where to dump the inputs of slow state resolutions, if anywhere.
+        self.state_resolution_dump_directory = state_res_profiling_config.get(
+            "dump_directory"
+        )
+        self.state_resolution_dump_threshold_ms = self.parse_duration(
+            state_res_profiling_config.get("dump_threshold", "5s")
+        )
+
+        state_compression_config = config.get("state_compression")
+        if state_compression_config is None:
+            state_compression_config = {}
+
+        # Whether to rewrite the state groups of rooms into a more compact
+        # layout in the background.
+        self.state_compression_enabled = state_compression_config.get("enabled", False)
+        self.state_compression_interval_ms = self.parse_duration(
+            state_compression_config.get("interval", "10s")
+        )
+        self.state_compression_chunk_size = state_compression_config.get(
+            "chunk_size", 10000
+        )
+        if (
+            not isinstance(self.state_compression_chunk_size, int)
+            or self.state_compression_chunk_size < 1
+        ):
+            raise ConfigError("state_compression.chunk_size must be a positive integer")
+
+        sync_snapshots_config = config.get("sync_snapshots")
+        if sync_snapshots_config is None:
+            sync_snapshots_config = {}
+
+        # Whether to reuse the unchanged parts of users' previous initial
+        # syncs.
+        self.sync_snapshots_enabled = sync_snapshots_config.get("enabled", False)
+        self.sync_snapshots_min_rooms = sync_snapshots_config.get("min_rooms", 50)
+        self.sync_snapshots_max_age_ms = self.parse_duration(
+            sync_snapshots_config.get("max_age", "7d")
+        )
+        self.sync_snapshots_max_per_user = sync_snapshots_config.get("max_per_user", 2)
+        if (
+            not isinstance(self.sync_snapshots_max_per_user, int)
+            or self.sync_snapshots_max_per_user < 1
+        ):
+            raise ConfigError("sync_snapshots.max_per_user must be a positive integer")
+
+        notifier_coalescing_config = config.get("notifier_coalescing")
+        if notifier_coalescing_config is None:
+            notifier_coalescing_config = {}
+
+        # Whether to batch up wake-ups of large numbers of event streams (e.g.
+        # for everyone in a large room), and stagger waking them.
+        self.notifier_coalescing_enabled = notifier_coalescing_config.get(
+            "enabled", False
+        )
+        self.notifier_coalescing_min_streams = notifier_coalescing_config.get(
+            "min_streams", 100
+        )
+        self.notifier_coalescing_window_ms = self.parse_duration(
+            notifier_coalescing_config.get("window", 50)
+        )
+        self.notifier_coalescing_batch_size = notifier_coalescing_config.get(
+            "batch_size", 100
+        )
+        self.notifier_coalescing_batch_interval_ms = self.parse_duration(
+            notifier_coalescing_config.get("batch_interval", 10)
+        )
+        for name in ("min_streams", "batch_size"):
+            value = notifier_coalescing_config.get(name)
+            if value is not None and (not isinstance(value, int) or value < 1):
+                raise ConfigError(
+                    "notifier_coalescing.%s must be a positive integer" % (name,)
+                )
+
+        lazy_loaded_members_config = config.get("lazy_loaded_members_persistence")
+        if lazy_loaded_members_config is None:
+            lazy_loaded_members_config = {}
+
+        # Whether to remember which members have been sent to clients which
+        # lazy-load members in the database, rather than only in memory.
+        self.lazy_loaded_members_persistence_enabled = lazy_loaded_members_config.get(
+            "enabled", False
+        )
+        self.lazy_loaded_members_persistence_max_age_ms = self.parse_duration(
+            lazy_loaded_members_config.get("max_age", "7d")
+        )
+
+        sync_response_cache_config = config.get("sync_response_cache")
+        if sync_response_cache_config is None:
+            sync_response_cache_config = {}
+
+        # Whether to keep the encoded responses to /sync requests for a short
+        # while, to answer clients retrying the same request.
+        self.sync_response_cache_enabled = sync_response_cache_config.get(
+            "enabled", False
+        )
+        self.sync_response_cache_expiry_ms = self.parse_duration(
+            sync_response_cache_config.get("expiry", "2m")
+        )
+        self.sync_response_cache_max_size = self.parse_size(
+            sync_response_cache_config.get("max_size", "50M")
+        )
+
+        sync_profiling_config = config.get("sync_profiling")
+        if sync_profiling_config is None:
+            sync_profiling_config = {}
+
+        # Whether to record CPU profiles of a sample of /sync requests, and the
+        # proportion of requests to profile.
+        self.sync_profiling_enabled = sync_profiling_config.get("enabled", False)
+        self.sync_profiling_sample_rate = sync_profiling_config.get("sample_rate", 0.01)
+        if (
+            not isinstance(self.sync_profiling_sample_rate, (int, float))
+            or not 0 <= self.sync_profiling_sample_rate <= 1
+        ):
+            raise ConfigError("sync_profiling.sample_rate must be between 0 and 1")
+
         # Whether to update the user directory or not. This should be set to
         # false only if we are updating the user directory in a worker
         self.update_user_directory = config.get("update_user_directory", True)
@@ -699,6 +828,164 @@ class ServerConfig(Config):
         #
         #use_presence: false
 
+        # The number of worker processes to use for the CPU-heavy parts of state
+        # resolution in large rooms, so that they don't block the main process.
+        # Defaults to 0, which means that state resolution is done in the main
+        # process. Requires Python 3.7 or later.
+        #
+        #state_resolution_processes: 2
+
+        # Settings for profiling state resolution.
+        #
+        state_resolution_profiling:
+          # If set, the inputs of any state resolution which takes longer than
+          # 'dump_threshold' are written to a file in this directory, so that
+          # it can be replayed offline. Defaults to unset.
+          #
+          #dump_directory: /var/lib/synapse/state_res_dumps
+
+          # How long a state resolution must take for its inputs to be dumped.
+          # Defaults to '5s'.
+          #
+          #dump_threshold: 10s
+
+        # Settings for compressing the state of rooms in the background.
+        #
+        # Synapse stores the state of rooms as chains of deltas between "state
+        # groups". Over time these chains can become long and badly balanced,
+        # which makes the state tables large and slow to query. When enabled,
+        # Synapse will slowly rewrite the state groups of each room into a
+        # more compact layout, where it saves space to do so.
+        #
+        state_compression:
+          # Uncomment to enable state compression. Defaults to 'false'.
+          #
+          #enabled: true
+
+          # How long to wait between compressing each chunk of state groups.
+          # Defaults to '10s'.
+          #
+          #interval: 1m
+
+          # The maximum number of rows of state to compress at a time.
+          # Defaults to 10000.
+          #
+          #chunk_size: 1000
+
+        # Settings for precomputed initial syncs.
+        #
+        # When enabled, Synapse keeps a snapshot of the rooms section of each
+        # user's most recent initial syncs, and reuses the entries for rooms
+        # which haven't changed since when a user next does an initial sync.
+        #
+        sync_snapshots:
+          # Uncomment to enable sync snapshots. Defaults to 'false'.
+          #
+          #enabled: true
+
+          # Only keep snapshots for users who are in at least this many rooms.
+          # Defaults to 50.
+          #
+          #min_rooms: 100
+
+          # How long to keep snapshots which haven't been used. Defaults to '7d'.
+          #
+          #max_age: 3d
+
+          # The maximum number of snapshots to keep for each user. Clients using
+          # different filters need different snapshots. Defaults to 2.
+          #
+          #max_per_user: 3
+
+        # Settings for coalescing wake-ups of clients waiting for new events.
+        #
+        # When enabled, if an update (such as a message in a large room) would
+        # wake up lots of clients waiting on /sync or /events, the wake-ups are
+        # held for a short window, so that further updates are delivered in the
+        # same response, and the clients are then woken in batches, so that
+        # their requests don't all hit the database at once.
+        #
+        notifier_coalescing:
+          # Uncomment to enable coalescing wake-ups. Defaults to 'false'.
+          #
+          #enabled: true
+
+          # Only coalesce updates which wake up at least this many clients.
+          # Smaller updates are delivered immediately. Defaults to 100.
+          #
+          #min_streams: 500
+
+          # How long to hold wake-ups for before waking clients, in
+          # milliseconds unless a unit is given. Defaults to 50.
+          #
+          #window: 100
+
+          # The number of clients to wake up at a time. Defaults to 100.
+          #
+          #batch_size: 50
+
+          # How long to wait between waking each batch of clients, in
+          # milliseconds unless a unit is given. Defaults to 10.
+          #
+          #batch_interval: 20
+
+        # Settings for remembering which room members have been sent to clients
+        # which lazy-load members.
+        #
+        # Normally this is only remembered in memory, so after a restart, or
+        # when a client's syncs move to another worker, the members are sent
+        # again. When enabled, it is also stored in the database.
+        #
+        lazy_loaded_members_persistence:
+          # Uncomment to store the members sent in the database. Defaults to
+          # 'false'.
+          #
+          #enabled: true
+
+          # How long to remember the members sent to a device which hasn't
+          # synced. Defaults to '7d'.
+          #
+          #max_age: 3d
+
+        # Settings for caching the responses to /sync requests.
+        #
+        # When enabled, the encoded response to each /sync request is kept for
+        # a short while, and returned without being recalculated if the client
+        # retries the same request (e.g. because it lost its connection before
+        # receiving the response).
+        #
+        sync_response_cache:
+          # Uncomment to enable caching responses. Defaults to 'false'.
+          #
+          #enabled: true
+
+          # How long to keep each response for. Defaults to '2m'.
+          #
+          #expiry: 5m
+
+          # The maximum total size of the cached responses. Defaults to '50M'.
+          #
+          #max_size: 100M
+
+        # Settings for profiling /sync requests.
+        #
+        # When enabled, a sample of /sync requests are run under the Python
+        # profiler, and the profiles of the slowest are available through the
+        # admin API (see docs/admin_api/sync.md). Note that the profile of a
+        # request includes anything else that the process does while the
+        # request is being calculated, and that profiling slows the process
+        # down.
+        #
+        sync_profiling:
+          # Uncomment to enable profiling. Defaults to 'false'.
+          #
+          #enabled: true
+
+          # The proportion of requests to profile, between 0 and 1. Only one
+          # request is profiled at a time. Defaults to 0.01.
+          #
+          #sample_rate: 0.1
+
         # Whether to require authentication to retrieve profile data (avatars,
         # display names) of other users through the client API. Defaults to
         # 'false'. Note that profile data is also available via the federation
@@ -289,7 +289,8 @@ def serialize_event(
     time_now_ms = int(time_now_ms)
 
     # Should this strip out None's?
-    d = {k: v for k, v in e.get_dict().items()}
+    # `get_dict` returns a (shallow) copy, which we are free to modify.
+    d = e.get_dict()
 
     d["event_id"] = e.event_id
 
@@ -358,67 +359,139 @@ class EventClientSerializer:
         if not isinstance(event, EventBase):
             return event
 
-        event_id = event.event_id
         serialized_event = serialize_event(event, time_now, **kwargs)
 
         # If MSC1849 is enabled then we need to look if there are any relations
         # we need to bundle in with the event.
-        # Do not bundle relations if the event has been redacted
-        if not event.internal_metadata.is_redacted() and (
-            self.experimental_msc1849_support_enabled and bundle_aggregations
-        ):
-            annotations = await self.store.get_aggregation_groups_for_event(event_id)
-            references = await self.store.get_relations_for_event(
-                event_id, RelationTypes.REFERENCE, direction="f"
-            )
-
-            if annotations.chunk:
-                r = serialized_event["unsigned"].setdefault("m.relations", {})
-                r[RelationTypes.ANNOTATION] = annotations.to_dict()
-
-            if references.chunk:
-                r = serialized_event["unsigned"].setdefault("m.relations", {})
-                r[RelationTypes.REFERENCE] = references.to_dict()
-
-            edit = None
-            if event.type == EventTypes.Message:
-                edit = await self.store.get_applicable_edit(event_id)
-
-            if edit:
-                # If there is an edit replace the content, preserving existing
-                # relations.
-
-                relations = event.content.get("m.relates_to")
-                serialized_event["content"] = edit.content.get("m.new_content", {})
-                if relations:
-                    serialized_event["content"]["m.relates_to"] = relations
-                else:
-                    serialized_event["content"].pop("m.relates_to", None)
-
-                r = serialized_event["unsigned"].setdefault("m.relations", {})
-                r[RelationTypes.REPLACE] = {
-                    "event_id": edit.event_id,
-                    "origin_server_ts": edit.origin_server_ts,
-                    "sender": edit.sender,
-                }
+        if self._should_bundle_aggregations(event, bundle_aggregations):
+            if await self.store.event_has_relations(event.event_id):
+                await self._inject_bundled_aggregations(event, serialized_event)
 
         return serialized_event
 
-    def serialize_events(self, events, time_now, **kwargs):
+    async def serialize_events(
+        self, events, time_now, bundle_aggregations=True, **kwargs
+    ):
         """Serializes multiple events.
 
+        Rather than looking up the relations of each event separately, this
+        works out which events have any relations (and fetches their edits) in
+        bulk, and only fetches the remaining aggregations for those events.
+
         Args:
             event (iter[EventBase])
             time_now (int): The current time in milliseconds
+            bundle_aggregations (bool): Whether to bundle in related events
             **kwargs: Arguments to pass to `serialize_event`
 
         Returns:
-            Deferred[list[dict]]: The list of serialized events
+            list[dict]: The list of serialized events
+        """
+        events = list(events)
+        serialized_events = [
+            serialize_event(event, time_now, **kwargs) for event in events
+        ]
+
+        events_to_bundle = [
+            (event, serialized_event)
+            for event, serialized_event in zip(events, serialized_events)
+            if isinstance(event, EventBase)
+            and self._should_bundle_aggregations(event, bundle_aggregations)
+        ]
+        if not events_to_bundle:
+            return serialized_events
+
+        has_relations = await self.store.events_have_relations(
+            [event.event_id for event, _ in events_to_bundle]
+        )
+        events_to_bundle = [
+            (event, serialized_event)
+            for event, serialized_event in events_to_bundle
+            if has_relations[event.event_id]
+        ]
+        if not events_to_bundle:
+            return serialized_events
+
+        # Prefill the edits cache, so that we don't need to look them up one
+        # by one when injecting the aggregations.
+        await self.store.get_applicable_edits(
+            [
+                event.event_id
+                for event, _ in events_to_bundle
+                if event.type == EventTypes.Message
+            ]
+        )
+
+        await yieldable_gather_results(
+            lambda args: self._inject_bundled_aggregations(*args), events_to_bundle
+        )
+
+        return serialized_events
+
+    def _should_bundle_aggregations(self, event, bundle_aggregations):
+        """Whether we should bundle the aggregations of the given event.
+
+        Args:
+            event (EventBase)
+            bundle_aggregations (bool): Whether the caller asked for related
+                events to be bundled
+
+        Returns:
+            bool
+        """
+        # Do not bundle relations if the event has been redacted
+        return (
+            self.experimental_msc1849_support_enabled
+            and bundle_aggregations
+            and not event.internal_metadata.is_redacted()
+        )
+
+    async def _inject_bundled_aggregations(self, event, serialized_event):
+        """Fetches the aggregations of the given event and bundles them into
+        its serialized form.
+
+        Args:
+            event (EventBase)
+            serialized_event (dict): The serialized event, which is modified
+                in place
         """
-        return yieldable_gather_results(
-            self.serialize_event, events, time_now=time_now, **kwargs
+        event_id = event.event_id
+
+        annotations = await self.store.get_aggregation_groups_for_event(event_id)
+        references = await self.store.get_relations_for_event(
+            event_id, RelationTypes.REFERENCE, direction="f"
         )
 
+        if annotations.chunk:
+            r = serialized_event["unsigned"].setdefault("m.relations", {})
+            r[RelationTypes.ANNOTATION] = annotations.to_dict()
+
+        if references.chunk:
+            r = serialized_event["unsigned"].setdefault("m.relations", {})
+            r[RelationTypes.REFERENCE] = references.to_dict()
+
+        edit = None
+        if event.type == EventTypes.Message:
+            edit = await self.store.get_applicable_edit(event_id)
+
+        if edit:
+            # If there is an edit replace the content, preserving existing
+            # relations.
+
+            relations = event.content.get("m.relates_to")
+            serialized_event["content"] = edit.content.get("m.new_content", {})
+            if relations:
+                serialized_event["content"]["m.relates_to"] = relations
+            else:
+                serialized_event["content"].pop("m.relates_to", None)
+
+            r = serialized_event["unsigned"].setdefault("m.relations", {})
+            r[RelationTypes.REPLACE] = {
+                "event_id": edit.event_id,
+                "origin_server_ts": edit.origin_server_ts,
+                "sender": edit.sender,
+            }
+
 
 def copy_power_levels_contents(
     old_power_levels: Mapping[str, Union[int, Mapping[str, int]]]
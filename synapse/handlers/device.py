@@ -109,6 +109,37 @@ class DeviceWorkerHandler(BaseHandler):
 
         return device
 
+    async def get_tracked_users_whose_devices_changed(
+        self, user_id: str, from_key: int
+    ) -> Set[str]:
+        """Get the users whose devices have changed since `from_key`, out of
+        `user_id` and the users who share a room with them.
+
+        Args:
+            user_id
+            from_key: The device lists stream token
+        """
+        # If we know which users' devices have changed since `from_key` (which
+        # we will for recent tokens), we check which of them share a room with
+        # the user, rather than fanning out over all the members of the user's
+        # rooms.
+        changed = self.store.get_users_whose_devices_may_have_changed(from_key)
+        if changed is None:
+            tracked_users = set(
+                await self.store.get_users_who_share_room_with_user(user_id)
+            )
+            tracked_users.add(user_id)
+        else:
+            tracked_users = await self.store.filter_users_who_share_room_with_user(
+                user_id, changed
+            )
+
+            # Always tell the user about their own devices.
+            if user_id in changed:
+                tracked_users.add(user_id)
+
+        return await self.store.get_users_whose_devices_changed(from_key, tracked_users)
+
     @trace
     @measure_func("device.get_user_ids_changed")
     async def get_user_ids_changed(
@@ -126,17 +157,8 @@ class DeviceWorkerHandler(BaseHandler):
 
         # First we check if any devices have changed for users that we share
         # rooms with.
-        users_who_share_room = await self.store.get_users_who_share_room_with_user(
-            user_id
-        )
-
-        tracked_users = set(users_who_share_room)
-
-        # Always tell the user about their own devices
-        tracked_users.add(user_id)
-
-        changed = await self.store.get_users_whose_devices_changed(
-            from_token.device_list_key, tracked_users
+        changed = await self.get_tracked_users_whose_devices_changed(
+            user_id, from_token.device_list_key
         )
 
         # Then work out if any users have since joined
@@ -226,6 +248,9 @@ class DeviceWorkerHandler(BaseHandler):
         if possibly_changed or possibly_left:
             # Take the intersection of the users whose devices may have changed
             # and those that actually still share a room with the user
+            users_who_share_room = await self.store.filter_users_who_share_room_with_user(
+                user_id, possibly_changed | possibly_left
+            )
             possibly_joined = possibly_changed & users_who_share_room
             possibly_left = (possibly_changed | possibly_left) - users_who_share_room
         else:
@@ -17,6 +17,7 @@
 
 """Contains handlers for federation events."""
 
+import collections
 import itertools
 import logging
 from collections.abc import Container
@@ -911,14 +912,43 @@ class FederationHandler(BaseHandler):
                 )
             )
 
+        # The state group after each of the events we've persisted, and its
+        # state, for those events which are prev events of events we have yet
+        # to persist.
+        state_after_events = {}  # type: Dict[str, Tuple[int, StateMap[str]]]
+        remaining_children = collections.Counter(
+            prev_event_id for ev in events for prev_event_id in ev.prev_event_ids()
+        )
+
+        async def record_state_after_event(event_id: str, context: EventContext):
+            if not remaining_children[event_id]:
+                return
+
+            # rejected events get the state of their predecessors (see
+            # `_store_event_state_mappings_txn`)
+            if context.rejected:
+                state_after_events[event_id] = (
+                    context.state_group_before_event,
+                    await context.get_prev_state_ids(),
+                )
+            else:
+                state_after_events[event_id] = (
+                    context.state_group,
+                    await context.get_current_state_ids(),
+                )
+
         if ev_infos:
-            await self._handle_new_events(dest, room_id, ev_infos, backfilled=True)
+            contexts = await self._handle_new_events(
+                dest, room_id, ev_infos, backfilled=True
+            )
+            for ev_info, context in zip(ev_infos, contexts):
+                await record_state_after_event(ev_info.event.event_id, context)
 
         # Step 2: Persist the rest of the events in the chunk one by one
         events.sort(key=lambda e: e.depth)
 
         for event in events:
-            if event in events_to_state:
+            if event.event_id in events_to_state:
                 continue
 
             # For paranoia we ensure that these events are marked as
@@ -926,9 +956,25 @@ class FederationHandler(BaseHandler):
             assert not event.internal_metadata.is_outlier()
 
             # We store these one at a time since each event depends on the
-            # previous to work out the state.
-            # TODO: We can probably do something more clever here.
-            await self._handle_new_event(dest, event, backfilled=True)
+            # previous to work out the state. If we've just persisted all of
+            # the prev events we already know the state after them, so can
+            # skip loading it from the database.
+            prev_state_groups = None  # type: Optional[Dict[int, StateMap[str]]]
+            prev_event_ids = event.prev_event_ids()
+            if all(e_id in state_after_events for e_id in prev_event_ids):
+                prev_state_groups = dict(
+                    state_after_events[e_id] for e_id in prev_event_ids
+                )
+
+            for e_id in prev_event_ids:
+                remaining_children[e_id] -= 1
+                if not remaining_children[e_id]:
+                    state_after_events.pop(e_id, None)
+
+            context = await self._handle_new_event(
+                dest, event, backfilled=True, prev_state_groups=prev_state_groups
+            )
+            await record_state_after_event(event.event_id, context)
 
         return events
 
@@ -1306,7 +1352,7 @@ class FederationHandler(BaseHandler):
     async def on_event_auth(self, event_id: str) -> List[EventBase]:
         event = await self.store.get_event(event_id)
         auth = await self.store.get_auth_chain(
-            list(event.auth_event_ids()), include_given=True
+            event.room_id, list(event.auth_event_ids()), include_given=True
         )
         return list(auth)
 
@@ -1573,7 +1619,7 @@ class FederationHandler(BaseHandler):
         prev_state_ids = await context.get_prev_state_ids()
 
         state_ids = list(prev_state_ids.values())
-        auth_chain = await self.store.get_auth_chain(state_ids)
+        auth_chain = await self.store.get_auth_chain(event.room_id, state_ids)
 
         state = await self.store.get_events(list(prev_state_ids.values()))
 
@@ -1889,10 +1935,21 @@ class FederationHandler(BaseHandler):
         return await self.store.get_min_depth(context)
 
     async def _handle_new_event(
-        self, origin, event, state=None, auth_events=None, backfilled=False
+        self,
+        origin,
+        event,
+        state=None,
+        auth_events=None,
+        backfilled=False,
+        prev_state_groups=None,
     ):
         context = await self._prep_event(
-            origin, event, state=state, auth_events=auth_events, backfilled=backfilled
+            origin,
+            event,
+            state=state,
+            auth_events=auth_events,
+            backfilled=backfilled,
+            prev_state_groups=prev_state_groups,
         )
 
         try:
@@ -1922,13 +1979,16 @@ class FederationHandler(BaseHandler):
         room_id: str,
         event_infos: Iterable[_NewEventInfo],
         backfilled: bool = False,
-    ) -> None:
+    ) -> List[EventContext]:
         """Creates the appropriate contexts and persists events. The events
         should not depend on one another, e.g. this should be used to persist
         a bunch of outliers, but not a chunk of individual events that depend
         on each other for state calculations.
 
         Notifies about the events where appropriate.
+
+        Returns:
+            The contexts of the events, in the same order as `event_infos`.
         """
 
         async def prep(ev_info: _NewEventInfo):
@@ -1959,6 +2019,8 @@ class FederationHandler(BaseHandler):
             backfilled=backfilled,
         )
 
+        return contexts
+
     async def _persist_auth_tree(
         self,
         origin: str,
@@ -2027,6 +2089,7 @@ class FederationHandler(BaseHandler):
             else:
                 logger.info("Failed to find auth event %r", e_id)
 
+        events_and_auth = []
         for e in itertools.chain(auth_events, state, [event]):
             auth_for_e = {
                 (event_map[e_id].type, event_map[e_id].state_key): event_map[e_id]
@@ -2036,20 +2099,24 @@ class FederationHandler(BaseHandler):
             if create_event:
                 auth_for_e[(EventTypes.Create, "")] = create_event
 
-            try:
-                event_auth.check(room_version, e, auth_events=auth_for_e)
-            except SynapseError as err:
-                # we may get SynapseErrors here as well as AuthErrors. For
-                # instance, there are a couple of (ancient) events in some
-                # rooms whose senders do not have the correct sigil; these
-                # cause SynapseErrors in auth.check. We don't want to give up
-                # the attempt to federate altogether in such cases.
+            events_and_auth.append((e, auth_for_e))
+
+        # we may get SynapseErrors here as well as AuthErrors. For instance,
+        # there are a couple of (ancient) events in some rooms whose senders do
+        # not have the correct sigil; these cause SynapseErrors in auth.check.
+        # We don't want to give up the attempt to federate altogether in such
+        # cases.
+        auth_errors = event_auth.check_batch(room_version, events_and_auth)
+        for e, _ in events_and_auth:
+            err = auth_errors.get(e.event_id)
+            if err is None:
+                continue
 
-                logger.warning("Rejecting %s because %s", e.event_id, err.msg)
+            logger.warning("Rejecting %s because %s", e.event_id, err.msg)
 
-                if e == event:
-                    raise
-                events_to_context[e.event_id].rejected = RejectedReason.AUTH_ERROR
+            if e == event:
+                raise err
+            events_to_context[e.event_id].rejected = RejectedReason.AUTH_ERROR
 
         await self.persist_events_and_notify(
             room_id,
@@ -2074,8 +2141,11 @@ class FederationHandler(BaseHandler):
         state: Optional[Iterable[EventBase]],
         auth_events: Optional[MutableStateMap[EventBase]],
         backfilled: bool,
+        prev_state_groups: Optional[Dict[int, StateMap[str]]] = None,
     ) -> EventContext:
-        context = await self.state_handler.compute_event_context(event, old_state=state)
+        context = await self.state_handler.compute_event_context(
+            event, old_state=state, prev_state_groups=prev_state_groups
+        )
 
         if not auth_events:
             prev_state_ids = await context.get_prev_state_ids()
@@ -2204,7 +2274,7 @@ class FederationHandler(BaseHandler):
 
         # Now get the current auth_chain for the event.
         local_auth_chain = await self.store.get_auth_chain(
-            list(event.auth_event_ids()), include_given=True
+            event.room_id, list(event.auth_event_ids()), include_given=True
         )
 
         # TODO: Check if we would now reject event_id. If so we need to tell
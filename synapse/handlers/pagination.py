@@ -14,13 +14,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import logging
-from typing import TYPE_CHECKING, Any, Dict, Optional, Set
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Set
 
 from twisted.python.failure import Failure
 
 from synapse.api.constants import EventTypes, Membership
 from synapse.api.errors import SynapseError
 from synapse.api.filtering import Filter
+from synapse.events import EventBase
 from synapse.logging.context import run_in_background
 from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.storage.state import StateFilter
@@ -36,6 +37,10 @@ if TYPE_CHECKING:
 
 logger = logging.getLogger(__name__)
 
+# The maximum number of batches of events we'll pull from the database when
+# trying to fill a page of /messages with events the client is allowed to see.
+MAX_PAGINATION_BATCHES = 5
+
 
 class PurgeStatus:
     """Object tracking the status of a purge request
@@ -396,24 +401,56 @@ class PaginationHandler:
             if pagin_config.to_token:
                 to_room_key = pagin_config.to_token.room_key
 
-            events, next_key = await self.store.paginate_room_events(
-                room_id=room_id,
-                from_key=from_token.room_key,
-                to_key=to_room_key,
-                direction=pagin_config.direction,
-                limit=pagin_config.limit,
-                event_filter=event_filter,
-            )
+            events = []  # type: List[EventBase]
+            next_key = from_token.room_key
+
+            # We keep pulling batches of events from the database until we
+            # have `limit` events that are visible to the client, so that
+            # clients scrolling back through heavily filtered rooms don't get
+            # lots of short (or empty) pages.
+            for _ in range(MAX_PAGINATION_BATCHES):
+                batch, batch_next_key = await self.store.paginate_room_events(
+                    room_id=room_id,
+                    from_key=next_key,
+                    to_key=to_room_key,
+                    direction=pagin_config.direction,
+                    limit=pagin_config.limit,
+                    event_filter=event_filter,
+                )
 
-            next_token = from_token.copy_and_replace("room_key", next_key)
+                visible_events = batch
+                if event_filter:
+                    visible_events = event_filter.filter(visible_events)
 
-        if events:
-            if event_filter:
-                events = event_filter.filter(events)
+                if visible_events:
+                    visible_events = await filter_events_for_client(
+                        self.storage,
+                        user_id,
+                        visible_events,
+                        is_peeking=(member_event_id is None),
+                    )
 
-            events = await filter_events_for_client(
-                self.storage, user_id, events, is_peeking=(member_event_id is None)
-            )
+                remaining = pagin_config.limit - len(events)
+                if len(visible_events) > remaining:
+                    # We've got more visible events than we need, so the token
+                    # needs to point at the last event we actually return.
+                    visible_events = visible_events[:remaining]
+                    last_event = visible_events[-1]
+                    if pagin_config.direction == "b":
+                        next_key = last_event.internal_metadata.before
+                    else:
+                        next_key = last_event.internal_metadata.after
+                else:
+                    next_key = batch_next_key
+
+                events.extend(visible_events)
+
+                if len(events) >= pagin_config.limit or len(batch) < pagin_config.limit:
+                    # Either we have enough events, or we've reached the end of
+                    # the stream.
+                    break
+
+            next_token = from_token.copy_and_replace("room_key", next_key)
 
         if not events:
             return {
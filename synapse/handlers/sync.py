@@ -13,18 +13,39 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import cProfile
+import hashlib
+import io
 import itertools
 import logging
-from typing import TYPE_CHECKING, Any, Dict, FrozenSet, List, Optional, Set, Tuple
+import pstats
+import random
+from contextlib import contextmanager
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 
 import attr
-from prometheus_client import Counter
+from canonicaljson import encode_canonical_json
+from prometheus_client import Counter, Histogram
 
 from synapse.api.constants import AccountDataTypes, EventTypes, Membership
 from synapse.api.filtering import FilterCollection
 from synapse.events import EventBase
 from synapse.logging.context import current_context
+from synapse.logging.opentracing import start_active_span
+from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.push.clientformat import format_push_rules_for_user
+from synapse.storage.databases.main.lazy_loaded_members import hash_member_event_id
 from synapse.storage.roommember import MemberSummary
 from synapse.storage.state import StateFilter
 from synapse.types import (
@@ -65,6 +86,48 @@ non_empty_sync_counter = Counter(
     ["type", "lazy_loaded"],
 )
 
+# Counts the number of rooms in initial syncs for users with a sync snapshot.
+# `result` is "reused" if the room's entry was taken from the snapshot, or
+# "generated" if it had to be recalculated.
+sync_snapshot_rooms_counter = Counter(
+    "synapse_handlers_sync_snapshot_rooms_total",
+    "Count of rooms in initial syncs which used a sync snapshot. result is "
+    "reused/generated.",
+    ["result"],
+)
+
+# The time taken by each stage of calculating sync responses. `stage` is one of
+# "account_data", "rooms", "presence", "to_device", "device_lists",
+# "one_time_keys", "groups" or "encode" (formatting the response for the
+# client).
+sync_stage_time = Histogram(
+    "synapse_handlers_sync_stage_time_seconds",
+    "Time taken by each stage of calculating sync responses",
+    ["stage"],
+)
+
+# How long to remember slow syncs for the admin API, and the number of the
+# slowest to remember.
+SLOW_SYNC_WINDOW_MS = 60 * 60 * 1000
+MAX_SLOW_SYNCS = 10
+
+# The number of functions to include in the profiles of slow syncs.
+SLOW_SYNC_PROFILE_LINES = 50
+
+# Rooms with more state than this (after filtering) in an initial sync aren't
+# stored in sync snapshots, to bound the size of the snapshots.
+MAX_SNAPSHOT_ROOM_STATE = 1000
+
+# The bounds on the number of room entries generated concurrently in a sync, and
+# the number of room entries per concurrent generation between those bounds.
+MIN_ROOM_ENTRY_CONCURRENCY = 10
+MAX_ROOM_ENTRY_CONCURRENCY = 50
+ROOM_ENTRIES_PER_CONCURRENT_GENERATION = 10
+
+# The number of timeline and state delta fragments to cache for sharing between
+# the syncs of the users in a room.
+SYNC_FRAGMENTS_CACHE_SIZE = 10000
+
 # Store the cache that tracks which lazy-loaded members have been sent to a given
 # client for no more than 30 minutes.
 LAZY_LOADED_MEMBERS_CACHE_MAX_AGE = 30 * 60 * 1000
@@ -73,6 +136,15 @@ LAZY_LOADED_MEMBERS_CACHE_MAX_AGE = 30 * 60 * 1000
 # avoiding redundantly sending the same lazy-loaded members to the client
 LAZY_LOADED_MEMBERS_CACHE_MAX_SIZE = 100
 
+# The maximum number of member event ID hashes to remember, across all devices
+# and rooms, when the lazy-loaded members sent to clients are also stored in the
+# database.
+PERSISTED_LAZY_LOADED_MEMBERS_CACHE_MAX_SIZE = 500000
+
+# How often to write the lazy-loaded members sent to clients to the database,
+# when that is enabled.
+LAZY_LOADED_MEMBERS_FLUSH_INTERVAL_MS = 5 * 1000
+
 
 @attr.s(slots=True, frozen=True)
 class SyncConfig:
@@ -81,6 +153,9 @@ class SyncConfig:
     is_guest = attr.ib(type=bool)
     request_key = attr.ib(type=Tuple[Any, ...])
     device_id = attr.ib(type=str)
+    # If set, the (offset, limit) of the window of joined rooms, ordered by
+    # recency, to generate room entries for.
+    room_window = attr.ib(type=Optional[Tuple[int, int]], default=None)
 
 
 @attr.s(slots=True, frozen=True)
@@ -96,6 +171,17 @@ class TimelineBatch:
         return bool(self.events)
 
 
+@attr.s(slots=True, frozen=True)
+class _RoomSnapshot:
+    """The parts of a room's entry in an initial sync which can be stored in a
+    sync snapshot, rather than being recalculated on each initial sync.
+    """
+
+    batch = attr.ib(type=TimelineBatch)
+    state = attr.ib(type=MutableStateMap[EventBase])
+    summary = attr.ib(type=Optional[JsonDict])
+
+
 # We can't freeze this class, because we need to update it after it's instantiated to
 # update its unread count. This is because we calculate the unread count for a room only
 # if there are updates for it, which we check after the instance has been created.
@@ -160,6 +246,42 @@ class GroupsSyncResult:
         return bool(self.join or self.invite or self.leave)
 
 
+@attr.s(slots=True, frozen=True)
+class _TimelineFragment:
+    """The events loaded from the database for a room's timeline, before any
+    filtering for the syncing user.
+
+    Attributes:
+        events: The ID of each event along with the tokens before and after
+            it, in ascending order.
+        end_key: The token pointing to the start of the loaded events.
+    """
+
+    events = attr.ib(type=List[Tuple[str, RoomStreamToken, RoomStreamToken]])
+    end_key = attr.ib(type=RoomStreamToken)
+
+
+@attr.s(slots=True, frozen=True)
+class RoomWindowSyncResult:
+    """The result of a sync restricted to a window of the user's joined rooms.
+
+    Attributes:
+        room_ids: The joined rooms in the window, most recent first.
+        count: The total number of joined rooms.
+        changed: Joined rooms outside the window which have changed.
+    """
+
+    room_ids = attr.ib(type=List[str])
+    count = attr.ib(type=int)
+    changed = attr.ib(type=List[str])
+
+    def __bool__(self) -> bool:
+        """Make the result appear empty if no rooms outside the window have
+        changed, as the rooms in the window are included in the main result.
+        """
+        return bool(self.changed)
+
+
 @attr.s(slots=True, frozen=True)
 class DeviceLists:
     """
@@ -187,6 +309,47 @@ class _RoomChanges:
     newly_left_rooms = attr.ib(type=List[str])
 
 
+@attr.s(slots=True)
+class SyncTimings:
+    """The time taken to calculate a sync response.
+
+    Attributes:
+        sync_type: "initial_sync", "full_state_sync" or "incremental_sync"
+        duration: The total time taken, in seconds.
+        stages: The time taken by each stage, in seconds.
+        profile: The CPU profile of the calculation, if it was sampled for
+            profiling.
+        recorded: Whether the sync has been recorded by `record_sync_timings`.
+    """
+
+    sync_type = attr.ib(type=str)
+    duration = attr.ib(type=float, default=0.0)
+    stages = attr.ib(type=Dict[str, float], default=attr.Factory(dict))
+    profile = attr.ib(type=Optional[cProfile.Profile], default=None)
+    recorded = attr.ib(type=bool, default=False)
+
+
+@attr.s(slots=True, frozen=True)
+class SlowSync:
+    """Details of a sync, as returned by the admin API."""
+
+    user_id = attr.ib(type=str)
+    device_id = attr.ib(type=Optional[str])
+    sync_type = attr.ib(type=str)
+
+    # when the response was calculated, in milliseconds since the epoch
+    ts = attr.ib(type=int)
+
+    # the time taken to calculate and format the response, and by each stage
+    # of that, in seconds
+    duration = attr.ib(type=float)
+    stages = attr.ib(type=Dict[str, float])
+
+    # the CPU profile of the calculation, as formatted by `pstats`, if it was
+    # sampled for profiling
+    profile = attr.ib(type=Optional[str])
+
+
 @attr.s(slots=True, frozen=True)
 class SyncResult:
     """
@@ -204,6 +367,9 @@ class SyncResult:
         device_unused_fallback_key_types: List of key types that have an unused fallback
             key
         groups: Group updates, if any
+        room_window: The window of joined rooms, if the sync was restricted
+            to one
+        timings: The time taken to calculate the result
     """
 
     next_batch = attr.ib(type=StreamToken)
@@ -217,6 +383,8 @@ class SyncResult:
     device_one_time_keys_count = attr.ib(type=JsonDict)
     device_unused_fallback_key_types = attr.ib(type=List[str])
     groups = attr.ib(type=Optional[GroupsSyncResult])
+    room_window = attr.ib(type=Optional[RoomWindowSyncResult], default=None)
+    timings = attr.ib(type=Optional[SyncTimings], default=None)
 
     def __bool__(self) -> bool:
         """Make the result appear empty if there are no updates. This is used
@@ -232,6 +400,7 @@ class SyncResult:
             or self.to_device
             or self.device_lists
             or self.groups
+            or self.room_window
         )
 
 
@@ -250,6 +419,7 @@ class SyncHandler:
         self.auth = hs.get_auth()
         self.storage = hs.get_storage()
         self.state_store = self.storage.state
+        self._device_handler = hs.get_device_handler()
 
         # ExpiringCache((User, Device)) -> LruCache(state_key => event_id)
         self.lazy_loaded_members_cache = ExpiringCache(
@@ -259,6 +429,55 @@ class SyncHandler:
             expiry_ms=LAZY_LOADED_MEMBERS_CACHE_MAX_AGE,
         )
 
+        # Whether to also remember the lazy-loaded members sent to clients in
+        # the database, so that they survive restarts and moving workers.
+        self._lazy_loaded_members_persistence_enabled = (
+            hs.config.lazy_loaded_members_persistence_enabled
+        )
+
+        # LruCache((User, Device, Room)) -> (time added in ms, set of member
+        # event ID hashes, as returned by `hash_member_event_id`). The size of
+        # the cache is the total number of hashes, so entries must be popped
+        # and re-added when their set changes.
+        self._persisted_lazy_loaded_members = LruCache(
+            PERSISTED_LAZY_LOADED_MEMBERS_CACHE_MAX_SIZE,
+            "persisted_lazy_loaded_members",
+            size_callback=lambda entry: len(entry[1]),
+        )  # type: LruCache[Tuple[str, str, str], Tuple[int, Set[bytes]]]
+
+        # The members sent which are yet to be written to the database:
+        # (User, Device, Room) -> (whether to forget previous members, hashes)
+        self._pending_lazy_loaded_members = (
+            {}
+        )  # type: Dict[Tuple[str, str, str], Tuple[bool, Set[bytes]]]
+
+        if self._lazy_loaded_members_persistence_enabled:
+            self.clock.looping_call(
+                self._flush_lazy_loaded_members_sent,
+                LAZY_LOADED_MEMBERS_FLUSH_INTERVAL_MS,
+            )
+
+        self._sync_profiling_enabled = hs.config.sync_profiling_enabled
+        self._sync_profiling_sample_rate = hs.config.sync_profiling_sample_rate
+        self._sync_profile_active = False
+
+        # the slowest recent syncs, and the slowest which were profiled, for the
+        # admin API.
+        self._slow_syncs = []  # type: List[SlowSync]
+        self._slow_profiled_syncs = []  # type: List[SlowSync]
+
+        self._sync_snapshots_enabled = hs.config.sync_snapshots_enabled
+        self._sync_snapshots_min_rooms = hs.config.sync_snapshots_min_rooms
+
+        # The parts of room entries which don't depend on the syncing user, so
+        # that they can be shared between the syncs of all the users in a room.
+        self._timeline_fragment_cache = LruCache(
+            SYNC_FRAGMENTS_CACHE_SIZE, "sync_timeline_fragments"
+        )  # type: LruCache[Tuple[Any, ...], _TimelineFragment]
+        self._state_delta_fragment_cache = LruCache(
+            SYNC_FRAGMENTS_CACHE_SIZE, "sync_state_delta_fragments"
+        )  # type: LruCache[Tuple[Any, ...], StateMap[str]]
+
     async def wait_for_sync_for_user(
         self,
         requester: Requester,
@@ -295,12 +514,7 @@ class SyncHandler:
         timeout: int = 0,
         full_state: bool = False,
     ) -> SyncResult:
-        if since_token is None:
-            sync_type = "initial_sync"
-        elif full_state:
-            sync_type = "full_state_sync"
-        else:
-            sync_type = "incremental_sync"
+        sync_type = _get_sync_type(since_token, full_state)
 
         context = current_context()
         if context:
@@ -341,7 +555,98 @@ class SyncHandler:
     ) -> SyncResult:
         """Get the sync for client needed to match what the server has now.
         """
-        return await self.generate_sync_result(sync_config, since_token, full_state)
+        timings = SyncTimings(sync_type=_get_sync_type(since_token, full_state))
+        timings.profile = self._start_sync_profile()
+        start = self.clock.time()
+        try:
+            return await self.generate_sync_result(
+                sync_config, since_token, full_state, timings
+            )
+        finally:
+            timings.duration = self.clock.time() - start
+            if timings.profile is not None:
+                timings.profile.disable()
+                self._sync_profile_active = False
+
+    def _start_sync_profile(self) -> Optional[cProfile.Profile]:
+        """Start profiling a sync, if it has been sampled for profiling.
+
+        Returns:
+            The profiler, or None if the sync isn't to be profiled.
+        """
+        if not self._sync_profiling_enabled or self._sync_profile_active:
+            return None
+        if random.random() >= self._sync_profiling_sample_rate:
+            return None
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Something else is already profiling the process.
+            return None
+
+        self._sync_profile_active = True
+        return profile
+
+    @contextmanager
+    def _time_sync_stage(self, timings: SyncTimings, stage: str) -> Iterator[None]:
+        """Time a stage of calculating a sync response, and trace it as a span
+        of the request.
+        """
+        start = self.clock.time()
+        try:
+            with start_active_span("sync.%s" % (stage,)):
+                yield
+        finally:
+            duration = self.clock.time() - start
+            timings.stages[stage] = duration
+            sync_stage_time.labels(stage).observe(duration)
+
+    def record_sync_timings(
+        self, sync_config: SyncConfig, timings: SyncTimings, encode_duration: float
+    ) -> None:
+        """Record the time taken to calculate and format a sync response, so
+        that the slowest are available through the admin API.
+
+        Args:
+            sync_config
+            timings: The timings of the sync result.
+            encode_duration: The time taken to format the response for the
+                client, in seconds.
+        """
+        sync_stage_time.labels("encode").observe(encode_duration)
+
+        # Requests which shared the result of another only count once.
+        if timings.recorded:
+            return
+        timings.recorded = True
+
+        slow_sync = SlowSync(
+            user_id=sync_config.user.to_string(),
+            device_id=sync_config.device_id,
+            sync_type=timings.sync_type,
+            ts=self.clock.time_msec(),
+            duration=timings.duration + encode_duration,
+            stages=dict(timings.stages, encode=encode_duration),
+            profile=None,
+        )
+        self._slow_syncs = _add_slow_sync(self._slow_syncs, slow_sync, timings.profile)
+        if timings.profile is not None:
+            self._slow_profiled_syncs = _add_slow_sync(
+                self._slow_profiled_syncs, slow_sync, timings.profile
+            )
+
+    def get_slow_syncs(self, profiled: bool = False) -> List[SlowSync]:
+        """Get the slowest recent syncs calculated by this process, slowest
+        first.
+
+        Args:
+            profiled: Whether to only include syncs which were profiled.
+        """
+        now = self.clock.time_msec()
+        slow_syncs = self._slow_profiled_syncs if profiled else self._slow_syncs
+        return [s for s in slow_syncs if s.ts > now - SLOW_SYNC_WINDOW_MS]
 
     async def push_rules_for_user(self, user: UserID) -> JsonDict:
         user_id = user.to_string()
@@ -488,17 +793,9 @@ class SyncHandler:
                 # can just use `get_room_events_stream_for_room`.
                 # Otherwise, we want to return the last N events in the room
                 # in toplogical ordering.
-                if since_key:
-                    events, end_key = await self.store.get_room_events_stream_for_room(
-                        room_id,
-                        limit=load_limit + 1,
-                        from_key=since_key,
-                        to_key=end_key,
-                    )
-                else:
-                    events, end_key = await self.store.get_recent_events_for_room(
-                        room_id, limit=load_limit + 1, end_token=end_key
-                    )
+                events, end_key = await self._load_timeline_fragment(
+                    room_id, since_key, end_key, load_limit + 1
+                )
                 loaded_recents = sync_config.filter_collection.filter_room_timeline(
                     events
                 )
@@ -540,6 +837,86 @@ class SyncHandler:
             limited=limited or newly_joined_room,
         )
 
+    async def _load_timeline_fragment(
+        self,
+        room_id: str,
+        since_key: Optional[RoomStreamToken],
+        end_key: RoomStreamToken,
+        limit: int,
+    ) -> Tuple[List[EventBase], RoomStreamToken]:
+        """Load the events in a room before `end_key`, and after `since_key` if
+        given, before any filtering for the syncing user.
+
+        Only the event IDs and their positions are cached, and the events are
+        fetched each time, so that any redactions are applied.
+
+        Args:
+            room_id
+            since_key: The token of the previous sync, if the events should
+                come from the live stream.
+            end_key
+            limit
+
+        Returns:
+            The events in ascending order, and a token pointing to the start of
+            the returned events.
+        """
+        cache_key = (
+            room_id,
+            _get_room_key_cache_key(since_key),
+            _get_room_key_cache_key(end_key),
+            limit,
+        )
+        fragment = self._timeline_fragment_cache.get(cache_key)
+        if fragment is None:
+            # If we have a since_key then we are trying to get any events
+            # that have happened since `since_key` up to `end_key`, so we
+            # can just use `get_room_events_stream_for_room`.
+            # Otherwise, we want to return the last N events in the room
+            # in toplogical ordering.
+            if since_key:
+                events, new_end_key = await self.store.get_room_events_stream_for_room(
+                    room_id, limit=limit, from_key=since_key, to_key=end_key,
+                )
+            else:
+                events, new_end_key = await self.store.get_recent_events_for_room(
+                    room_id, limit=limit, end_token=end_key
+                )
+
+            self._timeline_fragment_cache.set(
+                cache_key,
+                _TimelineFragment(
+                    events=[
+                        (
+                            event.event_id,
+                            event.internal_metadata.before,
+                            event.internal_metadata.after,
+                        )
+                        for event in events
+                    ],
+                    end_key=new_end_key,
+                ),
+            )
+            return events, new_end_key
+
+        events = await self.store.get_events_as_list(
+            [event_id for event_id, _, _ in fragment.events], get_prev_content=True
+        )
+        tokens = {
+            event_id: (before, after) for event_id, before, after in fragment.events
+        }
+        for event in events:
+            # The event may have been evicted from the event cache (or
+            # redacted) since the fragment was cached, so put back the ordering
+            # information that the storage layer would have set on it.
+            before, after = tokens[event.event_id]
+            internal = event.internal_metadata
+            internal.before = before
+            internal.after = after
+            internal.order = (after.topological or 0, after.stream)
+
+        return events, fragment.end_key
+
     async def get_state_after_event(
         self, event: EventBase, state_filter: StateFilter = StateFilter.all()
     ) -> StateMap[str]:
@@ -716,12 +1093,26 @@ class SyncHandler:
             )
         ]
 
+        if missing_hero_event_ids and self._lazy_loaded_members_persistence_enabled:
+            persisted = await self._get_persisted_lazy_loaded_members(
+                sync_config, room_id
+            )
+            missing_hero_event_ids = [
+                event_id
+                for event_id in missing_hero_event_ids
+                if hash_member_event_id(event_id) not in persisted
+            ]
+
         missing_hero_state = await self.store.get_events(missing_hero_event_ids)
 
         for s in missing_hero_state.values():
             cache.set(s.state_key, s.event_id)
             state[(EventTypes.Member, s.state_key)] = s
 
+        self._record_lazy_loaded_members_sent(
+            sync_config, room_id, missing_hero_state, reset=False
+        )
+
         return summary
 
     def get_lazy_loaded_members_cache(self, cache_key: Tuple[str, str]) -> LruCache:
@@ -734,6 +1125,109 @@ class SyncHandler:
             logger.debug("found LruCache for %r", cache_key)
         return cache
 
+    async def _get_persisted_lazy_loaded_members(
+        self, sync_config: SyncConfig, room_id: str
+    ) -> Set[bytes]:
+        """Get the hashes of the member events which have been sent to the
+        syncing device in a room, as remembered in the database.
+        """
+        key = (sync_config.user.to_string(), sync_config.device_id, room_id)
+        members = self._get_cached_persisted_lazy_loaded_members(key)
+        if members is not None:
+            return members
+
+        members = set(await self.store.get_lazy_loaded_members_sent(*key))
+
+        # Include anything sent which hasn't been written to the database yet.
+        pending = self._pending_lazy_loaded_members.get(key)
+        if pending is not None:
+            reset, hashes = pending
+            if reset:
+                members = set(hashes)
+            else:
+                members.update(hashes)
+
+        self._persisted_lazy_loaded_members[key] = (self.clock.time_msec(), members)
+        return members
+
+    def _get_cached_persisted_lazy_loaded_members(
+        self, key: Tuple[str, str, str]
+    ) -> Optional[Set[bytes]]:
+        """Get the hashes of the member events sent to a device in a room from
+        the in-memory cache, if they are there and haven't expired.
+        """
+        entry = self._persisted_lazy_loaded_members.get(key)
+        if entry is None:
+            return None
+
+        added_ms, members = entry
+        if self.clock.time_msec() - added_ms >= LAZY_LOADED_MEMBERS_CACHE_MAX_AGE:
+            self._persisted_lazy_loaded_members.pop(key)
+            return None
+
+        return members
+
+    def _record_lazy_loaded_members_sent(
+        self,
+        sync_config: SyncConfig,
+        room_id: str,
+        event_ids: Iterable[str],
+        reset: bool,
+    ) -> None:
+        """Record that member events have been sent to the syncing device in a
+        room, so that they will be written to the database.
+
+        Args:
+            sync_config
+            room_id
+            event_ids: The IDs of the member events sent.
+            reset: Whether to forget the members previously sent, as this is a
+                new sync sequence.
+        """
+        if not self._lazy_loaded_members_persistence_enabled:
+            return
+
+        hashes = {hash_member_event_id(event_id) for event_id in event_ids}
+        if not hashes and not reset:
+            return
+
+        key = (sync_config.user.to_string(), sync_config.device_id, room_id)
+
+        if reset:
+            self._persisted_lazy_loaded_members[key] = (
+                self.clock.time_msec(),
+                set(hashes),
+            )
+        else:
+            # Pop the entry before changing it, so that the cache's running
+            # size stays correct.
+            entry = self._persisted_lazy_loaded_members.pop(key)
+            if entry is not None:
+                entry[1].update(hashes)
+                self._persisted_lazy_loaded_members[key] = entry
+
+        pending = self._pending_lazy_loaded_members.get(key)
+        if reset or pending is None:
+            self._pending_lazy_loaded_members[key] = (reset, hashes)
+        else:
+            pending[1].update(hashes)
+
+    def _flush_lazy_loaded_members_sent(self) -> None:
+        """Write the lazy-loaded members sent since the last flush to the
+        database.
+        """
+        if not self._pending_lazy_loaded_members:
+            return
+
+        pending = self._pending_lazy_loaded_members
+        self._pending_lazy_loaded_members = {}
+
+        run_as_background_process(
+            "update_lazy_loaded_members_sent",
+            self.store.update_lazy_loaded_members_sent,
+            pending,
+        )
+
     async def compute_state_delta(
         self,
         room_id: str,
@@ -794,6 +1288,27 @@ class SyncHandler:
                 if event.is_state()
             }
 
+            # Unless this is a full state sync (where we lazy-load the syncing
+            # user), the state before filtering for the syncing user only
+            # depends on the timeline and the tokens, so is shared between all
+            # the users in the room with the same timeline.
+            state_ids_cache_key = None
+            cached_state_ids = None
+            if not full_state and (batch.limited or lazy_load_members):
+                state_ids_cache_key = (
+                    room_id,
+                    tuple(event.event_id for event in batch.events),
+                    batch.limited,
+                    _get_room_key_cache_key(since_token.room_key)
+                    if since_token
+                    else None,
+                    _get_room_key_cache_key(now_token.room_key),
+                    lazy_load_members,
+                )
+                cached_state_ids = self._state_delta_fragment_cache.get(
+                    state_ids_cache_key
+                )
+
             if full_state:
                 if batch:
                     current_state_ids = await self.state_store.get_state_ids_for_event(
@@ -818,6 +1333,8 @@ class SyncHandler:
                     current=current_state_ids,
                     lazy_load_members=lazy_load_members,
                 )
+            elif cached_state_ids is not None:
+                state_ids = cached_state_ids
             elif batch.limited:
                 if batch:
                     state_at_timeline_start = await self.state_store.get_state_ids_for_event(
@@ -893,6 +1410,9 @@ class SyncHandler:
                             ),
                         )
 
+            if state_ids_cache_key is not None and cached_state_ids is None:
+                self._state_delta_fragment_cache.set(state_ids_cache_key, state_ids)
+
             if lazy_load_members and not include_redundant_members:
                 cache_key = (sync_config.user.to_string(), sync_config.device_id)
                 cache = self.get_lazy_loaded_members_cache(cache_key)
@@ -913,14 +1433,38 @@ class SyncHandler:
                         for t, event_id in state_ids.items()
                         if cache.get(t[1]) != event_id
                     }
+
+                    # ... nor those which we've remembered sending in the
+                    # database (e.g. before a restart).
+                    if self._lazy_loaded_members_persistence_enabled and any(
+                        t[0] == EventTypes.Member for t in state_ids
+                    ):
+                        persisted = await self._get_persisted_lazy_loaded_members(
+                            sync_config, room_id
+                        )
+                        state_ids = {
+                            t: event_id
+                            for t, event_id in state_ids.items()
+                            if t[0] != EventTypes.Member
+                            or hash_member_event_id(event_id) not in persisted
+                        }
                     logger.debug("...to %r", state_ids)
 
                 # add any member IDs we are about to send into our LruCache
+                sent_member_event_ids = []
                 for t, event_id in itertools.chain(
                     state_ids.items(), timeline_state.items()
                 ):
                     if t[0] == EventTypes.Member:
                         cache.set(t[1], event_id)
+                        sent_member_event_ids.append(event_id)
+
+                self._record_lazy_loaded_members_sent(
+                    sync_config,
+                    room_id,
+                    sent_member_event_ids,
+                    reset=since_token is None,
+                )
 
         state = {}  # type: Dict[str, EventBase]
         if state_ids:
@@ -934,29 +1478,69 @@ class SyncHandler:
             if e.type != EventTypes.Aliases  # until MSC2261 or alternative solution
         }
 
-    async def unread_notifs_for_room_id(
-        self, room_id: str, sync_config: SyncConfig
-    ) -> Dict[str, int]:
-        with Measure(self.clock, "unread_notifs_for_room_id"):
-            last_unread_event_id = await self.store.get_last_receipt_event_id_for_user(
-                user_id=sync_config.user.to_string(),
-                room_id=room_id,
-                receipt_type="m.read",
-            )
+    async def _add_unread_counts(
+        self, sync_config: SyncConfig, joined: List[JoinedSyncResult]
+    ) -> None:
+        """Fill in the unread notification counts of joined room entries, by
+        looking them up for all the rooms at once.
+        """
+        if not joined:
+            return
 
-            notifs = await self.store.get_unread_event_push_actions_by_room_for_user(
-                room_id, sync_config.user.to_string(), last_unread_event_id
+        user_id = sync_config.user.to_string()
+        with Measure(self.clock, "unread_notifs_for_room_ids"):
+            receipts = await self.store.get_receipts_for_user(user_id, "m.read")
+            last_read_event_ids = {
+                room_sync.room_id: receipts.get(room_sync.room_id)
+                for room_sync in joined
+            }
+            notifs_by_room = await self.store.get_unread_event_push_actions_by_rooms_for_user(
+                user_id, last_read_event_ids
             )
-            return notifs
+
+        for room_sync in joined:
+            notifs = notifs_by_room[room_sync.room_id]
+
+            unread_notifications = room_sync.unread_notifications
+            unread_notifications["notification_count"] = notifs["notify_count"]
+            unread_notifications["highlight_count"] = notifs["highlight_count"]
+
+            room_sync.unread_count = notifs["unread_count"]
+
+    async def _prefetch_state_groups_for_room_entries(
+        self, room_entries: List["RoomSyncResultBuilder"]
+    ) -> None:
+        """Look up the state groups of the events already loaded for the room
+        entries in one go, so that filtering them for the client and calculating
+        the state deltas hits the cache rather than querying them one at a time.
+        """
+        event_ids = [
+            event.event_id
+            for room_entry in room_entries
+            if room_entry.events
+            for event in room_entry.events
+        ]
+        if event_ids:
+            await self.state_store.get_state_group_for_events(event_ids)
 
     async def generate_sync_result(
         self,
         sync_config: SyncConfig,
         since_token: Optional[StreamToken] = None,
         full_state: bool = False,
+        timings: Optional[SyncTimings] = None,
     ) -> SyncResult:
         """Generates a sync result.
+
+        Args:
+            sync_config
+            since_token
+            full_state
+            timings: Where to record the time taken by each stage of the sync.
         """
+        if timings is None:
+            timings = SyncTimings(sync_type=_get_sync_type(since_token, full_state))
+
         # NB: The now_token gets changed by some of the generate_sync_* methods,
         # this is due to some of the underlying streams not supporting the ability
         # to query up to a given point.
@@ -990,15 +1574,17 @@ class SyncHandler:
 
         logger.debug("Fetching account data")
 
-        account_data_by_room = await self._generate_sync_entry_for_account_data(
-            sync_result_builder
-        )
+        with self._time_sync_stage(timings, "account_data"):
+            account_data_by_room = await self._generate_sync_entry_for_account_data(
+                sync_result_builder
+            )
 
         logger.debug("Fetching room data")
 
-        res = await self._generate_sync_entry_for_rooms(
-            sync_result_builder, account_data_by_room
-        )
+        with self._time_sync_stage(timings, "rooms"):
+            res = await self._generate_sync_entry_for_rooms(
+                sync_result_builder, account_data_by_room
+            )
         newly_joined_rooms, newly_joined_or_invited_users, _, _ = res
         _, _, newly_left_rooms, newly_left_users = res
 
@@ -1007,35 +1593,42 @@ class SyncHandler:
         )
         if self.hs_config.use_presence and not block_all_presence_data:
             logger.debug("Fetching presence data")
-            await self._generate_sync_entry_for_presence(
-                sync_result_builder, newly_joined_rooms, newly_joined_or_invited_users
-            )
+            with self._time_sync_stage(timings, "presence"):
+                await self._generate_sync_entry_for_presence(
+                    sync_result_builder,
+                    newly_joined_rooms,
+                    newly_joined_or_invited_users,
+                )
 
         logger.debug("Fetching to-device data")
-        await self._generate_sync_entry_for_to_device(sync_result_builder)
-
-        device_lists = await self._generate_sync_entry_for_device_list(
-            sync_result_builder,
-            newly_joined_rooms=newly_joined_rooms,
-            newly_joined_or_invited_users=newly_joined_or_invited_users,
-            newly_left_rooms=newly_left_rooms,
-            newly_left_users=newly_left_users,
-        )
+        with self._time_sync_stage(timings, "to_device"):
+            await self._generate_sync_entry_for_to_device(sync_result_builder)
+
+        with self._time_sync_stage(timings, "device_lists"):
+            device_lists = await self._generate_sync_entry_for_device_list(
+                sync_result_builder,
+                newly_joined_rooms=newly_joined_rooms,
+                newly_joined_or_invited_users=newly_joined_or_invited_users,
+                newly_left_rooms=newly_left_rooms,
+                newly_left_users=newly_left_users,
+            )
 
         logger.debug("Fetching OTK data")
         device_id = sync_config.device_id
         one_time_key_counts = {}  # type: JsonDict
         unused_fallback_key_types = []  # type: List[str]
         if device_id:
-            one_time_key_counts = await self.store.count_e2e_one_time_keys(
-                user_id, device_id
-            )
-            unused_fallback_key_types = await self.store.get_e2e_unused_fallback_key_types(
-                user_id, device_id
-            )
+            with self._time_sync_stage(timings, "one_time_keys"):
+                one_time_key_counts = await self.store.count_e2e_one_time_keys(
+                    user_id, device_id
+                )
+                unused_fallback_key_types = await self.store.get_e2e_unused_fallback_key_types(
+                    user_id, device_id
+                )
 
         logger.debug("Fetching group data")
-        await self._generate_sync_entry_for_groups(sync_result_builder)
+        with self._time_sync_stage(timings, "groups"):
+            await self._generate_sync_entry_for_groups(sync_result_builder)
 
         # debug for https://github.com/matrix-org/synapse/issues/4422
         for joined_room in sync_result_builder.joined:
@@ -1058,6 +1651,8 @@ class SyncHandler:
             device_one_time_keys_count=one_time_key_counts,
             device_unused_fallback_key_types=unused_fallback_key_types,
             next_batch=sync_result_builder.now_token,
+            room_window=sync_result_builder.room_window,
+            timings=timings,
         )
 
     @measure_func("_generate_sync_entry_for_groups")
@@ -1149,22 +1744,9 @@ class SyncHandler:
             # room with by looking at all users that have left a room plus users
             # that were in a room we've left.
 
-            users_who_share_room = await self.store.get_users_who_share_room_with_user(
-                user_id
-            )
-
-            # Always tell the user about their own devices. We check as the user
-            # ID is almost certainly already included (unless they're not in any
-            # rooms) and taking a copy of the set is relatively expensive.
-            if user_id not in users_who_share_room:
-                users_who_share_room = set(users_who_share_room)
-                users_who_share_room.add(user_id)
-
-            tracked_users = users_who_share_room
-
             # Step 1a, check for changes in devices of users we share a room with
-            users_that_have_changed = await self.store.get_users_whose_devices_changed(
-                since_token.device_list_key, tracked_users
+            users_that_have_changed = await self._device_handler.get_tracked_users_whose_devices_changed(
+                user_id, since_token.device_list_key
             )
 
             # Step 1b, check for newly joined rooms
@@ -1187,7 +1769,10 @@ class SyncHandler:
                 newly_left_users.update(left_users)
 
             # Remove any users that we still share a room with.
-            newly_left_users -= users_who_share_room
+            newly_left_users.discard(user_id)
+            newly_left_users -= await self.store.filter_users_who_share_room_with_user(
+                user_id, newly_left_users
+            )
 
             return DeviceLists(changed=users_that_have_changed, left=newly_left_users)
         else:
@@ -1422,6 +2007,41 @@ class SyncHandler:
         newly_joined_rooms = room_changes.newly_joined_rooms
         newly_left_rooms = room_changes.newly_left_rooms
 
+        if sync_result_builder.sync_config.room_window is not None:
+            room_entries = await self._filter_room_entries_to_window(
+                sync_result_builder,
+                room_entries,
+                rooms_with_updates=itertools.chain(
+                    ephemeral_by_room, tags_by_room, account_data_by_room
+                ),
+            )
+
+        # For initial syncs of users in lots of rooms, we reuse the entries of
+        # any rooms which haven't changed since the user's last initial sync.
+        use_snapshot = (
+            since_token is None
+            and sync_result_builder.sync_config.room_window is None
+            and self._sync_snapshots_enabled
+            and len(sync_result_builder.joined_room_ids)
+            >= self._sync_snapshots_min_rooms
+        )
+
+        room_snapshots = {}  # type: Dict[str, _RoomSnapshot]
+        new_room_snapshots = (
+            None
+        )  # type: Optional[Dict[str, Tuple[str, _RoomSnapshot]]]
+        if use_snapshot:
+            snapshot_filter_key = _get_sync_snapshot_filter_key(
+                sync_result_builder.sync_config, ignored_users
+            )
+            room_snapshots, removed_room_ids = await self._load_sync_snapshot(
+                user_id,
+                snapshot_filter_key,
+                room_entries,
+                sync_result_builder.now_token,
+            )
+            new_room_snapshots = {}
+
         async def handle_room_entries(room_entry):
             logger.debug("Generating room entry for %s", room_entry.room_id)
             res = await self._generate_room_entry(
@@ -1432,11 +2052,37 @@ class SyncHandler:
                 tags=tags_by_room.get(room_entry.room_id),
                 account_data=account_data_by_room.get(room_entry.room_id, {}),
                 always_include=sync_result_builder.full_state,
+                snapshot=room_snapshots.get(room_entry.room_id),
+                new_snapshots=new_room_snapshots,
             )
             logger.debug("Generated room entry for %s", room_entry.room_id)
             return res
 
-        await concurrently_execute(handle_room_entries, room_entries, 10)
+        await self._prefetch_state_groups_for_room_entries(room_entries)
+
+        joined_before = len(sync_result_builder.joined)
+        await concurrently_execute(
+            handle_room_entries,
+            room_entries,
+            _get_room_entry_concurrency(len(room_entries)),
+        )
+        await self._add_unread_counts(
+            sync_result_builder.sync_config, sync_result_builder.joined[joined_before:]
+        )
+
+        if new_room_snapshots is not None:
+            sync_snapshot_rooms_counter.labels("reused").inc(len(room_snapshots))
+            sync_snapshot_rooms_counter.labels("generated").inc(len(new_room_snapshots))
+
+            run_as_background_process(
+                "update_sync_snapshot",
+                self._update_sync_snapshot,
+                user_id,
+                snapshot_filter_key,
+                new_room_snapshots,
+                removed_room_ids,
+                sync_result_builder.now_token,
+            )
 
         sync_result_builder.invited.extend(invited)
 
@@ -1780,6 +2426,207 @@ class SyncHandler:
 
         return _RoomChanges(room_entries, invited, [], [])
 
+    async def _filter_room_entries_to_window(
+        self,
+        sync_result_builder: "SyncResultBuilder",
+        room_entries: List["RoomSyncResultBuilder"],
+        rooms_with_updates: Iterable[str],
+    ) -> List["RoomSyncResultBuilder"]:
+        """Restrict the joined room entries to the window of joined rooms
+        requested in the sync config, and populate the `room_window` of the
+        `sync_result_builder`.
+
+        Rooms outside the window which have changed since the previous sync are
+        only listed, rather than having their entries generated.
+
+        Args:
+            sync_result_builder
+            room_entries: the entries for all the rooms which would be in the
+                sync response
+            rooms_with_updates: rooms with new ephemeral events, tags or
+                account data
+
+        Returns:
+            The entries for the rooms which should be in the sync response.
+        """
+        room_window = sync_result_builder.sync_config.room_window
+        assert room_window is not None
+        offset, limit = room_window
+
+        joined_room_ids = sync_result_builder.joined_room_ids
+        ordered_room_ids = await self.store.get_rooms_by_recency(
+            joined_room_ids, offset + limit
+        )
+        window_room_ids = ordered_room_ids[offset:]
+
+        filtered_entries = []
+        changed = []
+        window_room_id_set = set(window_room_ids)
+        rooms_with_updates = set(rooms_with_updates)
+        for room_entry in room_entries:
+            if room_entry.rtype != "joined" or room_entry.room_id in window_room_id_set:
+                filtered_entries.append(room_entry)
+            elif sync_result_builder.since_token and (
+                room_entry.events
+                or room_entry.newly_joined
+                or room_entry.room_id in rooms_with_updates
+            ):
+                changed.append(room_entry.room_id)
+
+        sync_result_builder.room_window = RoomWindowSyncResult(
+            room_ids=window_room_ids, count=len(joined_room_ids), changed=changed
+        )
+
+        return filtered_entries
+
+    async def _load_sync_snapshot(
+        self,
+        user_id: str,
+        filter_key: str,
+        room_entries: List["RoomSyncResultBuilder"],
+        now_token: StreamToken,
+    ) -> Tuple[Dict[str, _RoomSnapshot], Set[str]]:
+        """Load the entries of the user's sync snapshot which can be used in the
+        current initial sync.
+
+        An entry can be used if the room hasn't changed since the entry was
+        calculated.
+
+        Args:
+            user_id
+            filter_key: identifies the snapshot, see `_get_sync_snapshot_filter_key`
+            room_entries: the rooms in the initial sync
+            now_token: the token the initial sync is up to
+
+        Returns:
+            A map from room ID to the reusable entries, and the IDs of the rooms
+            in the snapshot which are no longer in the initial sync.
+        """
+        rows = await self.store.get_sync_snapshot(user_id, filter_key)
+
+        removed_room_ids = set(rows)
+        usable_entries = {}  # type: Dict[str, JsonDict]
+        for room_builder in room_entries:
+            room_id = room_builder.room_id
+            removed_room_ids.discard(room_id)
+
+            if room_id not in rows:
+                continue
+
+            stream_ordering, entry = rows[room_id]
+            if entry["rtype"] != room_builder.rtype:
+                continue
+
+            # The entry may be from a sync on a worker which is ahead of us.
+            if stream_ordering > now_token.room_key.stream:
+                continue
+
+            if self.store.has_room_changed_since(room_id, stream_ordering):
+                continue
+
+            usable_entries[room_id] = entry
+
+        if not usable_entries:
+            return {}, removed_room_ids
+
+        # The timeline events are fetched with their `prev_content`, as they
+        # are when calculating the timeline.
+        timeline_event_ids = set()  # type: Set[str]
+        state_event_ids = set()  # type: Set[str]
+        for entry in usable_entries.values():
+            timeline_event_ids.update(entry["timeline"])
+            state_event_ids.update(entry["state"])
+        timeline_events = {
+            event.event_id: event
+            for event in await self.store.get_events_as_list(
+                timeline_event_ids, get_prev_content=True
+            )
+        }
+        state_events = await self.store.get_events(state_event_ids)
+
+        room_snapshots = {}
+        for room_id, entry in usable_entries.items():
+            # If any of the events have gone away (e.g. because they were
+            # purged) we fall back to recalculating the entry.
+            if any(
+                event_id not in timeline_events for event_id in entry["timeline"]
+            ) or any(event_id not in state_events for event_id in entry["state"]):
+                continue
+
+            # Visibility can change without the room changing, e.g. when a
+            # sender is erased, so the timeline is filtered again.
+            recents = [timeline_events[event_id] for event_id in entry["timeline"]]
+            current_state_ids = frozenset()  # type: FrozenSet[str]
+            if any(e.is_state() for e in recents):
+                current_state_ids_map = await self.state.get_current_state_ids(room_id)
+                current_state_ids = frozenset(current_state_ids_map.values())
+
+            filtered_recents = await filter_events_for_client(
+                self.storage, user_id, recents, always_include_ids=current_state_ids,
+            )
+            if len(filtered_recents) != len(recents):
+                continue
+
+            batch = TimelineBatch(
+                events=filtered_recents,
+                prev_batch=await StreamToken.from_string(
+                    self.store, entry["prev_batch"]
+                ),
+                limited=entry["limited"],
+            )
+            state = {
+                (event.type, event.state_key): event
+                for event in (state_events[event_id] for event_id in entry["state"])
+            }
+            room_snapshots[room_id] = _RoomSnapshot(
+                batch=batch, state=state, summary=entry["summary"]
+            )
+
+        return room_snapshots, removed_room_ids
+
+    async def _update_sync_snapshot(
+        self,
+        user_id: str,
+        filter_key: str,
+        room_snapshots: Dict[str, Tuple[str, _RoomSnapshot]],
+        removed_room_ids: Set[str],
+        now_token: StreamToken,
+    ) -> None:
+        """Store the newly calculated room entries of an initial sync in the
+        user's sync snapshot.
+
+        Args:
+            user_id
+            filter_key: identifies the snapshot, see `_get_sync_snapshot_filter_key`
+            room_snapshots: map from room ID to the newly calculated room
+                entries, and the type of the entry.
+            removed_room_ids: rooms which should be removed from the snapshot
+            now_token: the token the initial sync was up to
+        """
+        updated_entries = {}  # type: Dict[str, Tuple[int, JsonDict]]
+        removed_room_ids = set(removed_room_ids)
+        for room_id, (rtype, room_snapshot) in room_snapshots.items():
+            if len(room_snapshot.state) > MAX_SNAPSHOT_ROOM_STATE:
+                removed_room_ids.add(room_id)
+                continue
+
+            batch = room_snapshot.batch
+            updated_entries[room_id] = (
+                now_token.room_key.stream,
+                {
+                    "rtype": rtype,
+                    "timeline": [event.event_id for event in batch.events],
+                    "limited": batch.limited,
+                    "prev_batch": await batch.prev_batch.to_string(self.store),
+                    "state": [event.event_id for event in room_snapshot.state.values()],
+                    "summary": room_snapshot.summary,
+                },
+            )
+
+        await self.store.update_sync_snapshot(
+            user_id, filter_key, updated_entries, removed_room_ids
+        )
+
     async def _generate_room_entry(
         self,
         sync_result_builder: "SyncResultBuilder",
@@ -1789,6 +2636,8 @@ class SyncHandler:
         tags: Optional[Dict[str, Dict[str, Any]]],
         account_data: Dict[str, JsonDict],
         always_include: bool = False,
+        snapshot: Optional[_RoomSnapshot] = None,
+        new_snapshots: Optional[Dict[str, Tuple[str, _RoomSnapshot]]] = None,
     ):
         """Populates the `joined` and `archived` section of `sync_result_builder`
         based on the `room_builder`.
@@ -1803,6 +2652,11 @@ class SyncHandler:
             account_data: List of new account data for room
             always_include: Always include this room in the sync response,
                 even if empty.
+            snapshot: The room's entry from the user's sync snapshot, which
+                is used instead of recalculating the timeline, state and summary.
+            new_snapshots: If not None, the newly calculated timeline, state and
+                summary are added to this (along with the `rtype`), to be stored
+                in the user's sync snapshot.
         """
         newly_joined = room_builder.newly_joined
         full_state = (
@@ -1822,14 +2676,17 @@ class SyncHandler:
         since_token = room_builder.since_token
         upto_token = room_builder.upto_token
 
-        batch = await self._load_filtered_recents(
-            room_id,
-            sync_config,
-            now_token=upto_token,
-            since_token=since_token,
-            potential_recents=events,
-            newly_joined_room=newly_joined,
-        )
+        if snapshot:
+            batch = snapshot.batch
+        else:
+            batch = await self._load_filtered_recents(
+                room_id,
+                sync_config,
+                now_token=upto_token,
+                since_token=since_token,
+                potential_recents=events,
+                newly_joined_room=newly_joined,
+            )
 
         # Note: `batch` can be both empty and limited here in the case where
         # `_load_filtered_recents` can't find any events the user should see
@@ -1874,16 +2731,29 @@ class SyncHandler:
         ):
             return
 
-        state = await self.compute_state_delta(
-            room_id, batch, sync_config, since_token, now_token, full_state=full_state
-        )
+        if snapshot:
+            state = snapshot.state
+            self._add_snapshot_members_to_lazy_loaded_cache(
+                sync_config, room_id, snapshot
+            )
+        else:
+            state = await self.compute_state_delta(
+                room_id,
+                batch,
+                sync_config,
+                since_token,
+                now_token,
+                full_state=full_state,
+            )
 
         summary = {}  # type: Optional[JsonDict]
 
         # we include a summary in room responses when we're lazy loading
         # members (as the client otherwise doesn't have enough info to form
         # the name itself).
-        if sync_config.filter_collection.lazy_load_members() and (
+        if snapshot:
+            summary = snapshot.summary
+        elif sync_config.filter_collection.lazy_load_members() and (
             # we recalculate the summary:
             #   if there are membership changes in the timeline, or
             #   if membership has changed during a gappy sync, or
@@ -1901,6 +2771,12 @@ class SyncHandler:
                 room_id, sync_config, batch, state, now_token
             )
 
+        if new_snapshots is not None and not snapshot:
+            new_snapshots[room_id] = (
+                room_builder.rtype,
+                _RoomSnapshot(batch=batch, state=state, summary=summary),
+            )
+
         if room_builder.rtype == "joined":
             unread_notifications = {}  # type: Dict[str, int]
             room_sync = JoinedSyncResult(
@@ -1914,14 +2790,9 @@ class SyncHandler:
                 unread_count=0,
             )
 
+            # The unread counts are filled in by `_add_unread_counts` once all
+            # the room entries have been generated.
             if room_sync or always_include:
-                notifs = await self.unread_notifs_for_room_id(room_id, sync_config)
-
-                unread_notifications["notification_count"] = notifs["notify_count"]
-                unread_notifications["highlight_count"] = notifs["highlight_count"]
-
-                room_sync.unread_count = notifs["unread_count"]
-
                 sync_result_builder.joined.append(room_sync)
 
             if batch.limited and since_token:
@@ -1942,6 +2813,35 @@ class SyncHandler:
         else:
             raise Exception("Unrecognized rtype: %r", room_builder.rtype)
 
+    def _add_snapshot_members_to_lazy_loaded_cache(
+        self, sync_config: SyncConfig, room_id: str, snapshot: _RoomSnapshot
+    ) -> None:
+        """Record the members sent down in a room entry taken from a sync
+        snapshot in the lazy-loaded members cache, as `compute_state_delta` and
+        `compute_summary` would have done when calculating the entry.
+        """
+        if not sync_config.filter_collection.lazy_load_members():
+            return
+        if sync_config.filter_collection.include_redundant_members():
+            return
+
+        cache_key = (sync_config.user.to_string(), sync_config.device_id)
+        cache = self.get_lazy_loaded_members_cache(cache_key)
+
+        # This is always a new sync sequence, so the client doesn't know about
+        # any members yet.
+        cache.clear()
+
+        sent_member_event_ids = []
+        for event in itertools.chain(snapshot.state.values(), snapshot.batch.events):
+            if event.type == EventTypes.Member:
+                cache.set(event.state_key, event.event_id)
+                sent_member_event_ids.append(event.event_id)
+
+        self._record_lazy_loaded_members_sent(
+            sync_config, room_id, sent_member_event_ids, reset=True
+        )
+
     async def get_rooms_for_user_at(
         self, user_id: str, room_key: RoomStreamToken
     ) -> FrozenSet[str]:
@@ -1986,6 +2886,102 @@ class SyncHandler:
         return frozenset(joined_room_ids)
 
 
+def _get_room_key_cache_key(
+    token: Optional[RoomStreamToken],
+) -> Optional[Tuple[Any, ...]]:
+    """Get a hashable representation of a room stream token, for use in cache
+    keys.
+    """
+    if token is None:
+        return None
+    return (token.topological, token.stream, tuple(sorted(token.instance_map.items())))
+
+
+def _get_sync_type(since_token: Optional[StreamToken], full_state: bool) -> str:
+    """Get the type of a sync, as used to label metrics."""
+    if since_token is None:
+        return "initial_sync"
+    elif full_state:
+        return "full_state_sync"
+    else:
+        return "incremental_sync"
+
+
+def _add_slow_sync(
+    slow_syncs: List[SlowSync],
+    slow_sync: SlowSync,
+    profile: Optional[cProfile.Profile] = None,
+) -> List[SlowSync]:
+    """Add a sync to a list of the slowest recent syncs, if it is one of them.
+
+    Args:
+        slow_syncs: The slowest recent syncs, slowest first.
+        slow_sync: The details of the sync.
+        profile: The CPU profile of the sync, to add to its details if it is
+            added.
+
+    Returns:
+        The new list of the slowest recent syncs.
+    """
+    # Forget syncs which are no longer recent, and don't bother formatting the
+    # profile of this one if it's faster than all of the rest.
+    slow_syncs = [s for s in slow_syncs if s.ts > slow_sync.ts - SLOW_SYNC_WINDOW_MS]
+    if (
+        len(slow_syncs) >= MAX_SLOW_SYNCS
+        and slow_sync.duration <= slow_syncs[-1].duration
+    ):
+        return slow_syncs
+
+    if profile is not None:
+        slow_sync = attr.evolve(slow_sync, profile=_format_sync_profile(profile))
+
+    slow_syncs.append(slow_sync)
+    slow_syncs.sort(key=lambda s: s.duration, reverse=True)
+    del slow_syncs[MAX_SLOW_SYNCS:]
+    return slow_syncs
+
+
+def _format_sync_profile(profile: cProfile.Profile) -> str:
+    """Format the CPU profile of a sync, listing the functions which took the
+    most time (including the functions they called).
+    """
+    out = io.StringIO()
+    stats = pstats.Stats(profile, stream=out)
+    stats.sort_stats("cumulative").print_stats(SLOW_SYNC_PROFILE_LINES)
+    return out.getvalue()
+
+
+def _get_room_entry_concurrency(num_room_entries: int) -> int:
+    """Get the number of room entries to generate concurrently.
+
+    Generating a room entry mostly waits on the database and caches, so syncs
+    with lots of rooms benefit from more concurrency, but we cap it so that
+    one sync can't hog the database connection pool.
+    """
+    return min(
+        max(
+            MIN_ROOM_ENTRY_CONCURRENCY,
+            num_room_entries // ROOM_ENTRIES_PER_CONCURRENT_GENERATION,
+        ),
+        MAX_ROOM_ENTRY_CONCURRENCY,
+    )
+
+
+def _get_sync_snapshot_filter_key(
+    sync_config: SyncConfig, ignored_users: FrozenSet[str]
+) -> str:
+    """Get the key identifying the sync snapshot for an initial sync.
+
+    Room entries depend on the filter used and the users the user has ignored,
+    so a user has a separate snapshot for each combination.
+    """
+    key = {
+        "filter": sync_config.filter_collection.get_filter_json(),
+        "ignored_users": sorted(ignored_users),
+    }
+    return hashlib.sha256(encode_canonical_json(key)).hexdigest()
+
+
 def _action_has_highlight(actions: List[JsonDict]) -> bool:
     for action in actions:
         try:
@@ -2070,6 +3066,7 @@ class SyncResultBuilder:
         archived (list[ArchivedSyncResult])
         groups (GroupsSyncResult|None)
         to_device (list)
+        room_window (RoomWindowSyncResult|None)
     """
 
     sync_config = attr.ib(type=SyncConfig)
@@ -2085,6 +3082,7 @@ class SyncResultBuilder:
     archived = attr.ib(type=List[ArchivedSyncResult], default=attr.Factory(list))
     groups = attr.ib(type=Optional[GroupsSyncResult], default=None)
     to_device = attr.ib(type=List[JsonDict], default=attr.Factory(list))
+    room_window = attr.ib(type=Optional[RoomWindowSyncResult], default=None)
 
 
 @attr.s(slots=True)
@@ -45,7 +45,7 @@ from synapse.api.errors import (
 from synapse.http.site import SynapseRequest
 from synapse.logging.context import preserve_fn
 from synapse.logging.opentracing import trace_servlet
-from synapse.util import json_encoder
+from synapse.util import fast_encode_json, json_encoder
 from synapse.util.caches import intern_dict
 
 logger = logging.getLogger(__name__)
@@ -607,6 +607,13 @@ def respond_with_json(
         )
         return None
 
+    # If we have a fast JSON encoder available then encode the whole response
+    # in one go, falling back to the (much slower) iterative pure-python
+    # encoders otherwise.
+    json_bytes = fast_encode_json(json_object, canonical=canonical_json)
+    if json_bytes is not None:
+        return respond_with_json_bytes(request, code, json_bytes, send_cors)
+
     if canonical_json:
         encoder = iterencode_canonical_json
     else:
@@ -16,10 +16,10 @@
 import logging
 from collections import namedtuple
 from typing import (
+    TYPE_CHECKING,
     Awaitable,
     Callable,
     Dict,
-    Iterable,
     List,
     Optional,
     Set,
@@ -29,11 +29,10 @@ from typing import (
 )
 
 import attr
-from prometheus_client import Counter
+from prometheus_client import Counter, Histogram
 
 from twisted.internet import defer
 
-import synapse.server
 from synapse.api.constants import EventTypes, Membership
 from synapse.api.errors import AuthError
 from synapse.events import EventBase
@@ -51,8 +50,12 @@ from synapse.types import (
 )
 from synapse.util.async_helpers import ObservableDeferred, timeout_deferred
 from synapse.util.metrics import Measure
+from synapse.util.wheel_timer import WheelTimer
 from synapse.visibility import filter_events_for_client
 
+if TYPE_CHECKING:
+    from synapse.server import HomeServer
+
 logger = logging.getLogger(__name__)
 
 notified_events_counter = Counter("synapse_notifier_notified_events", "")
@@ -61,17 +64,33 @@ users_woken_by_stream_counter = Counter(
     "synapse_notifier_users_woken_by_stream", "", ["stream"]
 )
 
-T = TypeVar("T")
+# The number of user streams woken up together, either by a single update or
+# by a batch of coalesced updates.
+wakeup_herd_size = Histogram(
+    "synapse_notifier_wakeup_herd_size",
+    "Number of user streams woken up at once",
+    buckets=(1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 50000),
+)
+
+# How long coalesced wake-ups were held for before the first batch of user
+# streams was woken.
+coalesced_wakeup_delay = Histogram(
+    "synapse_notifier_coalesced_wakeup_delay_seconds",
+    "Time between a wake-up being coalesced and user streams being woken",
+)
+
+# The time between a user stream being woken up and the waiting request (e.g.
+# /sync) having its response.
+wake_to_response_time = Histogram(
+    "synapse_notifier_wake_to_response_seconds",
+    "Time between a user stream being woken and the response being ready",
+)
 
+T = TypeVar("T")
 
-# TODO(paul): Should be shared somewhere
-def count(func: Callable[[T], bool], it: Iterable[T]) -> int:
-    """Return the number of items in it for which func returns true."""
-    n = 0
-    for x in it:
-        if func(x):
-            n += 1
-    return n
+# An update to notify a user stream of: the stream which has updated, and its
+# new position.
+_StreamUpdate = Tuple[str, Union[int, RoomStreamToken]]
 
 
 class _NotificationListener:
@@ -133,20 +152,44 @@ class _NotifierUserStream:
         self.last_notified_ms = time_now_ms
         noify_deferred = self.notify_deferred
 
-        users_woken_by_stream_counter.labels(stream_key).inc()
+        # If nobody is listening then there is nothing to wake up, and new
+        # listeners will see that `last_notified_token` has changed.
+        if not noify_deferred.observers():
+            return
 
         with PreserveLoggingContext():
             self.notify_deferred = ObservableDeferred(defer.Deferred())
             noify_deferred.callback(self.current_token)
 
+    def notify_all(
+        self, updates: List[_StreamUpdate], time_now_ms: int,
+    ):
+        """Notify any listeners for this user of several new events at once.
+
+        Args:
+            updates: The streams the events came from, and the new ids for
+                those streams.
+            time_now_ms: The current time in milliseconds.
+        """
+        for stream_key, stream_id in updates[:-1]:
+            self.current_token = self.current_token.copy_and_advance(
+                stream_key, stream_id
+            )
+
+        stream_key, stream_id = updates[-1]
+        self.notify(stream_key, stream_id, time_now_ms)
+
     def remove(self, notifier: "Notifier"):
         """ Remove this listener from all the indexes in the Notifier
         it knows about.
         """
 
         for room in self.rooms:
-            lst = notifier.room_to_user_streams.get(room, set())
-            lst.discard(self)
+            room_streams = notifier.room_to_user_streams.get(room)
+            if room_streams is not None:
+                room_streams.discard(self)
+                if not room_streams:
+                    del notifier.room_to_user_streams[room]
 
         notifier.user_to_user_stream.pop(self.user_id)
 
@@ -194,10 +237,20 @@ class Notifier:
 
     UNUSED_STREAM_EXPIRY_MS = 10 * 60 * 1000
 
-    def __init__(self, hs: "synapse.server.HomeServer"):
+    # How often to check for expired user streams. This is also the accuracy
+    # of the expiry.
+    STREAM_EXPIRY_CHECK_INTERVAL_MS = 10 * 1000
+
+    def __init__(self, hs: "HomeServer"):
         self.user_to_user_stream = {}  # type: Dict[str, _NotifierUserStream]
         self.room_to_user_streams = {}  # type: Dict[str, Set[_NotifierUserStream]]
 
+        # The user streams, by when they should next be checked for expiry,
+        # so that we don't have to check every stream each time.
+        self._user_stream_expiry_wheel = WheelTimer(
+            bucket_size=self.STREAM_EXPIRY_CHECK_INTERVAL_MS
+        )
+
         self.hs = hs
         self.storage = hs.get_storage()
         self.event_sources = hs.get_event_sources()
@@ -221,30 +274,43 @@ class Notifier:
 
         self.state_handler = hs.get_state_handler()
 
+        self._coalescing_enabled = hs.config.notifier_coalescing_enabled
+        self._coalescing_min_streams = hs.config.notifier_coalescing_min_streams
+        self._coalescing_window_ms = hs.config.notifier_coalescing_window_ms
+        self._coalescing_batch_size = hs.config.notifier_coalescing_batch_size
+        self._coalescing_batch_interval_ms = (
+            hs.config.notifier_coalescing_batch_interval_ms
+        )
+
+        # The user streams whose wake-ups are being coalesced, along with the
+        # updates to notify them of, and when the first of them was coalesced.
+        self._coalesced_wakeups = (
+            {}
+        )  # type: Dict[_NotifierUserStream, List[_StreamUpdate]]
+        self._coalesced_wakeups_since_ms = 0
+        self._coalesced_wakeups_call = None
+
         self.clock.looping_call(
-            self.remove_expired_streams, self.UNUSED_STREAM_EXPIRY_MS
+            self.remove_expired_streams, self.STREAM_EXPIRY_CHECK_INTERVAL_MS
         )
 
         # This is not a very cheap test to perform, but it's only executed
         # when rendering the metrics page, which is likely once per minute at
         # most when scraping it.
         def count_listeners():
-            all_user_streams = set()  # type: Set[_NotifierUserStream]
-
-            for streams in list(self.room_to_user_streams.values()):
-                all_user_streams |= streams
-            for stream in list(self.user_to_user_stream.values()):
-                all_user_streams.add(stream)
-
-            return sum(stream.count_listeners() for stream in all_user_streams)
+            # Every user stream is in `user_to_user_stream`, so we don't need
+            # to look at the room streams.
+            return sum(
+                stream.count_listeners()
+                for stream in list(self.user_to_user_stream.values())
+            )
 
         LaterGauge("synapse_notifier_listeners", "", [], count_listeners)
 
+        # Rooms are removed from `room_to_user_streams` once they have no user
+        # streams.
         LaterGauge(
-            "synapse_notifier_rooms",
-            "",
-            [],
-            lambda: count(bool, list(self.room_to_user_streams.values())),
+            "synapse_notifier_rooms", "", [], lambda: len(self.room_to_user_streams)
         )
         LaterGauge(
             "synapse_notifier_users", "", [], lambda: len(self.user_to_user_stream)
@@ -408,12 +474,26 @@ class Notifier:
                 for room in rooms:
                     user_streams |= self.room_to_user_streams.get(room, set())
 
-                time_now_ms = self.clock.time_msec()
-                for user_stream in user_streams:
-                    try:
-                        user_stream.notify(stream_key, new_token, time_now_ms)
-                    except Exception:
-                        logger.exception("Failed to notify listener")
+                if (
+                    self._coalescing_enabled
+                    and len(user_streams) >= self._coalescing_min_streams
+                ):
+                    self._coalesce_wakeups(user_streams, stream_key, new_token)
+                elif user_streams:
+                    wakeup_herd_size.observe(len(user_streams))
+                    users_woken_by_stream_counter.labels(stream_key).inc(
+                        len(user_streams)
+                    )
+
+                    # We're in the Measure logcontext here, so switch back to
+                    # the sentinel context once, rather than for each stream.
+                    with PreserveLoggingContext():
+                        time_now_ms = self.clock.time_msec()
+                        for user_stream in user_streams:
+                            try:
+                                user_stream.notify(stream_key, new_token, time_now_ms)
+                            except Exception:
+                                logger.exception("Failed to notify listener")
 
                 self.notify_replication()
 
@@ -422,6 +502,66 @@ class Notifier:
                     stream_key, new_token, users,
                 )
 
+    def _coalesce_wakeups(
+        self,
+        user_streams: Collection[_NotifierUserStream],
+        stream_key: str,
+        new_token: Union[int, RoomStreamToken],
+    ):
+        """Queue up waking the given user streams, so that the wake-ups are
+        batched with any others in the coalescing window.
+        """
+        users_woken_by_stream_counter.labels(stream_key).inc(len(user_streams))
+
+        for user_stream in user_streams:
+            self._coalesced_wakeups.setdefault(user_stream, []).append(
+                (stream_key, new_token)
+            )
+
+        if self._coalesced_wakeups_call is None:
+            self._coalesced_wakeups_since_ms = self.clock.time_msec()
+            self._coalesced_wakeups_call = self.clock.call_later(
+                self._coalescing_window_ms / 1000.0, self._wake_coalesced_user_streams
+            )
+
+    def _wake_coalesced_user_streams(self):
+        """Wake up the user streams whose wake-ups have been coalesced, in
+        batches.
+        """
+        self._coalesced_wakeups_call = None
+        pending = list(self._coalesced_wakeups.items())
+        self._coalesced_wakeups = {}
+
+        coalesced_wakeup_delay.observe(
+            (self.clock.time_msec() - self._coalesced_wakeups_since_ms) / 1000.0
+        )
+        wakeup_herd_size.observe(len(pending))
+
+        self._wake_user_stream_batch(pending)
+
+    def _wake_user_stream_batch(
+        self, pending: List[Tuple[_NotifierUserStream, List[_StreamUpdate]]],
+    ):
+        """Wake up the next batch of the given user streams, and schedule
+        waking the rest.
+        """
+        batch = pending[: self._coalescing_batch_size]
+        rest = pending[self._coalescing_batch_size :]
+
+        time_now_ms = self.clock.time_msec()
+        for user_stream, updates in batch:
+            try:
+                user_stream.notify_all(updates, time_now_ms)
+            except Exception:
+                logger.exception("Failed to notify listener")
+
+        if rest:
+            self.clock.call_later(
+                self._coalescing_batch_interval_ms / 1000.0,
+                self._wake_user_stream_batch,
+                rest,
+            )
+
     def on_new_replication_data(self) -> None:
         """Used to inform replication listeners that something has happened
         without waking up any of the normal user event streams"""
@@ -473,10 +613,16 @@ class Notifier:
                     with PreserveLoggingContext():
                         await listener.deferred
 
+                    # If something had already happened before we started
+                    # waiting then we were woken up immediately.
+                    woken_ms = max(user_stream.last_notified_ms, now)
                     current_token = user_stream.current_token
 
                     result = await callback(prev_token, current_token)
                     if result:
+                        wake_to_response_time.observe(
+                            (self.clock.time_msec() - woken_ms) / 1000.0
+                        )
                         break
 
                     # Update the prev_token to the current_token since nothing
@@ -617,21 +763,49 @@ class Notifier:
 
     @log_function
     def remove_expired_streams(self) -> None:
+        """Remove the user streams which have no listeners and haven't been
+        notified for `UNUSED_STREAM_EXPIRY_MS`.
+
+        Only the streams which are due to expire are checked. Those which have
+        been used since they were scheduled are rescheduled.
+        """
         time_now_ms = self.clock.time_msec()
-        expired_streams = []
         expire_before_ts = time_now_ms - self.UNUSED_STREAM_EXPIRY_MS
-        for stream in self.user_to_user_stream.values():
-            if stream.count_listeners():
+
+        for stream in self._user_stream_expiry_wheel.fetch(time_now_ms):
+            if self.user_to_user_stream.get(stream.user_id) is not stream:
+                # The stream has already been removed.
                 continue
-            if stream.last_notified_ms < expire_before_ts:
-                expired_streams.append(stream)
 
-        for expired_stream in expired_streams:
-            expired_stream.remove(self)
+            if stream.count_listeners():
+                # Check again once it could have expired, if the listeners go
+                # away now.
+                self._schedule_user_stream_expiry(
+                    stream, time_now_ms + self.UNUSED_STREAM_EXPIRY_MS
+                )
+            elif stream.last_notified_ms < expire_before_ts:
+                stream.remove(self)
+            else:
+                self._schedule_user_stream_expiry(
+                    stream, stream.last_notified_ms + self.UNUSED_STREAM_EXPIRY_MS
+                )
+
+    def _schedule_user_stream_expiry(
+        self, user_stream: _NotifierUserStream, expiry_ms: int
+    ):
+        """Schedule checking whether the user stream has expired, after the
+        given time.
+        """
+        self._user_stream_expiry_wheel.insert(
+            self.clock.time_msec(), user_stream, expiry_ms
+        )
 
     @log_function
     def _register_with_keys(self, user_stream: _NotifierUserStream):
         self.user_to_user_stream[user_stream.user_id] = user_stream
+        self._schedule_user_stream_expiry(
+            user_stream, user_stream.last_notified_ms + self.UNUSED_STREAM_EXPIRY_MS
+        )
 
         for room in user_stream.rooms:
             s = self.room_to_user_streams.setdefault(room, set())
@@ -110,6 +110,9 @@ CONDITIONAL_REQUIREMENTS = {
     # hiredis is not a *strict* dependency, but it makes things much faster.
     # (if it is not installed, we fall back to slow code.)
     "redis": ["txredisapi>=1.4.7", "hiredis"],
+    # orjson is used to encode JSON responses, if installed, as it is much faster
+    # than the standard library encoder.
+    "orjson": ["orjson>=3.0.0;python_version>='3.6'"],
 }
 
 CONDITIONAL_REQUIREMENTS["mypy"] = ["mypy==0.790", "mypy-zope==0.2.8"]
@@ -15,6 +15,7 @@
 
 import itertools
 import logging
+from typing import Optional, Tuple
 
 from synapse.api.constants import PresenceState
 from synapse.api.errors import Codes, StoreError, SynapseError
@@ -25,14 +26,19 @@ from synapse.events.utils import (
 )
 from synapse.handlers.presence import format_user_presence_state
 from synapse.handlers.sync import SyncConfig
+from synapse.http.server import respond_with_json_bytes
 from synapse.http.servlet import RestServlet, parse_boolean, parse_integer, parse_string
 from synapse.types import StreamToken
-from synapse.util import json_decoder
+from synapse.util import fast_encode_json, json_decoder, json_encoder
+from synapse.util.caches.lrucache import LruCache
 
 from ._base import client_patterns, set_timeline_upper_limit
 
 logger = logging.getLogger(__name__)
 
+# The maximum number of rooms in the window of a room window sync.
+MAX_ROOM_WINDOW_LIMIT = 100
+
 
 class SyncRestServlet(RestServlet):
     """
@@ -85,6 +91,21 @@ class SyncRestServlet(RestServlet):
         self._server_notices_sender = hs.get_server_notices_sender()
         self._event_serializer = hs.get_event_client_serializer()
 
+        # The encoded responses to recent requests, so that clients retrying a
+        # request can be answered without recalculating and re-encoding it.
+        # Entries are (time added in ms, response bytes). The size of the cache
+        # is the total length of the responses, which the LruCache keeps a
+        # running count of. Entries are expired when they are read.
+        self._response_bytes_cache = None  # type: Optional[LruCache]
+        self._response_bytes_cache_expiry_ms = hs.config.sync_response_cache_expiry_ms
+        if hs.config.sync_response_cache_enabled:
+            self._response_bytes_cache = LruCache(
+                max_size=hs.config.sync_response_cache_max_size,
+                cache_name="sync_response_bytes",
+                size_callback=lambda entry: len(entry[1]),
+                apply_cache_factor_from_config=False,
+            )
+
     async def on_GET(self, request):
         if b"from" in request.args:
             # /events used to use 'from', but /sync uses 'since'.
@@ -107,6 +128,7 @@ class SyncRestServlet(RestServlet):
         )
         filter_id = parse_string(request, "filter", default=None)
         full_state = parse_boolean(request, "full_state", default=False)
+        room_window = self.parse_room_window(request)
 
         logger.debug(
             "/sync: user=%r, timeout=%r, since=%r, "
@@ -119,7 +141,15 @@ class SyncRestServlet(RestServlet):
             device_id,
         )
 
-        request_key = (user, timeout, since, filter_id, full_state, device_id)
+        request_key = (
+            user,
+            timeout,
+            since,
+            filter_id,
+            full_state,
+            device_id,
+            room_window,
+        )
 
         if filter_id is None:
             filter_collection = DEFAULT_FILTER_COLLECTION
@@ -150,6 +180,7 @@ class SyncRestServlet(RestServlet):
             is_guest=requester.is_guest,
             request_key=request_key,
             device_id=device_id,
+            room_window=room_window,
         )
 
         since_token = None
@@ -166,10 +197,28 @@ class SyncRestServlet(RestServlet):
                 user, {"presence": set_presence}, True
             )
 
+        # The response depends on the access token, as the transaction IDs of
+        # events are only included for the token which sent them.
+        response_cache_key = (
+            user.to_string(),
+            device_id,
+            requester.access_token_id,
+            since,
+            filter_id,
+            full_state,
+            room_window,
+        )
         context = await self.presence_handler.user_syncing(
             user.to_string(), affect_presence=affect_presence
         )
         with context:
+            # A retried request still counts as the user syncing for presence.
+            response_bytes = self._get_cached_response_bytes(response_cache_key)
+            if response_bytes is not None:
+                logger.debug("Returning cached sync response")
+                respond_with_json_bytes(request, 200, response_bytes, send_cors=True)
+                return None
+
             sync_result = await self.sync_handler.wait_for_sync_for_user(
                 requester,
                 sync_config,
@@ -185,13 +234,59 @@ class SyncRestServlet(RestServlet):
             return 200, {}
 
         time_now = self.clock.time_msec()
+        encode_start = self.clock.time()
         response_content = await self.encode_response(
             time_now, sync_result, requester.access_token_id, filter_collection
         )
 
         logger.debug("Event formatting complete")
+
+        if sync_result.timings is not None:
+            self.sync_handler.record_sync_timings(
+                sync_config, sync_result.timings, self.clock.time() - encode_start
+            )
+
+        # Empty responses are cheap to recalculate, and the client will want to
+        # wait for new events if it retries the request.
+        if self._response_bytes_cache is not None and sync_result:
+            response_bytes = fast_encode_json(response_content)
+            if response_bytes is None:
+                response_bytes = json_encoder.encode(response_content).encode("utf-8")
+            self._response_bytes_cache[response_cache_key] = (
+                self.clock.time_msec(),
+                response_bytes,
+            )
+            respond_with_json_bytes(request, 200, response_bytes, send_cors=True)
+            return None
+
         return 200, response_content
 
+    def _get_cached_response_bytes(self, key: Tuple) -> Optional[bytes]:
+        """Get the encoded response to a recent sync request, if it is cached
+        and hasn't expired.
+        """
+        if self._response_bytes_cache is None:
+            return None
+
+        cached = self._response_bytes_cache.get(key)
+        if cached is None:
+            return None
+
+        added_ms, response_bytes = cached
+        if self.clock.time_msec() - added_ms >= self._response_bytes_cache_expiry_ms:
+            self._response_bytes_cache.pop(key)
+            return None
+
+        return response_bytes
+
+    def parse_room_window(self, request) -> Optional[Tuple[int, int]]:
+        """Parse the window of joined rooms to restrict the sync to, if any.
+
+        Returns:
+            The offset and limit of the window, or None to sync all rooms.
+        """
+        return None
+
     async def encode_response(self, time_now, sync_result, access_token_id, filter):
         logger.debug("Formatting events in sync response")
         if filter.event_format == "client":
@@ -222,7 +317,7 @@ class SyncRestServlet(RestServlet):
         )
 
         logger.debug("building sync response dict")
-        return {
+        response = {
             "account_data": {"events": sync_result.account_data},
             "to_device": {"events": sync_result.to_device},
             "device_lists": {
@@ -241,6 +336,15 @@ class SyncRestServlet(RestServlet):
             "next_batch": await sync_result.next_batch.to_string(self.store),
         }
 
+        if sync_result.room_window is not None:
+            response["org.matrix.room_window"] = {
+                "rooms": sync_result.room_window.room_ids,
+                "count": sync_result.room_window.count,
+                "changed": sync_result.room_window.changed,
+            }
+
+        return response
+
     @staticmethod
     def encode_presence(events, time_now):
         return {
@@ -432,5 +536,52 @@ class SyncRestServlet(RestServlet):
         return result
 
 
+class RoomWindowSyncRestServlet(SyncRestServlet):
+    """A variant of /sync which only includes a window of the user's joined
+    rooms, ordered by the most recent event in each room.
+
+    Takes the same GET parameters as /sync, plus::
+        room_offset(int): The position of the start of the window. Defaults
+            to 0.
+        room_limit(int): The number of rooms in the window. Defaults to 20.
+
+    The response is the same as for /sync, except that `rooms.join` only
+    includes rooms in the window, plus::
+        "org.matrix.room_window": {
+          "rooms": [], // IDs of the rooms in the window, most recent first.
+          "count": // The total number of joined rooms.
+          "changed": [] // IDs of rooms outside the window which have changed
+                        // since `since`.
+        }
+
+    Incremental syncs only include entries for rooms in the window which have
+    changed, so clients should make a sync without `since` to get the full
+    entries of rooms which they have not seen before (for example, after
+    moving the window).
+    """
+
+    PATTERNS = client_patterns(
+        "/org.matrix.room_window/sync$", releases=(),  # This is an unstable feature
+    )
+
+    def parse_room_window(self, request) -> Optional[Tuple[int, int]]:
+        room_offset = parse_integer(request, "room_offset", default=0)
+        room_limit = parse_integer(request, "room_limit", default=20)
+
+        if room_offset < 0:
+            raise SynapseError(
+                400, "room_offset must not be negative", errcode=Codes.INVALID_PARAM
+            )
+        if not 0 < room_limit <= MAX_ROOM_WINDOW_LIMIT:
+            raise SynapseError(
+                400,
+                "room_limit must be between 1 and %d" % (MAX_ROOM_WINDOW_LIMIT,),
+                errcode=Codes.INVALID_PARAM,
+            )
+
+        return room_offset, room_limit
+
+
 def register_servlets(hs, http_server):
     SyncRestServlet(hs).register(http_server)
+    RoomWindowSyncRestServlet(hs).register(http_server)
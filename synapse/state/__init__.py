@@ -15,13 +15,18 @@
 # limitations under the License.
 import heapq
 import logging
+import os.path
+import re
 from collections import defaultdict, namedtuple
 from typing import (
     Any,
     Awaitable,
     Callable,
+    ContextManager,
     DefaultDict,
     Dict,
+    FrozenSet,
+    Hashable,
     Iterable,
     List,
     Optional,
@@ -41,15 +46,24 @@ from synapse.api.constants import EventTypes
 from synapse.api.room_versions import KNOWN_ROOM_VERSIONS, StateResolutionVersions
 from synapse.events import EventBase
 from synapse.events.snapshot import EventContext
-from synapse.logging.context import ContextResourceUsage
+from synapse.logging.context import ContextResourceUsage, defer_to_thread
 from synapse.logging.utils import log_function
+from synapse.metrics import LaterGauge
+from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.state import v1, v2
+from synapse.state.dump import RecordingStateResolutionStore
+from synapse.state.process_pool import (
+    PROCESS_POOL_SUPPORTED,
+    StateResolutionProcessPool,
+)
 from synapse.storage.databases.main.events_worker import EventRedactBehaviour
 from synapse.storage.roommember import ProfileInfo
 from synapse.types import Collection, StateMap
+from synapse.util import json_encoder
 from synapse.util.async_helpers import Linearizer
 from synapse.util.caches.expiringcache import ExpiringCache
 from synapse.util.metrics import Measure, measure_func
+from synapse.util.state_map import FrozenStateMap, copy_state_map
 
 logger = logging.getLogger(__name__)
 metrics_logger = logging.getLogger("synapse.state.metrics")
@@ -62,11 +76,63 @@ state_groups_histogram = Histogram(
 )
 
 
+# Metrics for the state resolution results stored in the database.
+state_res_db_cache_hits = Counter(
+    "synapse_state_res_db_cache_hits",
+    "Number of state resolutions which were served from the database",
+)
+
+state_res_db_cache_misses = Counter(
+    "synapse_state_res_db_cache_misses",
+    "Number of state resolutions which were not found in the database",
+)
+
+
+# Metrics for time spent waiting for the state resolution locks.
+state_res_lock_wait_histogram = Histogram(
+    "synapse_state_res_lock_wait_seconds",
+    "Time spent waiting to acquire the locks guarding a state resolution",
+    ["lock"],
+)
+
+
+# Metrics for the cost of each state resolution.
+_state_res_cost_buckets = (0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, "+Inf")
+
+state_res_cpu_histogram = Histogram(
+    "synapse_state_res_cpu_seconds",
+    "CPU time spent performing each state resolution",
+    buckets=_state_res_cost_buckets,
+)
+
+state_res_db_histogram = Histogram(
+    "synapse_state_res_db_seconds",
+    "Database time spent performing each state resolution",
+    buckets=_state_res_cost_buckets,
+)
+
+
 KeyStateTuple = namedtuple("KeyStateTuple", ("context", "type", "state_key"))
 
 
 EVICTION_TIMEOUT_SECONDS = 60 * 60
 
+# The maximum number of state resolutions we will run at once, across all rooms.
+MAX_CONCURRENT_STATE_RESOLUTIONS = 10
+
+# The number of rooms for which we report the time spent on state resolution
+# during each reporting period.
+STATE_RES_TOP_ROOMS = 10
+
+# The minimum time a state resolution must take for its result to be stored in
+# the database for other workers to reuse. Cheaper resolutions are quicker to
+# redo than the write is worth.
+MIN_STORED_STATE_RESOLUTION_MS = 100
+
+# The number of slow state resolutions we remember, and for how long.
+MAX_SLOW_STATE_RESOLUTIONS = 50
+SLOW_STATE_RESOLUTION_WINDOW_MS = 60 * 60 * 1000
+
 
 _NEXT_STATE_ID = 1
 
@@ -91,7 +157,9 @@ class _StateCacheEntry:
         delta_ids: Optional[StateMap[str]] = None,
     ):
         # A map from (type, state_key) to event_id.
-        self.state = frozendict(state)
+        self.state = (
+            state if isinstance(state, FrozenStateMap) else FrozenStateMap(state)
+        )
 
         # the ID of a state group if one and only one is involved.
         # otherwise, None otherwise?
@@ -251,7 +319,10 @@ class StateHandler:
         return await self.store.get_joined_hosts(room_id, entry)
 
     async def compute_event_context(
-        self, event: EventBase, old_state: Optional[Iterable[EventBase]] = None
+        self,
+        event: EventBase,
+        old_state: Optional[Iterable[EventBase]] = None,
+        prev_state_groups: Optional[Dict[int, StateMap[str]]] = None,
     ) -> EventContext:
         """Build an EventContext structure for the event.
 
@@ -264,6 +335,10 @@ class StateHandler:
                 calculated from existing events. This is normally only specified
                 when receiving an event from federation where we don't have the
                 prev events for, e.g. when backfilling.
+            prev_state_groups: The state groups after each of the event's prev
+                events, and their state, if the caller already knows them
+                (e.g. because it has just computed them). Saves fetching them
+                from the database.
         Returns:
             The event context.
         """
@@ -316,7 +391,7 @@ class StateHandler:
             logger.debug("calling resolve_state_groups from compute_event_context")
 
             entry = await self.resolve_state_groups_for_events(
-                event.room_id, event.prev_event_ids()
+                event.room_id, event.prev_event_ids(), prev_state_groups
             )
 
             state_ids_before_event = entry.state
@@ -368,7 +443,7 @@ class StateHandler:
             if replaces != event.event_id:
                 event.unsigned["replaces_state"] = replaces
 
-        state_ids_after_event = dict(state_ids_before_event)
+        state_ids_after_event = copy_state_map(state_ids_before_event)
         state_ids_after_event[key] = event.event_id
         delta_ids = {key: event.event_id}
 
@@ -391,7 +466,10 @@ class StateHandler:
 
     @measure_func()
     async def resolve_state_groups_for_events(
-        self, room_id: str, event_ids: Iterable[str]
+        self,
+        room_id: str,
+        event_ids: Iterable[str],
+        state_groups_ids: Optional[Dict[int, StateMap[str]]] = None,
     ) -> _StateCacheEntry:
         """ Given a list of event_ids this method fetches the state at each
         event, resolves conflicts between them and returns them.
@@ -399,18 +477,21 @@ class StateHandler:
         Args:
             room_id
             event_ids
+            state_groups_ids: The state groups at the events, and their state,
+                if already known.
 
         Returns:
             The resolved state
         """
         logger.debug("resolve_state_groups event_ids %s", event_ids)
 
-        # map from state group id to the state in that state group (where
-        # 'state' is a map from state key to event id)
-        # dict[int, dict[(str, str), str]]
-        state_groups_ids = await self.state_store.get_state_groups_ids(
-            room_id, event_ids
-        )
+        if state_groups_ids is None:
+            # map from state group id to the state in that state group (where
+            # 'state' is a map from state key to event id)
+            # dict[int, dict[(str, str), str]]
+            state_groups_ids = await self.state_store.get_state_groups_ids(
+                room_id, event_ids
+            )
 
         if len(state_groups_ids) == 0:
             return _StateCacheEntry(state={}, state_group=None)
@@ -478,6 +559,32 @@ class _StateResMetrics:
     db_events = attr.ib(type=int, default=0)
 
 
+@attr.s(slots=True, frozen=True)
+class SlowStateResolution:
+    """Details of a state resolution, as returned by the admin API."""
+
+    room_id = attr.ib(type=str)
+    room_version = attr.ib(type=str)
+
+    # when the resolution finished, in milliseconds since the epoch
+    ts = attr.ib(type=int)
+
+    # the wall clock, CPU and database time taken by the resolution, in seconds
+    duration = attr.ib(type=float)
+    cpu_time = attr.ib(type=float)
+    db_time = attr.ib(type=float)
+
+    # the number of events fetched from the database
+    db_events = attr.ib(type=int)
+
+    # the number of state sets resolved, the number of (type, state_key)
+    # pairs they disagreed on, and the number of events involved in that
+    # disagreement.
+    state_sets = attr.ib(type=int)
+    conflicted_state_keys = attr.ib(type=int)
+    conflicted_events = attr.ib(type=int)
+
+
 _biggest_room_by_cpu_counter = Counter(
     "synapse_state_res_cpu_for_biggest_room_seconds",
     "CPU time spent performing state resolution for the single most expensive "
@@ -500,7 +607,38 @@ class StateResolutionHandler:
     def __init__(self, hs):
         self.clock = hs.get_clock()
 
-        self.resolve_linearizer = Linearizer(name="state_resolve_lock")
+        # ensures that we only do one resolution for a given set of state groups
+        # at a time, so that concurrent requests can share the cached result.
+        self.resolve_linearizer = Linearizer(
+            name="state_resolve_lock", clock=self.clock
+        )
+
+        # ensures that an expensive room can only tie up one of the slots of
+        # `_resolve_limiter` at a time, rather than blocking unrelated rooms.
+        self._room_resolve_linearizer = Linearizer(
+            name="state_resolve_room_lock", clock=self.clock
+        )
+
+        # bounds the number of resolutions which may run concurrently.
+        self._resolve_limiter = Linearizer(
+            name="state_resolve_limiter",
+            max_count=MAX_CONCURRENT_STATE_RESOLUTIONS,
+            clock=self.clock,
+        )
+
+        # pool of processes to run v2 state resolution for large rooms in, if
+        # enabled.
+        self._process_pool = None  # type: Optional[StateResolutionProcessPool]
+        if hs.config.state_resolution_processes:
+            if PROCESS_POOL_SUPPORTED:
+                self._process_pool = StateResolutionProcessPool(
+                    hs.get_reactor(), hs.config.state_resolution_processes
+                )
+            else:
+                logger.warning(
+                    "state_resolution_processes requires Python 3.7 or later: "
+                    "resolving state in-process"
+                )
 
         # dict of set of event_ids -> _StateCacheEntry.
         self._state_cache = ExpiringCache(
@@ -521,8 +659,36 @@ class StateResolutionHandler:
             _StateResMetrics
         )  # type: DefaultDict[str, _StateResMetrics]
 
+        # the rooms which used the most CPU and DB time on state res in the last
+        # reporting period, for the gauges below.
+        self._top_rooms_by_cpu = {}  # type: Dict[Tuple[str], float]
+        self._top_rooms_by_db = {}  # type: Dict[Tuple[str], float]
+
+        LaterGauge(
+            "synapse_state_res_top_rooms_cpu_seconds",
+            "CPU time spent on state resolution in the last reporting period, "
+            "for the rooms which used the most",
+            ["room_id"],
+            lambda: self._top_rooms_by_cpu,
+        )
+        LaterGauge(
+            "synapse_state_res_top_rooms_db_seconds",
+            "Database time spent on state resolution in the last reporting period, "
+            "for the rooms which used the most",
+            ["room_id"],
+            lambda: self._top_rooms_by_db,
+        )
+
         self.clock.looping_call(self._report_metrics, 120 * 1000)
 
+        # the slowest recent state resolutions, for the admin API.
+        self._slow_resolutions = []  # type: List[SlowStateResolution]
+
+        # where to dump the inputs of slow state resolutions, if anywhere.
+        self.hs = hs
+        self._dump_directory = hs.config.state_resolution_dump_directory
+        self._dump_threshold_ms = hs.config.state_resolution_dump_threshold_ms
+
     @log_function
     async def resolve_state_groups(
         self,
@@ -559,24 +725,40 @@ class StateResolutionHandler:
         """
         group_names = frozenset(state_groups_ids.keys())
 
-        with (await self.resolve_linearizer.queue(group_names)):
+        with (await self._queue(self.resolve_linearizer, group_names, "group")):
             cache = self._state_cache.get(group_names, None)
             if cache:
                 return cache
 
-            logger.info(
-                "Resolving state for %s with groups %s", room_id, list(group_names),
+            # another worker (or an earlier process) may already have done
+            # this resolution.
+            new_state = await self._get_stored_resolution(
+                group_names, state_groups_ids, state_res_store
             )
 
-            state_groups_histogram.observe(len(state_groups_ids))
-
-            new_state = await self.resolve_events_with_store(
-                room_id,
-                room_version,
-                list(state_groups_ids.values()),
-                event_map=event_map,
-                state_res_store=state_res_store,
-            )
+            if new_state is None:
+                with (
+                    await self._queue(self._room_resolve_linearizer, room_id, "room")
+                ):
+                    with (await self._queue(self._resolve_limiter, None, "global")):
+                        start_ms = self.clock.time_msec()
+                        new_state = await self._resolve_state_groups_locked(
+                            room_id,
+                            room_version,
+                            state_groups_ids,
+                            event_map,
+                            state_res_store,
+                        )
+                        duration_ms = self.clock.time_msec() - start_ms
+
+                if duration_ms >= MIN_STORED_STATE_RESOLUTION_MS:
+                    await self._store_resolution(
+                        room_id,
+                        group_names,
+                        new_state,
+                        state_groups_ids,
+                        state_res_store,
+                    )
 
             # if the new state matches any of the input state groups, we can
             # use that state group again. Otherwise we will generate a state_id
@@ -590,6 +772,118 @@ class StateResolutionHandler:
 
             return cache
 
+    async def _get_stored_resolution(
+        self,
+        group_names: FrozenSet[int],
+        state_groups_ids: Dict[int, StateMap[str]],
+        state_res_store: "StateResolutionStore",
+    ) -> Optional[StateMap[str]]:
+        """Look up the result of resolving the given state groups in the database.
+
+        Returns:
+            The resolved state, or None if we don't have a stored result.
+        """
+        result = await state_res_store.get_state_resolution_result(group_names)
+        if result is None:
+            state_res_db_cache_misses.inc()
+            return None
+
+        prev_group, delta_ids = result
+        if prev_group not in state_groups_ids:
+            # This shouldn't happen, as the result is keyed on the groups.
+            logger.warning(
+                "Ignoring stored state resolution for %s based on unknown group %s",
+                list(group_names),
+                prev_group,
+            )
+            state_res_db_cache_misses.inc()
+            return None
+
+        state_res_db_cache_hits.inc()
+
+        new_state = dict(state_groups_ids[prev_group])
+        for key, event_id in delta_ids.items():
+            if event_id is None:
+                new_state.pop(key, None)
+            else:
+                new_state[key] = event_id
+
+        return new_state
+
+    async def _store_resolution(
+        self,
+        room_id: str,
+        group_names: FrozenSet[int],
+        new_state: StateMap[str],
+        state_groups_ids: Dict[int, StateMap[str]],
+        state_res_store: "StateResolutionStore",
+    ) -> None:
+        """Store the result of resolving the given state groups in the database,
+        as a delta against the closest of the input state groups.
+        """
+        prev_group = None
+        delta_ids = None  # type: Optional[Dict[Tuple[str, str], Optional[str]]]
+
+        for group, state in state_groups_ids.items():
+            n_delta_ids = {
+                k: v for k, v in new_state.items() if state.get(k) != v
+            }  # type: Dict[Tuple[str, str], Optional[str]]
+            n_delta_ids.update((k, None) for k in state if k not in new_state)
+
+            if delta_ids is None or len(n_delta_ids) < len(delta_ids):
+                prev_group = group
+                delta_ids = n_delta_ids
+
+        assert prev_group is not None and delta_ids is not None
+
+        await state_res_store.store_state_resolution_result(
+            room_id, group_names, prev_group, delta_ids
+        )
+
+    async def _queue(
+        self, linearizer: Linearizer, key: Hashable, lock_name: str
+    ) -> ContextManager[None]:
+        """Wait for the given linearizer, recording how long we waited
+
+        Args:
+            linearizer: the linearizer to queue on
+            key: the key to queue on
+            lock_name: the name to record the wait time under in the metrics
+
+        Returns:
+            a context manager which releases the lock on exit
+        """
+        start = self.clock.time()
+        lock = await linearizer.queue(key)
+        state_res_lock_wait_histogram.labels(lock_name).observe(
+            self.clock.time() - start
+        )
+        return lock
+
+    async def _resolve_state_groups_locked(
+        self,
+        room_id: str,
+        room_version: str,
+        state_groups_ids: Dict[int, StateMap[str]],
+        event_map: Optional[Dict[str, EventBase]],
+        state_res_store: "StateResolutionStore",
+    ) -> StateMap[str]:
+        """Does the work of `resolve_state_groups`, once the locks are held.
+        """
+        logger.info(
+            "Resolving state for %s with groups %s", room_id, list(state_groups_ids),
+        )
+
+        state_groups_histogram.observe(len(state_groups_ids))
+
+        return await self.resolve_events_with_store(
+            room_id,
+            room_version,
+            list(state_groups_ids.values()),
+            event_map=event_map,
+            state_res_store=state_res_store,
+        )
+
     async def resolve_events_with_store(
         self,
         room_id: str,
@@ -620,6 +914,12 @@ class StateResolutionHandler:
         Returns:
             a map from (type, state_key) to event_id.
         """
+        recording_store = None  # type: Optional[RecordingStateResolutionStore]
+        if self._dump_directory:
+            recording_store = RecordingStateResolutionStore(state_res_store, event_map)
+            state_res_store = recording_store  # type: ignore
+
+        start_ms = self.clock.time_msec()
         try:
             with Measure(self.clock, "state._resolve_events") as m:
                 v = KNOWN_ROOM_VERSIONS[room_version]
@@ -627,6 +927,15 @@ class StateResolutionHandler:
                     return await v1.resolve_events_with_store(
                         room_id, state_sets, event_map, state_res_store.get_events
                     )
+                elif self._process_pool:
+                    return await self._process_pool.resolve_events_with_store(
+                        self.clock,
+                        room_id,
+                        room_version,
+                        state_sets,
+                        event_map,
+                        state_res_store,
+                    )
                 else:
                     return await v2.resolve_events_with_store(
                         self.clock,
@@ -637,24 +946,121 @@ class StateResolutionHandler:
                         state_res_store,
                     )
         finally:
-            self._record_state_res_metrics(room_id, m.get_resource_usage())
+            duration_ms = self.clock.time_msec() - start_ms
+            self._record_state_res_metrics(
+                room_id, room_version, state_sets, duration_ms, m.get_resource_usage()
+            )
+
+            if recording_store and duration_ms >= self._dump_threshold_ms:
+                run_as_background_process(
+                    "dump_state_resolution",
+                    self._dump_state_resolution,
+                    room_id,
+                    room_version,
+                    state_sets,
+                    recording_store,
+                )
+
+    def _record_state_res_metrics(
+        self,
+        room_id: str,
+        room_version: str,
+        state_sets: Sequence[StateMap[str]],
+        duration_ms: int,
+        rusage: ContextResourceUsage,
+    ):
+        cpu_time = rusage.ru_utime + rusage.ru_stime
 
-    def _record_state_res_metrics(self, room_id: str, rusage: ContextResourceUsage):
         room_metrics = self._state_res_metrics[room_id]
-        room_metrics.cpu_time += rusage.ru_utime + rusage.ru_stime
+        room_metrics.cpu_time += cpu_time
         room_metrics.db_time += rusage.db_txn_duration_sec
         room_metrics.db_events += rusage.evt_db_fetch_count
 
+        state_res_cpu_histogram.observe(cpu_time)
+        state_res_db_histogram.observe(rusage.db_txn_duration_sec)
+
+        # Forget resolutions which are no longer recent, and don't bother
+        # looking at this one in detail if it's faster than all of the rest.
+        now = self.clock.time_msec()
+        self._slow_resolutions = [
+            r
+            for r in self._slow_resolutions
+            if r.ts > now - SLOW_STATE_RESOLUTION_WINDOW_MS
+        ]
+        duration = duration_ms / 1000.0
+        if len(self._slow_resolutions) >= MAX_SLOW_STATE_RESOLUTIONS and duration <= (
+            self._slow_resolutions[-1].duration
+        ):
+            return
+
+        _, conflicted_state = v2._seperate(state_sets)
+
+        self._slow_resolutions.append(
+            SlowStateResolution(
+                room_id=room_id,
+                room_version=room_version,
+                ts=now,
+                duration=duration,
+                cpu_time=cpu_time,
+                db_time=rusage.db_txn_duration_sec,
+                db_events=rusage.evt_db_fetch_count,
+                state_sets=len(state_sets),
+                conflicted_state_keys=len(conflicted_state),
+                conflicted_events=sum(len(ids) for ids in conflicted_state.values()),
+            )
+        )
+        self._slow_resolutions.sort(key=lambda r: r.duration, reverse=True)
+        del self._slow_resolutions[MAX_SLOW_STATE_RESOLUTIONS:]
+
+    def get_slow_state_resolutions(self) -> List[SlowStateResolution]:
+        """Get the slowest recent state resolutions done by this process,
+        slowest first.
+        """
+        now = self.clock.time_msec()
+        return [
+            r
+            for r in self._slow_resolutions
+            if r.ts > now - SLOW_STATE_RESOLUTION_WINDOW_MS
+        ]
+
+    async def _dump_state_resolution(
+        self,
+        room_id: str,
+        room_version: str,
+        state_sets: Sequence[StateMap[str]],
+        recording_store: RecordingStateResolutionStore,
+    ) -> None:
+        """Write the inputs of a state resolution to the dump directory."""
+        dump = recording_store.encode(room_id, room_version, state_sets)
+        path = os.path.join(
+            self._dump_directory,
+            "%d-%s.json" % (self.clock.time_msec(), re.sub(r"[^\w.-]", "_", room_id)),
+        )
+
+        def _write():
+            with open(path, "w") as f:
+                for chunk in json_encoder.iterencode(dump):
+                    f.write(chunk)
+
+        try:
+            await defer_to_thread(self.hs.get_reactor(), _write)
+        except Exception:
+            logger.exception("Failed to dump state resolution to %s", path)
+        else:
+            logger.info("Dumped slow state resolution in %s to %s", room_id, path)
+
     def _report_metrics(self):
         if not self._state_res_metrics:
             # no state res has happened since the last iteration: don't bother logging.
+            self._top_rooms_by_cpu = {}
+            self._top_rooms_by_db = {}
             return
 
-        self._report_biggest(
+        self._top_rooms_by_cpu = self._report_biggest(
             lambda i: i.cpu_time, "CPU time", _biggest_room_by_cpu_counter,
         )
 
-        self._report_biggest(
+        self._top_rooms_by_db = self._report_biggest(
             lambda i: i.db_time, "DB time", _biggest_room_by_db_counter,
         )
 
@@ -665,7 +1071,7 @@ class StateResolutionHandler:
         extract_key: Callable[[_StateResMetrics], Any],
         metric_name: str,
         prometheus_counter_metric: Counter,
-    ) -> None:
+    ) -> Dict[Tuple[str], float]:
         """Report metrics on the biggest rooms for state res
 
         Args:
@@ -674,18 +1080,15 @@ class StateResolutionHandler:
             metric_name: the name of the metric we have extracted, for the log line
             prometheus_counter_metric: a prometheus metric recording the sum of the
                 the extracted metric
-        """
-        n_to_log = 10
-        if not metrics_logger.isEnabledFor(logging.DEBUG):
-            # only need the most expensive if we don't have debug logging, which
-            # allows nlargest() to degrade to max()
-            n_to_log = 1
 
+        Returns:
+            A map from (room_id,) to the extracted metric, for the biggest rooms.
+        """
         items = self._state_res_metrics.items()
 
         # log the N biggest rooms
         biggest = heapq.nlargest(
-            n_to_log, items, key=lambda i: extract_key(i[1])
+            STATE_RES_TOP_ROOMS, items, key=lambda i: extract_key(i[1])
         )  # type: List[Tuple[str, _StateResMetrics]]
         metrics_logger.debug(
             "%i biggest rooms for state-res by %s: %s",
@@ -698,6 +1101,8 @@ class StateResolutionHandler:
         _, biggest_metrics = biggest[0]
         prometheus_counter_metric.inc(extract_key(biggest_metrics))
 
+        return {(room_id,): extract_key(m) for room_id, m in biggest}
+
 
 def _make_state_cache_entry(
     new_state: StateMap[str], state_groups_ids: Dict[int, StateMap[str]]
@@ -783,7 +1188,7 @@ class StateResolutionStore:
         )
 
     def get_auth_chain_difference(
-        self, state_sets: List[Set[str]]
+        self, room_id: str, state_sets: List[Set[str]]
     ) -> Awaitable[Set[str]]:
         """Given sets of state events figure out the auth chain difference (as
         per state res v2 algorithm).
@@ -796,4 +1201,32 @@ class StateResolutionStore:
             An awaitable that resolves to a set of event IDs.
         """
 
-        return self.store.get_auth_chain_difference(state_sets)
+        return self.store.get_auth_chain_difference(room_id, state_sets)
+
+    def get_state_resolution_result(
+        self, state_groups: Collection[int]
+    ) -> Awaitable[Optional[Tuple[int, StateMap[Optional[str]]]]]:
+        """Get the stored result of resolving the state of the given state
+        groups, if any.
+
+        Returns:
+            An awaitable which resolves to None, or to a (prev_group,
+            delta_ids) tuple where `prev_group` is one of the given groups and
+            removed entries map to None in `delta_ids`.
+        """
+
+        return self.store.get_state_resolution_result(state_groups)
+
+    def store_state_resolution_result(
+        self,
+        room_id: str,
+        state_groups: Collection[int],
+        prev_group: int,
+        delta_ids: StateMap[Optional[str]],
+    ) -> Awaitable[None]:
+        """Store the result of resolving the state of the given state groups.
+        """
+
+        return self.store.store_state_resolution_result(
+            room_id, state_groups, prev_group, delta_ids
+        )
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Support for dumping the inputs of a state resolution to a file, so that it can
+be replayed offline (e.g. by the `state_res_replay` synmark suite).
+
+A dump records the state sets which were resolved, and everything that the
+algorithm read from the `StateResolutionStore` while resolving them.
+"""
+
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from synapse.api.room_versions import KNOWN_ROOM_VERSIONS
+from synapse.events import EventBase, make_event_from_dict
+from synapse.types import JsonDict, StateMap
+
+# The version of the dump format. Bump this if the format changes.
+DUMP_FORMAT_VERSION = 1
+
+
+class RecordingStateResolutionStore:
+    """Wraps a `StateResolutionStore`, recording the events and auth chain
+    difference that it returns.
+
+    Args:
+        store: the store to wrap
+        event_map: the events which the resolution was given up front, if any
+    """
+
+    def __init__(self, store, event_map: Optional[Dict[str, EventBase]] = None):
+        self._store = store
+        self.events = dict(event_map or {})  # type: Dict[str, EventBase]
+        self.auth_chain_difference = None  # type: Optional[Set[str]]
+
+    async def get_events(
+        self, event_ids: Iterable[str], allow_rejected: bool = False
+    ) -> Dict[str, EventBase]:
+        events = await self._store.get_events(event_ids, allow_rejected=allow_rejected)
+        self.events.update(events)
+        return events
+
+    async def get_auth_chain_difference(
+        self, room_id: str, state_sets: List[Set[str]]
+    ) -> Set[str]:
+        result = await self._store.get_auth_chain_difference(room_id, state_sets)
+        self.auth_chain_difference = set(result)
+        return result
+
+    def encode(
+        self, room_id: str, room_version: str, state_sets: Iterable[StateMap[str]]
+    ) -> JsonDict:
+        """Build a dump of a resolution of `state_sets` which used this store.
+        """
+        return {
+            "format_version": DUMP_FORMAT_VERSION,
+            "room_id": room_id,
+            "room_version": room_version,
+            "state_sets": [
+                [[typ, state_key, event_id] for (typ, state_key), event_id in s.items()]
+                for s in state_sets
+            ],
+            "auth_chain_difference": sorted(self.auth_chain_difference or ()),
+            "events": {
+                event_id: {
+                    "event": event.get_pdu_json(),
+                    "internal_metadata": event.internal_metadata.get_dict(),
+                    "rejected_reason": event.rejected_reason,
+                }
+                for event_id, event in self.events.items()
+            },
+        }
+
+
+class ReplayStateResolutionStore:
+    """A `StateResolutionStore` which serves the events and auth chain
+    difference recorded in a dump.
+    """
+
+    def __init__(self, events: Dict[str, EventBase], auth_chain_difference: Set[str]):
+        self._events = events
+        self._auth_chain_difference = auth_chain_difference
+
+    async def get_events(
+        self, event_ids: Iterable[str], allow_rejected: bool = False
+    ) -> Dict[str, EventBase]:
+        return {
+            event_id: self._events[event_id]
+            for event_id in event_ids
+            if event_id in self._events
+            and (allow_rejected or not self._events[event_id].rejected_reason)
+        }
+
+    async def get_auth_chain_difference(
+        self, room_id: str, state_sets: List[Set[str]]
+    ) -> Set[str]:
+        return set(self._auth_chain_difference)
+
+
+def decode_dump(
+    dump: JsonDict,
+) -> Tuple[str, str, List[StateMap[str]], ReplayStateResolutionStore]:
+    """Load a dump produced by `RecordingStateResolutionStore.encode`.
+
+    Returns:
+        The room ID, room version, state sets, and a store to resolve them
+        against.
+    """
+    if dump.get("format_version") != DUMP_FORMAT_VERSION:
+        raise ValueError(
+            "Unsupported state resolution dump format: %r"
+            % (dump.get("format_version"),)
+        )
+
+    room_version = KNOWN_ROOM_VERSIONS[dump["room_version"]]
+
+    events = {
+        event_id: make_event_from_dict(
+            entry["event"],
+            room_version,
+            entry["internal_metadata"],
+            entry["rejected_reason"],
+        )
+        for event_id, entry in dump["events"].items()
+    }
+
+    state_sets = [
+        {(typ, state_key): event_id for typ, state_key, event_id in state_set}
+        for state_set in dump["state_sets"]
+    ]  # type: List[StateMap[str]]
+
+    store = ReplayStateResolutionStore(events, set(dump["auth_chain_difference"]))
+    return dump["room_id"], room_version.identifier, state_sets, store
@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Support for running the CPU-heavy parts of v2 state resolution in a pool of
+worker processes, so that resolving state in large rooms doesn't block the
+reactor.
+
+Before handing off to the pool we fetch every event that the algorithm will
+look at, and ship a compact projection of each of them (see `EventProjection`)
+to the worker, which runs the unmodified v2 algorithm against them.
+"""
+
+import itertools
+import logging
+import multiprocessing
+import sys
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import attr
+from prometheus_client import Counter
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+import synapse.state
+from synapse import event_auth
+from synapse.api.constants import EventTypes
+from synapse.events import EventBase
+from synapse.logging.context import make_deferred_yieldable
+from synapse.state import v2
+from synapse.types import StateMap
+from synapse.util import Clock
+from synapse.util.frozenutils import unfreeze
+
+logger = logging.getLogger(__name__)
+
+# The minimum number of conflicted events (including the auth chain
+# difference) for which we bother shipping the resolution off to the pool.
+# Anything smaller is cheaper to resolve in-process.
+MIN_EVENTS_FOR_PROCESS_POOL = 100
+
+# We need to be able to choose how the worker processes are started (see
+# `StateResolutionProcessPool`), which `ProcessPoolExecutor` only supports from
+# Python 3.7.
+PROCESS_POOL_SUPPORTED = sys.version_info >= (3, 7)
+
+state_res_process_pool_counter = Counter(
+    "synapse_state_res_process_pool_resolutions",
+    "Number of state resolutions performed in the state resolution process pool",
+)
+
+state_res_process_pool_fallback_counter = Counter(
+    "synapse_state_res_process_pool_fallbacks",
+    "Number of state resolutions which had to be retried in-process because "
+    "resolving them in the process pool failed",
+)
+
+
+@attr.s(slots=True)
+class _ProjectionInternalMetadata:
+    """Stands in for the `internal_metadata` of an event projection, which the
+    auth rules may write to (e.g. `recheck_redaction`), but which state
+    resolution never reads.
+    """
+
+    recheck_redaction = attr.ib(type=bool, default=False)
+
+
+@attr.s(slots=True, frozen=True)
+class EventProjection:
+    """The parts of an event needed by v2 state resolution and the auth rules.
+
+    This implements the subset of the `EventBase` interface that
+    `synapse.state.v2` and `synapse.event_auth.check` (without signature or
+    size checks) use, and is cheap to pickle.
+    """
+
+    event_id = attr.ib(type=str)
+    room_id = attr.ib(type=str)
+    type = attr.ib(type=str)
+    state_key = attr.ib(type=Optional[str])
+    sender = attr.ib(type=str)
+    content = attr.ib(type=Dict[str, Any])
+    auth_events = attr.ib(type=Tuple[str, ...])
+    prev_events = attr.ib(type=Tuple[str, ...])
+    origin_server_ts = attr.ib(type=int)
+    redacts = attr.ib(type=Optional[str])
+    rejected_reason = attr.ib(type=Optional[str])
+    format_version = attr.ib(type=int)
+    internal_metadata = attr.ib(
+        type=_ProjectionInternalMetadata,
+        factory=_ProjectionInternalMetadata,
+        cmp=False,
+        repr=False,
+    )
+
+    @staticmethod
+    def from_event(event: EventBase) -> "EventProjection":
+        return EventProjection(
+            event_id=event.event_id,
+            room_id=event.room_id,
+            type=event.type,
+            state_key=event.get("state_key"),
+            sender=event.sender,
+            content=unfreeze(event.content),
+            auth_events=tuple(event.auth_event_ids()),
+            prev_events=tuple(event.prev_event_ids()),
+            origin_server_ts=event.origin_server_ts,
+            redacts=event.redacts,
+            rejected_reason=event.rejected_reason,
+            format_version=event.format_version,
+        )
+
+    @property
+    def user_id(self) -> str:
+        return self.sender
+
+    @property
+    def membership(self) -> str:
+        return self.content["membership"]
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return getattr(self, key, default)
+
+    def is_state(self) -> bool:
+        return self.state_key is not None
+
+    def auth_event_ids(self) -> Sequence[str]:
+        return self.auth_events
+
+    def prev_event_ids(self) -> Sequence[str]:
+        return self.prev_events
+
+
+class MissingProjectionError(Exception):
+    """Raised in a worker process when state resolution asks for an event which
+    we did not send a projection of.
+    """
+
+
+async def get_event_projections(
+    unconflicted_state: StateMap[str],
+    conflicted_state: StateMap[Set[str]],
+    auth_diff: Set[str],
+    event_map: Dict[str, EventBase],
+    state_res_store: "synapse.state.StateResolutionStore",
+) -> Tuple[Dict[str, EventProjection], Set[str]]:
+    """Fetch all the events that v2 state resolution will need to resolve the
+    given conflicted state, and build projections of them.
+
+    Args:
+        unconflicted_state
+        conflicted_state
+        auth_diff: the auth chain difference of the state sets
+        event_map: a dict from event_id to event, used as a cache of events
+        state_res_store
+
+    Returns:
+        A map from event ID to projection, and the set of event IDs which were
+        looked for but do not exist.
+    """
+    requested = set()  # type: Set[str]
+
+    async def _fetch(event_ids: Iterable[str]) -> List[EventBase]:
+        to_fetch = [eid for eid in event_ids if eid not in requested]
+        requested.update(to_fetch)
+
+        missing = [eid for eid in to_fetch if eid not in event_map]
+        if missing:
+            events = await state_res_store.get_events(missing, allow_rejected=True)
+            event_map.update(events)
+
+        return [event_map[eid] for eid in to_fetch if eid in event_map]
+
+    events = await _fetch(
+        itertools.chain(
+            itertools.chain.from_iterable(conflicted_state.values()), auth_diff
+        )
+    )
+
+    # The conflicted events are authed against their auth events, and against
+    # the (partially) resolved state, which may include unconflicted events.
+    next_ids = set()  # type: Set[str]
+    for event in events:
+        next_ids.update(event.auth_event_ids())
+        for key in event_auth.auth_types_for_event(event):
+            if key in unconflicted_state:
+                next_ids.add(unconflicted_state[key])
+
+    pl = unconflicted_state.get((EventTypes.PowerLevels, ""))
+    if pl:
+        next_ids.add(pl)
+
+    # When sorting by mainline we walk back through chains of power level
+    # events, looking at all of their auth events.
+    while next_ids:
+        events = await _fetch(next_ids)
+
+        next_ids = set()
+        for event in events:
+            if (event.type, event.state_key) == (EventTypes.PowerLevels, ""):
+                next_ids.update(event.auth_event_ids())
+
+    projections = {
+        eid: EventProjection.from_event(event_map[eid])
+        for eid in requested
+        if eid in event_map
+    }
+    return projections, requested - projections.keys()
+
+
+class _ProjectionStore:
+    """A `StateResolutionStore` which serves events from a set of projections.
+    """
+
+    def __init__(
+        self, projections: Dict[str, EventProjection], missing: Set[str]
+    ) -> None:
+        self._projections = projections
+        self._missing = missing
+
+    async def get_events(
+        self, event_ids: Iterable[str], allow_rejected: bool = False
+    ) -> Dict[str, EventProjection]:
+        result = {}
+        for event_id in event_ids:
+            projection = self._projections.get(event_id)
+            if projection is not None:
+                result[event_id] = projection
+            elif event_id not in self._missing:
+                raise MissingProjectionError(event_id)
+
+        return result
+
+
+class _SynchronousClock:
+    """A clock which never yields to the reactor (there is none in the worker)
+    """
+
+    async def sleep(self, seconds: float) -> None:
+        pass
+
+
+def resolve_with_projections(
+    room_id: str,
+    room_version: str,
+    unconflicted_state: StateMap[str],
+    conflicted_state: StateMap[Set[str]],
+    auth_diff: Set[str],
+    projections: Dict[str, EventProjection],
+    missing: Set[str],
+) -> StateMap[str]:
+    """Resolve the conflicted state using the given projections. This is run in
+    the worker processes.
+
+    Raises:
+        MissingProjectionError if the resolution needs an event which is
+        neither in `projections` nor `missing`.
+    """
+    coro = v2.resolve_conflicted_state(
+        _SynchronousClock(),  # type: ignore
+        room_id,
+        room_version,
+        unconflicted_state,
+        conflicted_state,
+        auth_diff,
+        dict(projections),  # type: ignore
+        _ProjectionStore(projections, missing),  # type: ignore
+    )
+
+    # Nothing in the projection store or the clock ever blocks, so the
+    # coroutine should run to completion in one go.
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+
+    coro.close()
+    raise Exception("State resolution blocked in worker process")
+
+
+class StateResolutionProcessPool:
+    """Runs v2 state resolution for large conflicts in a pool of processes.
+
+    The worker processes are started with the "forkserver" (or, where that is
+    not available, "spawn") start method, rather than by forking this process,
+    as forking a process which is running threads (as the reactor's thread pools
+    are) can leave the child with locks which will never be released.
+
+    Requires Python 3.7 or later (see `PROCESS_POOL_SUPPORTED`).
+    """
+
+    def __init__(self, reactor, max_workers: int):
+        self._reactor = reactor
+        self._max_workers = max_workers
+        self._executor = self._make_executor()
+
+        reactor.addSystemEventTrigger("before", "shutdown", self._shutdown)
+
+    def _make_executor(self) -> ProcessPoolExecutor:
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            mp_context = multiprocessing.get_context("forkserver")
+        else:
+            mp_context = multiprocessing.get_context("spawn")
+
+        return ProcessPoolExecutor(max_workers=self._max_workers, mp_context=mp_context)
+
+    def _shutdown(self) -> None:
+        self._executor.shutdown(wait=False)
+
+    async def resolve_events_with_store(
+        self,
+        clock: Clock,
+        room_id: str,
+        room_version: str,
+        state_sets: Sequence[StateMap[str]],
+        event_map: Optional[Dict[str, EventBase]],
+        state_res_store: "synapse.state.StateResolutionStore",
+    ) -> StateMap[str]:
+        """Resolves the state using the v2 state resolution algorithm, using the
+        process pool if the conflict is large enough.
+
+        Takes the same arguments as `synapse.state.v2.resolve_events_with_store`.
+        """
+        if event_map is None:
+            event_map = {}
+
+        unconflicted_state, conflicted_state = v2._seperate(state_sets)
+
+        if not conflicted_state:
+            return unconflicted_state
+
+        auth_diff = await state_res_store.get_auth_chain_difference(
+            room_id, [set(state_set.values()) for state_set in state_sets]
+        )
+
+        num_events = len(auth_diff) + sum(len(ids) for ids in conflicted_state.values())
+        if num_events >= MIN_EVENTS_FOR_PROCESS_POOL:
+            projections, missing = await get_event_projections(
+                unconflicted_state,
+                conflicted_state,
+                auth_diff,
+                event_map,
+                state_res_store,
+            )
+
+            try:
+                resolved_state = await self._run(
+                    resolve_with_projections,
+                    room_id,
+                    room_version,
+                    unconflicted_state,
+                    conflicted_state,
+                    auth_diff,
+                    projections,
+                    missing,
+                )
+            except MissingProjectionError as e:
+                logger.warning(
+                    "Event %s was missing from projections when resolving state "
+                    "for %s: resolving in-process",
+                    e,
+                    room_id,
+                )
+                state_res_process_pool_fallback_counter.inc()
+            except Exception:
+                # Whatever went wrong in the pool, we can still resolve the state
+                # in-process.
+                logger.exception(
+                    "Failed to resolve state for %s in the process pool: "
+                    "resolving in-process",
+                    room_id,
+                )
+                state_res_process_pool_fallback_counter.inc()
+            else:
+                state_res_process_pool_counter.inc()
+                return resolved_state
+
+        return await v2.resolve_conflicted_state(
+            clock,
+            room_id,
+            room_version,
+            unconflicted_state,
+            conflicted_state,
+            auth_diff,
+            event_map,
+            state_res_store,
+        )
+
+    def _run(self, f: Callable[..., Any], *args: Any) -> "defer.Deferred":
+        """Run the given function in the pool, returning a Deferred which
+        follows the synapse logcontext rules.
+        """
+        d = defer.Deferred()  # type: defer.Deferred
+
+        def _on_done(future: Future) -> None:
+            try:
+                result = future.result()
+            except Exception:
+                self._reactor.callFromThread(d.errback, Failure())
+            else:
+                self._reactor.callFromThread(d.callback, result)
+
+        executor = self._executor
+        try:
+            future = executor.submit(f, *args)
+        except BrokenProcessPool:
+            # A worker process died abruptly, which leaves the pool unusable, so
+            # start a new one.
+            logger.warning("State resolution process pool is broken: restarting it")
+            if self._executor is executor:
+                self._executor = self._make_executor()
+            executor.shutdown(wait=False)
+            future = self._executor.submit(f, *args)
+
+        future.add_done_callback(_on_done)
+
+        return make_deferred_yieldable(d)
@@ -97,8 +97,48 @@ async def resolve_events_with_store(
 
     # Also fetch all auth events that appear in only some of the state sets'
     # auth chains.
-    auth_diff = await _get_auth_chain_difference(state_sets, event_map, state_res_store)
+    auth_diff = await _get_auth_chain_difference(
+        room_id, state_sets, event_map, state_res_store
+    )
 
+    return await resolve_conflicted_state(
+        clock,
+        room_id,
+        room_version,
+        unconflicted_state,
+        conflicted_state,
+        auth_diff,
+        event_map,
+        state_res_store,
+    )
+
+
+async def resolve_conflicted_state(
+    clock: Clock,
+    room_id: str,
+    room_version: str,
+    unconflicted_state: StateMap[str],
+    conflicted_state: StateMap[Set[str]],
+    auth_diff: Set[str],
+    event_map: Dict[str, EventBase],
+    state_res_store: "synapse.state.StateResolutionStore",
+) -> StateMap[str]:
+    """Resolves the conflicted state using the v2 state resolution algorithm,
+    once the auth chain difference has been calculated.
+
+    Args:
+        clock
+        room_id: the room we are working in
+        room_version: The room version
+        unconflicted_state: the unconflicted state, as returned by `_seperate`
+        conflicted_state: the conflicted state, as returned by `_seperate`
+        auth_diff: the auth chain difference of the state sets
+        event_map: a dict from event_id to event, used as a cache of events
+        state_res_store:
+
+    Returns:
+        A map from (type, state_key) to event_id.
+    """
     full_conflicted_set = set(
         itertools.chain(
             itertools.chain.from_iterable(conflicted_state.values()), auth_diff
@@ -236,6 +276,7 @@ async def _get_power_level_for_sender(
 
 
 async def _get_auth_chain_difference(
+    room_id: str,
     state_sets: Sequence[StateMap[str]],
     event_map: Dict[str, EventBase],
     state_res_store: "synapse.state.StateResolutionStore",
@@ -244,6 +285,7 @@ async def _get_auth_chain_difference(
     that only appear in some but not all of the auth chains.
 
     Args:
+        room_id
         state_sets
         event_map
         state_res_store
@@ -253,7 +295,7 @@ async def _get_auth_chain_difference(
     """
 
     difference = await state_res_store.get_auth_chain_difference(
-        [set(state_set.values()) for state_set in state_sets]
+        room_id, [set(state_set.values()) for state_set in state_sets]
     )
 
     return difference
@@ -46,6 +46,7 @@ from .events_bg_updates import EventsBackgroundUpdatesStore
 from .filtering import FilteringStore
 from .group_server import GroupServerStore
 from .keys import KeyStore
+from .lazy_loaded_members import LazyLoadedMembersStore
 from .media_repository import MediaRepositoryStore
 from .metrics import ServerMetricsStore
 from .monthly_active_users import MonthlyActiveUsersStore
@@ -66,6 +67,7 @@ from .signatures import SignatureStore
 from .state import StateStore
 from .stats import StatsStore
 from .stream import StreamStore
+from .sync_snapshots import SyncSnapshotStore
 from .tags import TagsStore
 from .transactions import TransactionStore
 from .ui_auth import UIAuthStore
@@ -113,6 +115,8 @@ class DataStore(
     UserErasureStore,
     MonthlyActiveUsersStore,
     StatsStore,
+    SyncSnapshotStore,
+    LazyLoadedMembersStore,
     RelationsStore,
     CensorEventsStore,
     UIAuthStore,
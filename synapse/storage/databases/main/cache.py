@@ -171,6 +171,7 @@ class CacheInvalidationWorkerStore(SQLBaseStore):
         self._invalidate_get_event_cache(event_id)
 
         self.get_latest_event_ids_in_room.invalidate((room_id,))
+        self.get_last_event_stream_ordering.invalidate((room_id,))
 
         self.get_unread_event_push_actions_by_room_for_user.invalidate_many((room_id,))
 
@@ -188,6 +189,7 @@ class CacheInvalidationWorkerStore(SQLBaseStore):
             self.get_relations_for_event.invalidate_many((relates_to,))
             self.get_aggregation_groups_for_event.invalidate_many((relates_to,))
             self.get_applicable_edit.invalidate((relates_to,))
+            self.event_has_relations.invalidate((relates_to,))
 
     async def invalidate_cache_and_stream(self, cache_name: str, keys: Tuple[Any, ...]):
         """Invalidates the cache and adds it to the cache stream so slaves
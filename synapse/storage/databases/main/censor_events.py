@@ -120,6 +120,14 @@ class CensorEventsStore(EventsWorkerStore, CacheInvalidationWorkerStore, SQLBase
                 if pruned_json:
                     self._censor_event_txn(txn, event_id, pruned_json)
 
+                    # The cached copy of the event still holds the original
+                    # content. Invalidate it so that the next fetch only decodes
+                    # (and caches) the pruned form.
+                    txn.call_after(self._get_event_cache.invalidate, (event_id,))
+                    self._send_invalidation_to_replication(
+                        txn, "_get_event_cache", (event_id,)
+                    )
+
                 self.db_pool.simple_update_one_txn(
                     txn,
                     table="redactions",
@@ -489,6 +489,23 @@ class DeviceWorkerStore(SQLBaseStore):
             device["device_id"]: db_to_json(device["content"]) for device in devices
         }
 
+    def get_users_whose_devices_may_have_changed(
+        self, from_key: int
+    ) -> Optional[Set[str]]:
+        """Get the users whose devices may have changed since `from_key`, if
+        that can be told without querying the database.
+
+        Args:
+            from_key: The device lists stream token
+
+        Returns:
+            The user IDs, or None if `from_key` is too old to tell.
+        """
+        changed = self._device_list_stream_cache.get_all_entities_changed(from_key)
+        if changed is None:
+            return None
+        return set(changed)
+
     async def get_users_whose_devices_changed(
         self, from_key: int, user_ids: Iterable[str]
     ) -> Set[str]:
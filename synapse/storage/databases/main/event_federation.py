@@ -15,15 +15,18 @@
 import itertools
 import logging
 from queue import Empty, PriorityQueue
-from typing import Dict, Iterable, List, Set, Tuple
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
 from synapse.api.errors import StoreError
 from synapse.events import EventBase
 from synapse.metrics.background_process_metrics import wrap_as_background_process
 from synapse.storage._base import SQLBaseStore, make_in_list_sql_clause
 from synapse.storage.database import DatabasePool, LoggingTransaction
+from synapse.storage.databases.main.events import PersistEventsStore
 from synapse.storage.databases.main.events_worker import EventsWorkerStore
 from synapse.storage.databases.main.signatures import SignatureWorkerStore
+from synapse.storage.types import Cursor
+from synapse.storage.util.sequence import build_sequence_generator
 from synapse.types import Collection
 from synapse.util.caches.descriptors import cached
 from synapse.util.caches.lrucache import LruCache
@@ -32,6 +35,11 @@ from synapse.util.iterutils import batch_iter
 logger = logging.getLogger(__name__)
 
 
+class _NoChainCoverIndex(Exception):
+    def __init__(self, room_id: str):
+        super().__init__("Unexpectedly no chain cover for events in %s" % (room_id,))
+
+
 class EventFederationWorkerStore(EventsWorkerStore, SignatureWorkerStore, SQLBaseStore):
     def __init__(self, database: DatabasePool, db_conn, hs):
         super().__init__(database, db_conn, hs)
@@ -46,12 +54,22 @@ class EventFederationWorkerStore(EventsWorkerStore, SignatureWorkerStore, SQLBas
             500000, "_event_auth_cache", size_callback=len
         )  # type: LruCache[str, List[Tuple[str, int]]]
 
+        def get_max_chain_id_txn(txn: Cursor) -> int:
+            txn.execute("SELECT COALESCE(MAX(chain_id), 0) FROM event_auth_chains")
+            return txn.fetchone()[0]
+
+        # Generates the IDs of new chains in the chain cover index.
+        self._event_chain_id_gen = build_sequence_generator(
+            database.engine, get_max_chain_id_txn, "event_auth_chain_id"
+        )
+
     async def get_auth_chain(
-        self, event_ids: Collection[str], include_given: bool = False
+        self, room_id: str, event_ids: Collection[str], include_given: bool = False
     ) -> List[EventBase]:
         """Get auth events for given event_ids. The events *must* be state events.
 
         Args:
+            room_id: The room the event is in.
             event_ids: state events
             include_given: include the given events in result
 
@@ -59,16 +77,17 @@ class EventFederationWorkerStore(EventsWorkerStore, SignatureWorkerStore, SQLBas
             list of events
         """
         event_ids = await self.get_auth_chain_ids(
-            event_ids, include_given=include_given
+            room_id, event_ids, include_given=include_given
         )
         return await self.get_events_as_list(event_ids)
 
     async def get_auth_chain_ids(
-        self, event_ids: Collection[str], include_given: bool = False,
+        self, room_id: str, event_ids: Collection[str], include_given: bool = False,
     ) -> List[str]:
         """Get auth events for given event_ids. The events *must* be state events.
 
         Args:
+            room_id: The room the event is in.
             event_ids: state events
             include_given: include the given events in result
 
@@ -78,13 +97,195 @@ class EventFederationWorkerStore(EventsWorkerStore, SignatureWorkerStore, SQLBas
         return await self.db_pool.runInteraction(
             "get_auth_chain_ids",
             self._get_auth_chain_ids_txn,
+            room_id,
             event_ids,
             include_given,
         )
 
+    def _has_auth_chain_index_txn(self, txn: LoggingTransaction, room_id: str) -> bool:
+        """Whether we can use the chain cover index for the given room.
+        """
+        return bool(
+            self.db_pool.simple_select_one_onecol_txn(
+                txn,
+                table="rooms",
+                keyvalues={"room_id": room_id},
+                retcol="has_auth_chain_index",
+                allow_none=True,
+            )
+        )
+
     def _get_auth_chain_ids_txn(
+        self,
+        txn: LoggingTransaction,
+        room_id: str,
+        event_ids: Collection[str],
+        include_given: bool,
+    ) -> List[str]:
+        if self._has_auth_chain_index_txn(txn, room_id):
+            try:
+                return self._get_auth_chain_ids_using_cover_index_txn(
+                    txn, room_id, event_ids, include_given
+                )
+            except _NoChainCoverIndex:
+                # For whatever reason we don't actually have a chain cover index
+                # for the events in question, so we fall back to the old method.
+                pass
+
+        return self._get_auth_chain_ids_by_walking_txn(txn, event_ids, include_given)
+
+    def _get_auth_chain_ids_using_cover_index_txn(
+        self,
+        txn: LoggingTransaction,
+        room_id: str,
+        event_ids: Collection[str],
+        include_given: bool,
+    ) -> List[str]:
+        """Calculates the auth chain IDs using the chain index.
+
+        Raises:
+            _NoChainCoverIndex if any of the events are missing from the index.
+        """
+
+        # First we look up the chain ID/sequence numbers for the given events.
+
+        initial_events = set(event_ids)
+
+        # All the events that we've found that are reachable from the events.
+        seen_events = set()  # type: Set[str]
+
+        # A map from chain ID to max sequence number of the given events.
+        event_chains = {}  # type: Dict[int, int]
+
+        sql = """
+            SELECT event_id, chain_id, sequence_number
+            FROM event_auth_chains
+            WHERE %s
+        """
+        for batch in batch_iter(initial_events, 1000):
+            clause, args = make_in_list_sql_clause(
+                txn.database_engine, "event_id", batch
+            )
+            txn.execute(sql % (clause,), args)
+
+            for event_id, chain_id, sequence_number in txn:
+                seen_events.add(event_id)
+                event_chains[chain_id] = max(
+                    sequence_number, event_chains.get(chain_id, 0)
+                )
+
+        # Check that we actually have a chain ID for all the events.
+        events_missing_chain_info = initial_events.difference(seen_events)
+        if events_missing_chain_info:
+            # This can happen e.g. for events persisted while the background
+            # update was indexing the room. We fall back to the old algorithm.
+            logger.info(
+                "Unexpectedly found that events don't have chain IDs in room %s: %s",
+                room_id,
+                events_missing_chain_info,
+            )
+            raise _NoChainCoverIndex(room_id)
+
+        # A map from chain ID to max sequence number *reachable* from any event ID.
+        chains = {}  # type: Dict[int, int]
+
+        # Add all linked chains reachable from initial set of chains.
+        for (
+            origin_chain_id,
+            origin_seq,
+            target_chain_id,
+            target_seq,
+        ) in self._get_chain_links_txn(txn, event_chains):
+            # chains are only reachable if the origin sequence number of
+            # the link is less than the max sequence number in the
+            # origin chain.
+            if origin_seq <= event_chains.get(origin_chain_id, 0):
+                chains[target_chain_id] = max(
+                    target_seq, chains.get(target_chain_id, 0),
+                )
+
+        # Add the initial set of chains, excluding the sequence corresponding to
+        # initial event.
+        for chain_id, seq_no in event_chains.items():
+            chains[chain_id] = max(seq_no - 1, chains.get(chain_id, 0))
+
+        # Now for each chain we figure out the maximum sequence number reachable
+        # from *any* event ID. Events with a sequence less than that are in the
+        # auth chain.
+        if include_given:
+            results = initial_events
+        else:
+            results = set()
+
+        results.update(
+            self._get_events_in_chain_ranges_txn(
+                txn, {chain_id: (0, max_no) for chain_id, max_no in chains.items()}
+            )
+        )
+
+        return list(results)
+
+    def _get_chain_links_txn(
+        self, txn: LoggingTransaction, chain_ids: Iterable[int]
+    ) -> List[Tuple[int, int, int, int]]:
+        """Fetch all the links from the given chains.
+
+        Returns:
+            A list of (origin chain ID, origin sequence number, target chain ID,
+            target sequence number) tuples.
+        """
+        sql = """
+            SELECT
+                origin_chain_id, origin_sequence_number,
+                target_chain_id, target_sequence_number
+            FROM event_auth_chain_links
+            WHERE %s
+        """
+
+        links = []  # type: List[Tuple[int, int, int, int]]
+        for batch in batch_iter(chain_ids, 1000):
+            clause, args = make_in_list_sql_clause(
+                txn.database_engine, "origin_chain_id", batch
+            )
+            txn.execute(sql % (clause,), args)
+            links.extend(txn)
+
+        return links
+
+    def _get_events_in_chain_ranges_txn(
+        self, txn: LoggingTransaction, chain_to_range: Dict[int, Tuple[int, int]]
+    ) -> Set[str]:
+        """Fetch the events in the given ranges of the given chains.
+
+        Args:
+            chain_to_range: map from chain ID to a (min, max) pair of sequence
+                numbers. Events with a sequence number greater than min and at
+                most max are returned.
+        """
+        results = set()  # type: Set[str]
+
+        # We fetch the ranges for a batch of chains in each query, rather than
+        # doing a query per chain.
+        for batch in batch_iter(chain_to_range.items(), 100):
+            clauses = []
+            args = []  # type: List[int]
+            for chain_id, (min_no, max_no) in batch:
+                clauses.append(
+                    "(chain_id = ? AND ? < sequence_number AND sequence_number <= ?)"
+                )
+                args.extend((chain_id, min_no, max_no))
+
+            sql = "SELECT event_id FROM event_auth_chains WHERE " + " OR ".join(clauses)
+            txn.execute(sql, args)
+            results.update(r for r, in txn)
+
+        return results
+
+    def _get_auth_chain_ids_by_walking_txn(
         self, txn: LoggingTransaction, event_ids: Collection[str], include_given: bool
     ) -> List[str]:
+        """Calculates the auth chain IDs by walking the `event_auth` table.
+        """
         if include_given:
             results = set(event_ids)
         else:
@@ -137,7 +338,9 @@ class EventFederationWorkerStore(EventsWorkerStore, SignatureWorkerStore, SQLBas
 
         return list(results)
 
-    async def get_auth_chain_difference(self, state_sets: List[Set[str]]) -> Set[str]:
+    async def get_auth_chain_difference(
+        self, room_id: str, state_sets: List[Set[str]]
+    ) -> Set[str]:
         """Given sets of state events figure out the auth chain difference (as
         per state res v2 algorithm).
 
@@ -152,12 +355,147 @@ class EventFederationWorkerStore(EventsWorkerStore, SignatureWorkerStore, SQLBas
         return await self.db_pool.runInteraction(
             "get_auth_chain_difference",
             self._get_auth_chain_difference_txn,
+            room_id,
             state_sets,
         )
 
     def _get_auth_chain_difference_txn(
-        self, txn, state_sets: List[Set[str]]
+        self, txn: LoggingTransaction, room_id: str, state_sets: List[Set[str]]
+    ) -> Set[str]:
+        if self._has_auth_chain_index_txn(txn, room_id):
+            try:
+                return self._get_auth_chain_difference_using_cover_index_txn(
+                    txn, room_id, state_sets
+                )
+            except _NoChainCoverIndex:
+                # For whatever reason we don't actually have a chain cover index
+                # for the events in question, so we fall back to the old method.
+                pass
+
+        return self._get_auth_chain_difference_by_walking_txn(txn, state_sets)
+
+    def _get_auth_chain_difference_using_cover_index_txn(
+        self, txn: LoggingTransaction, room_id: str, state_sets: List[Set[str]]
     ) -> Set[str]:
+        """Calculates the auth chain difference using the chain index.
+
+        See docs/auth_chain_difference_algorithm.md for details.
+
+        Raises:
+            _NoChainCoverIndex if any of the events are missing from the index.
+        """
+
+        # First we look up the chain ID/sequence numbers for all the events, and
+        # work out the chain/sequence numbers reachable from each state set.
+
+        initial_events = set(state_sets[0]).union(*state_sets[1:])
+
+        # Map from event_id -> (chain ID, seq no)
+        chain_info = {}  # type: Dict[str, Tuple[int, int]]
+
+        # Map from chain ID -> seq no -> event Id
+        chain_to_event = {}  # type: Dict[int, Dict[int, str]]
+
+        # All the chains that we've found that are reachable from the state
+        # sets.
+        seen_chains = set()  # type: Set[int]
+
+        sql = """
+            SELECT event_id, chain_id, sequence_number
+            FROM event_auth_chains
+            WHERE %s
+        """
+        for batch in batch_iter(initial_events, 1000):
+            clause, args = make_in_list_sql_clause(
+                txn.database_engine, "event_id", batch
+            )
+            txn.execute(sql % (clause,), args)
+
+            for event_id, chain_id, sequence_number in txn:
+                chain_info[event_id] = (chain_id, sequence_number)
+                seen_chains.add(chain_id)
+                chain_to_event.setdefault(chain_id, {})[sequence_number] = event_id
+
+        # Check that we actually have a chain ID for all the events.
+        events_missing_chain_info = initial_events.difference(chain_info)
+        if events_missing_chain_info:
+            # This can happen e.g. for events persisted while the background
+            # update was indexing the room. We fall back to the old algorithm.
+            logger.info(
+                "Unexpectedly found that events don't have chain IDs in room %s: %s",
+                room_id,
+                events_missing_chain_info,
+            )
+            raise _NoChainCoverIndex(room_id)
+
+        # Corresponds to `state_sets`, except as a map from chain ID to max
+        # sequence number reachable from the state set.
+        set_to_chain = []  # type: List[Dict[int, int]]
+        for state_set in state_sets:
+            chains = {}  # type: Dict[int, int]
+            set_to_chain.append(chains)
+
+            for event_id in state_set:
+                chain_id, seq_no = chain_info[event_id]
+
+                chains[chain_id] = max(seq_no, chains.get(chain_id, 0))
+
+        # Now we look up all links for the chains we have, adding chains to
+        # set_to_chain that are reachable from each set.
+        for (
+            origin_chain_id,
+            origin_seq,
+            target_chain_id,
+            target_seq,
+        ) in self._get_chain_links_txn(txn, set(seen_chains)):
+            for chains in set_to_chain:
+                # chains are only reachable if the origin sequence number of
+                # the link is less than the max sequence number in the
+                # origin chain.
+                if origin_seq <= chains.get(origin_chain_id, 0):
+                    chains[target_chain_id] = max(
+                        target_seq, chains.get(target_chain_id, 0),
+                    )
+
+            seen_chains.add(target_chain_id)
+
+        # Now for each chain we figure out the maximum sequence number reachable
+        # from *any* state set and the minimum sequence number reachable from
+        # *all* state sets. Events in that range are in the auth chain
+        # difference.
+        result = set()
+
+        # Mapping from chain ID to the range of sequence numbers that should be
+        # pulled from the database.
+        chain_to_gap = {}  # type: Dict[int, Tuple[int, int]]
+
+        for chain_id in seen_chains:
+            min_seq_no = min(chains.get(chain_id, 0) for chains in set_to_chain)
+            max_seq_no = max(chains.get(chain_id, 0) for chains in set_to_chain)
+
+            if min_seq_no < max_seq_no:
+                # We have a non empty gap, try and fill it from the events that
+                # we have, otherwise add them to the list of gaps to pull out
+                # from the DB.
+                for seq_no in range(min_seq_no + 1, max_seq_no + 1):
+                    event_id = chain_to_event.get(chain_id, {}).get(seq_no)
+                    if event_id:
+                        result.add(event_id)
+                    else:
+                        chain_to_gap[chain_id] = (min_seq_no, max_seq_no)
+                        break
+
+        if chain_to_gap:
+            result.update(self._get_events_in_chain_ranges_txn(txn, chain_to_gap))
+
+        return result
+
+    def _get_auth_chain_difference_by_walking_txn(
+        self, txn: LoggingTransaction, state_sets: List[Set[str]]
+    ) -> Set[str]:
+        """Calculates the auth chain difference by walking the `event_auth`
+        table.
+        """
 
         # Algorithm Description
         # ~~~~~~~~~~~~~~~~~~~~~
@@ -686,6 +1024,7 @@ class EventFederationStore(EventFederationWorkerStore):
     """
 
     EVENT_AUTH_STATE_ONLY = "event_auth_state_only"
+    CHAIN_COVER_INDEX = "chain_cover"
 
     def __init__(self, database: DatabasePool, db_conn, hs):
         super().__init__(database, db_conn, hs)
@@ -694,6 +1033,10 @@ class EventFederationStore(EventFederationWorkerStore):
             self.EVENT_AUTH_STATE_ONLY, self._background_delete_non_state_event_auth
         )
 
+        self.db_pool.updates.register_background_update_handler(
+            self.CHAIN_COVER_INDEX, self._background_chain_cover_index
+        )
+
     async def clean_room_for_join(self, room_id):
         return await self.db_pool.runInteraction(
             "clean_room_for_join", self._clean_room_for_join_txn, room_id
@@ -754,3 +1097,130 @@ class EventFederationStore(EventFederationWorkerStore):
             )
 
         return batch_size
+
+    async def _background_chain_cover_index(self, progress: dict, batch_size: int):
+        """Adds the state events of rooms which predate the chain cover index to
+        the index, a room at a time.
+        """
+
+        current_room_id = progress.get("current_room_id", "")
+
+        # Where we've got to within the current room, as a (depth, stream
+        # ordering) pair.
+        last_depth = progress.get("last_depth", -1)
+        last_stream = progress.get("last_stream", -1)
+
+        def _calculate_chain_cover_txn(txn: LoggingTransaction) -> Optional[int]:
+            if not current_room_id:
+                # Find the next room which doesn't have the index yet.
+                txn.execute(
+                    """
+                    SELECT room_id FROM rooms
+                    WHERE (has_auth_chain_index IS NULL OR NOT has_auth_chain_index)
+                    ORDER BY room_id
+                    LIMIT 1
+                    """
+                )
+                row = txn.fetchone()
+                if not row:
+                    return None
+
+                room_id = row[0]
+                depth, stream = -1, -1
+            else:
+                room_id = current_room_id
+                depth, stream = last_depth, last_stream
+
+            # We fetch the room's state events in topological order, so that we
+            # generally see auth events before the events that cite them.
+            sql = """
+                SELECT event_id, events.type, state_key,
+                    topological_ordering, stream_ordering
+                FROM events
+                INNER JOIN state_events USING (event_id)
+                WHERE events.room_id = ?
+                    AND (topological_ordering > ?
+                        OR (topological_ordering = ? AND stream_ordering > ?))
+                ORDER BY topological_ordering, stream_ordering
+                LIMIT ?
+            """
+            txn.execute(sql, (room_id, depth, depth, stream, batch_size))
+            rows = txn.fetchall()
+
+            if not rows:
+                # We've finished this room, so it can now use the index. Any
+                # state events persisted while we were working through it will
+                # have been queued or will be picked up when a later event cites
+                # them.
+                self.db_pool.simple_update_txn(
+                    txn,
+                    table="rooms",
+                    keyvalues={"room_id": room_id},
+                    updatevalues={"has_auth_chain_index": True},
+                )
+                new_progress = {"current_room_id": ""}
+            else:
+                event_to_types = {
+                    event_id: (event_type, state_key)
+                    for event_id, event_type, state_key, _, _ in rows
+                }
+
+                event_to_auth_chain = {}  # type: Dict[str, List[str]]
+                for auth_row in self.db_pool.simple_select_many_txn(
+                    txn,
+                    table="event_auth",
+                    column="event_id",
+                    iterable=event_to_types,
+                    keyvalues={},
+                    retcols=("event_id", "auth_id"),
+                ):
+                    event_to_auth_chain.setdefault(auth_row["event_id"], []).append(
+                        auth_row["auth_id"]
+                    )
+
+                # Events from earlier batches (or persisted concurrently) may
+                # already be in the index.
+                already_indexed = self.db_pool.simple_select_many_txn(
+                    txn,
+                    table="event_auth_chains",
+                    column="event_id",
+                    iterable=event_to_types,
+                    keyvalues={},
+                    retcols=("event_id",),
+                )
+                for indexed_row in already_indexed:
+                    event_to_types.pop(indexed_row["event_id"], None)
+                    event_to_auth_chain.pop(indexed_row["event_id"], None)
+
+                if event_to_types:
+                    PersistEventsStore._add_chain_cover_index(
+                        txn,
+                        self.db_pool,
+                        self._event_chain_id_gen,
+                        {event_id: room_id for event_id in event_to_types},
+                        event_to_types,
+                        event_to_auth_chain,
+                    )
+
+                _, _, _, last_row_depth, last_row_stream = rows[-1]
+                new_progress = {
+                    "current_room_id": room_id,
+                    "last_depth": last_row_depth,
+                    "last_stream": last_row_stream,
+                }
+
+            self.db_pool.updates._background_update_progress_txn(
+                txn, self.CHAIN_COVER_INDEX, new_progress
+            )
+
+            return len(rows)
+
+        result = await self.db_pool.runInteraction(
+            "_background_chain_cover_index", _calculate_chain_cover_txn
+        )
+
+        if result is None:
+            await self.db_pool.updates._end_background_update(self.CHAIN_COVER_INDEX)
+            return 1
+
+        return max(result, 1)
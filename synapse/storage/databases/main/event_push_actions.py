@@ -18,6 +18,10 @@ from typing import Dict, List, Optional, Tuple, Union
 
 import attr
 
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+from synapse.logging.context import make_deferred_yieldable
 from synapse.metrics.background_process_metrics import wrap_as_background_process
 from synapse.storage._base import SQLBaseStore, db_to_json
 from synapse.storage.database import DatabasePool, LoggingTransaction
@@ -119,6 +123,78 @@ class EventPushActionsWorkerStore(SQLBaseStore):
             last_read_event_id,
         )
 
+    async def get_unread_event_push_actions_by_rooms_for_user(
+        self, user_id: str, last_read_event_ids: Dict[str, Optional[str]]
+    ) -> Dict[str, Dict[str, int]]:
+        """Get the notification, highlight and unread message counts for a user
+        in several rooms, as returned by
+        `get_unread_event_push_actions_by_room_for_user`.
+
+        Counts which are cached are returned from the cache, and the rest are
+        calculated in a single transaction and added to the cache.
+
+        This works like a `cachedList` over
+        `get_unread_event_push_actions_by_room_for_user`, which can't be used
+        directly as the read receipt, which is part of the cache key, differs
+        between rooms.
+
+        Args:
+            user_id: The user to retrieve the counts for.
+            last_read_event_ids: Map from the rooms to retrieve the counts in, to
+                the event associated with the user's latest read receipt in the
+                room, or None if there is no receipt.
+
+        Returns:
+            A map from room ID to the counts.
+        """
+        cache = self.get_unread_event_push_actions_by_room_for_user.cache
+
+        results = {}  # type: Dict[str, Dict[str, int]]
+        missing = {}  # type: Dict[str, Optional[str]]
+        for room_id, last_read_event_id in last_read_event_ids.items():
+            try:
+                d = cache.get((room_id, user_id, last_read_event_id))
+            except KeyError:
+                missing[room_id] = last_read_event_id
+                continue
+            results[room_id] = await make_deferred_yieldable(d)
+
+        if not missing:
+            return results
+
+        # Add pending entries to the cache before querying, so that they are
+        # discarded if they are invalidated while we query.
+        deferreds = {}  # type: Dict[str, defer.Deferred]
+        for room_id, last_read_event_id in missing.items():
+            deferreds[room_id] = defer.Deferred()
+            cache.set((room_id, user_id, last_read_event_id), deferreds[room_id])
+
+        def _get_unread_counts_by_receipts_txn(txn):
+            return {
+                room_id: self._get_unread_counts_by_receipt_txn(
+                    txn, room_id, user_id, last_read_event_id
+                )
+                for room_id, last_read_event_id in missing.items()
+            }
+
+        try:
+            counts = await self.db_pool.runInteraction(
+                "get_unread_event_push_actions_by_rooms",
+                _get_unread_counts_by_receipts_txn,
+            )
+        except Exception:
+            f = Failure()
+            for room_id, last_read_event_id in missing.items():
+                cache.invalidate((room_id, user_id, last_read_event_id))
+                deferreds[room_id].errback(f)
+            raise
+
+        for room_id, room_counts in counts.items():
+            deferreds[room_id].callback(room_counts)
+            results[room_id] = room_counts
+
+        return results
+
     def _get_unread_counts_by_receipt_txn(
         self, txn, room_id, user_id, last_read_event_id,
     ):
@@ -19,6 +19,7 @@ from collections import namedtuple
 from typing import Dict, Iterable, List, Optional, Tuple, overload
 
 from constantly import NamedConstant, Names
+from prometheus_client import Counter
 from typing_extensions import Literal
 
 from twisted.internet import defer
@@ -32,8 +33,12 @@ from synapse.api.room_versions import (
 )
 from synapse.events import EventBase, make_event_from_dict
 from synapse.events.snapshot import EventContext
-from synapse.events.utils import prune_event
-from synapse.logging.context import PreserveLoggingContext, current_context
+from synapse.events.utils import prune_event_dict
+from synapse.logging.context import (
+    PreserveLoggingContext,
+    current_context,
+    make_deferred_yieldable,
+)
 from synapse.metrics.background_process_metrics import (
     run_as_background_process,
     wrap_as_background_process,
@@ -46,6 +51,8 @@ from synapse.storage.database import DatabasePool
 from synapse.storage.engines import PostgresEngine
 from synapse.storage.util.id_generators import MultiWriterIdGenerator, StreamIdGenerator
 from synapse.types import Collection, JsonDict, get_domain_from_id
+from synapse.util import unwrapFirstError
+from synapse.util.async_helpers import ObservableDeferred
 from synapse.util.caches.descriptors import cached
 from synapse.util.caches.lrucache import LruCache
 from synapse.util.iterutils import batch_iter
@@ -64,6 +71,15 @@ EVENT_QUEUE_ITERATIONS = 3  # No. times we block waiting for requests for events
 EVENT_QUEUE_TIMEOUT_S = 0.1  # Timeout when waiting for requests for events
 
 
+# The number of events requested from the DB by `_get_events_from_cache_or_db`
+# which were actually fetched, vs. the number which piggy-backed on an
+# in-flight fetch for the same event started by a concurrent caller.
+event_fetch_from_db_counter = Counter("synapse_storage_events_fetched_from_db", "")
+event_fetch_deduplicated_counter = Counter(
+    "synapse_storage_events_fetch_deduplicated", ""
+)
+
+
 _EventCacheEntry = namedtuple("_EventCacheEntry", ("event", "redacted_event"))
 
 
@@ -157,6 +173,11 @@ class EventsWorkerStore(SQLBaseStore):
         self._event_fetch_list = []
         self._event_fetch_ongoing = 0
 
+        # Map from event ID to a deferred that will result in a map from event
+        # ID to cache entry. Note that the returned dict may not have the
+        # requested event in it if the event isn't in the DB.
+        self._current_event_fetches = {}  # type: Dict[str, ObservableDeferred]
+
     def process_replication_rows(self, stream_name, instance_name, token, rows):
         if stream_name == EventsStream.NAME:
             self._stream_id_gen.advance(instance_name, token)
@@ -475,23 +496,82 @@ class EventsWorkerStore(SQLBaseStore):
             event_ids, allow_rejected=allow_rejected
         )
 
-        missing_events_ids = [e for e in event_ids if e not in event_entry_map]
+        missing_events_ids = {e for e in event_ids if e not in event_entry_map}
+
+        # We now look up if we're already fetching some of the events in the DB,
+        # if so we wait for those lookups to finish instead of pulling the same
+        # events out of the DB multiple times.
+        already_fetching = {}  # type: Dict[str, defer.Deferred]
+
+        for event_id in missing_events_ids:
+            deferred = self._current_event_fetches.get(event_id)
+            if deferred is not None:
+                # We're already pulling the event out of the DB. Add the deferred
+                # to the collection of deferreds to wait on.
+                already_fetching[event_id] = deferred.observe()
+
+        missing_events_ids.difference_update(already_fetching)
+
+        if already_fetching:
+            event_fetch_deduplicated_counter.inc(len(already_fetching))
 
         if missing_events_ids:
             log_ctx = current_context()
             log_ctx.record_event_fetch(len(missing_events_ids))
+            event_fetch_from_db_counter.inc(len(missing_events_ids))
+
+            # Add entries to `self._current_event_fetches` for each event we're
+            # going to pull from the DB. We use a single deferred that resolves
+            # to all the events we pulled from the DB (this will result in this
+            # function returning more events than requested, but that can happen
+            # already due to `_get_events_from_db`).
+            fetching_deferred = ObservableDeferred(defer.Deferred(), consumeErrors=True)
+            for event_id in missing_events_ids:
+                self._current_event_fetches[event_id] = fetching_deferred
 
             # Note that _get_events_from_db is also responsible for turning db rows
             # into FrozenEvents (via _get_event_from_row), which involves seeing if
             # the events have been redacted, and if so pulling the redaction event out
             # of the database to check it.
             #
-            missing_events = await self._get_events_from_db(
-                missing_events_ids, allow_rejected=allow_rejected
-            )
+            # We always fetch rejected events here, since the results may be
+            # shared with concurrent callers which do want them; they are
+            # filtered out below if necessary.
+            try:
+                missing_events = await self._get_events_from_db(
+                    missing_events_ids, allow_rejected=True
+                )
+            except Exception as e:
+                with PreserveLoggingContext():
+                    fetching_deferred.errback(e)
+                raise
+            finally:
+                # Ensure that we mark these events as no longer being fetched.
+                for event_id in missing_events_ids:
+                    self._current_event_fetches.pop(event_id, None)
+
+            with PreserveLoggingContext():
+                fetching_deferred.callback(missing_events)
 
             event_entry_map.update(missing_events)
 
+        if already_fetching:
+            # Wait for the other event requests to finish and add their results
+            # to ours.
+            results = await make_deferred_yieldable(
+                defer.gatherResults(list(already_fetching.values()), consumeErrors=True)
+            ).addErrback(unwrapFirstError)
+
+            for result in results:
+                event_entry_map.update(result)
+
+        if not allow_rejected:
+            event_entry_map = {
+                event_id: entry
+                for event_id, entry in event_entry_map.items()
+                if entry and not entry.event.rejected_reason
+            }
+
         return event_entry_map
 
     def _invalidate_get_event_cache(self, event_id):
@@ -948,6 +1028,8 @@ class EventsWorkerStore(SQLBaseStore):
 
         Returns:
             If the event should be redacted, a pruned event object. Otherwise, None.
+            If the stored event has already been pruned, this will be `original_ev`
+            itself (now marked as redacted), so that only one copy is cached.
         """
         if original_ev.type == "m.room.create":
             # we choose to ignore redactions of m.room.create events.
@@ -993,7 +1075,28 @@ class EventsWorkerStore(SQLBaseStore):
             logger.debug("Redacting %s due to %s", original_ev.event_id, redaction_id)
 
             # we found a good redaction event. Redact!
-            redacted_event = prune_event(original_ev)
+            original_dict = original_ev.get_dict()
+            pruned_event_dict = prune_event_dict(
+                original_ev.room_version, original_dict
+            )
+
+            if pruned_event_dict == original_dict:
+                # Pruning doesn't change anything, which happens if the stored
+                # JSON has already been pruned (e.g. because the event has been
+                # censored). Rather than building and caching a second, identical
+                # copy of the event we just mark the original as redacted.
+                redacted_event = original_ev
+            else:
+                redacted_event = make_event_from_dict(
+                    pruned_event_dict,
+                    original_ev.room_version,
+                    original_ev.internal_metadata.get_dict(),
+                )
+                redacted_event.internal_metadata.stream_ordering = (
+                    original_ev.internal_metadata.stream_ordering
+                )
+
+            redacted_event.internal_metadata.redacted = True
             redacted_event.unsigned["redacted_by"] = redaction_id
 
             # It's fine to add the event directly, since get_pdu_json
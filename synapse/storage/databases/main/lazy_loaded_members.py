@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import logging
+from typing import Collection, Dict, List, Tuple
+
+from synapse.metrics.background_process_metrics import wrap_as_background_process
+from synapse.storage._base import SQLBaseStore
+from synapse.storage.database import DatabasePool, LoggingTransaction
+
+logger = logging.getLogger(__name__)
+
+# The number of bytes of the hash of each member event ID to store.
+MEMBER_HASH_LENGTH = 8
+
+# The maximum number of members to remember sending to a device in a room.
+# Beyond this the oldest are forgotten (and so may be sent again).
+MAX_LAZY_LOADED_MEMBERS_SENT_PER_ROOM = 10000
+
+# The maximum number of stale rows to delete in one go.
+STALE_LAZY_LOADED_MEMBERS_BATCH_SIZE = 1000
+
+
+def hash_member_event_id(event_id: str) -> bytes:
+    """Get the compact representation of a member event ID which is stored in
+    `lazy_loaded_members_sent`.
+    """
+    return hashlib.sha256(event_id.encode("utf-8")).digest()[:MEMBER_HASH_LENGTH]
+
+
+def _split_member_hashes(members: bytes) -> List[bytes]:
+    return [
+        members[i : i + MEMBER_HASH_LENGTH]
+        for i in range(0, len(members), MEMBER_HASH_LENGTH)
+    ]
+
+
+class LazyLoadedMembersStore(SQLBaseStore):
+    """Stores which member events have been sent to devices which lazy-load
+    members, so that syncs don't send them again.
+
+    The member event IDs are stored as (truncated) hashes, which are produced
+    by `hash_member_event_id`.
+    """
+
+    def __init__(self, database: DatabasePool, db_conn, hs):
+        super().__init__(database, db_conn, hs)
+
+        self._lazy_loaded_members_max_age_ms = (
+            hs.config.lazy_loaded_members_persistence_max_age_ms
+        )
+
+        if (
+            hs.config.lazy_loaded_members_persistence_enabled
+            and hs.config.run_background_tasks
+        ):
+            self._clock.looping_call(
+                self._delete_stale_lazy_loaded_members_sent, 60 * 60 * 1000
+            )
+
+    async def get_lazy_loaded_members_sent(
+        self, user_id: str, device_id: str, room_id: str
+    ) -> List[bytes]:
+        """Get the member events which have been sent to a device in a room.
+
+        Args:
+            user_id
+            device_id
+            room_id
+
+        Returns:
+            The hashes of the member event IDs, oldest first.
+        """
+        row = await self.db_pool.simple_select_one(
+            table="lazy_loaded_members_sent",
+            keyvalues={"user_id": user_id, "device_id": device_id, "room_id": room_id},
+            retcols=("members", "last_used_ts"),
+            allow_none=True,
+            desc="get_lazy_loaded_members_sent",
+        )
+        if (
+            row is None
+            or row["last_used_ts"]
+            < self._clock.time_msec() - self._lazy_loaded_members_max_age_ms
+        ):
+            return []
+
+        return _split_member_hashes(bytes(row["members"]))
+
+    async def update_lazy_loaded_members_sent(
+        self, updates: Dict[Tuple[str, str, str], Tuple[bool, Collection[bytes]]]
+    ) -> None:
+        """Record that member events have been sent to devices.
+
+        Args:
+            updates: A map from (user ID, device ID, room ID) to whether to
+                forget the members previously sent to the device in the room,
+                and the hashes of the member event IDs which have been sent.
+        """
+
+        def _update_lazy_loaded_members_sent_txn(txn: LoggingTransaction):
+            now = self._clock.time_msec()
+
+            for (user_id, device_id, room_id), (reset, hashes) in updates.items():
+                keyvalues = {
+                    "user_id": user_id,
+                    "device_id": device_id,
+                    "room_id": room_id,
+                }
+
+                members = []  # type: List[bytes]
+                if not reset:
+                    row = self.db_pool.simple_select_one_txn(
+                        txn,
+                        table="lazy_loaded_members_sent",
+                        keyvalues=keyvalues,
+                        retcols=("members", "last_used_ts"),
+                        allow_none=True,
+                    )
+                    if (
+                        row is not None
+                        and row["last_used_ts"]
+                        >= now - self._lazy_loaded_members_max_age_ms
+                    ):
+                        members = _split_member_hashes(bytes(row["members"]))
+
+                existing = set(members)
+                members.extend(h for h in hashes if h not in existing)
+                members = members[-MAX_LAZY_LOADED_MEMBERS_SENT_PER_ROOM:]
+
+                self.db_pool.simple_upsert_txn(
+                    txn,
+                    table="lazy_loaded_members_sent",
+                    keyvalues=keyvalues,
+                    values={"members": b"".join(members), "last_used_ts": now},
+                    lock=False,
+                )
+
+        await self.db_pool.runInteraction(
+            "update_lazy_loaded_members_sent", _update_lazy_loaded_members_sent_txn
+        )
+
+    @wrap_as_background_process("delete_stale_lazy_loaded_members_sent")
+    async def _delete_stale_lazy_loaded_members_sent(self) -> None:
+        def _delete_stale_lazy_loaded_members_sent_txn(txn: LoggingTransaction) -> int:
+            txn.execute(
+                "SELECT user_id, device_id, room_id FROM lazy_loaded_members_sent"
+                " WHERE last_used_ts < ? LIMIT ?",
+                (
+                    self._clock.time_msec() - self._lazy_loaded_members_max_age_ms,
+                    STALE_LAZY_LOADED_MEMBERS_BATCH_SIZE,
+                ),
+            )
+            rows = txn.fetchall()
+            for user_id, device_id, room_id in rows:
+                self.db_pool.simple_delete_txn(
+                    txn,
+                    table="lazy_loaded_members_sent",
+                    keyvalues={
+                        "user_id": user_id,
+                        "device_id": device_id,
+                        "room_id": room_id,
+                    },
+                )
+            return len(rows)
+
+        while True:
+            deleted = await self.db_pool.runInteraction(
+                "_delete_stale_lazy_loaded_members_sent",
+                _delete_stale_lazy_loaded_members_sent_txn,
+            )
+            if deleted < STALE_LAZY_LOADED_MEMBERS_BATCH_SIZE:
+                break
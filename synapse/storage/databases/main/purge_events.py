@@ -313,6 +313,7 @@ class PurgeEventsStore(StateGroupWorkerStore, SQLBaseStore):
         # Now we delete tables which lack an index on room_id but have one on event_id
         for table in (
             "event_auth",
+            "event_auth_chains",
             "event_edges",
             "event_json",
             "event_push_actions_staging",
@@ -339,6 +340,7 @@ class PurgeEventsStore(StateGroupWorkerStore, SQLBaseStore):
         for table in (
             "current_state_events",
             "destination_rooms",
+            "event_auth_chain_to_calculate",
             "event_backward_extremities",
             "event_forward_extremities",
             "event_push_actions",
@@ -356,6 +358,7 @@ class PurgeEventsStore(StateGroupWorkerStore, SQLBaseStore):
             "room_stats_historical",
             "room_stats_earliest_token",
             "rooms",
+            "state_resolution_cache",
             "stream_ordering_to_exterm",
             "users_in_public_rooms",
             "users_who_share_private_rooms",
@@ -14,20 +14,22 @@
 # limitations under the License.
 
 import logging
-from typing import Optional
+from typing import Dict, Optional
 
 import attr
 
 from synapse.api.constants import RelationTypes
 from synapse.events import EventBase
-from synapse.storage._base import SQLBaseStore
+from synapse.storage._base import SQLBaseStore, make_in_list_sql_clause
 from synapse.storage.databases.main.stream import generate_pagination_where_clause
 from synapse.storage.relations import (
     AggregationPaginationToken,
     PaginationChunk,
     RelationPaginationToken,
 )
-from synapse.util.caches.descriptors import cached
+from synapse.types import Collection
+from synapse.util.caches.descriptors import cached, cachedList
+from synapse.util.iterutils import batch_iter
 
 logger = logging.getLogger(__name__)
 
@@ -270,6 +272,118 @@ class RelationsWorkerStore(SQLBaseStore):
 
         return await self.get_event(edit_id, allow_none=True)
 
+    @cachedList(cached_method_name="get_applicable_edit", list_name="event_ids")
+    async def get_applicable_edits(
+        self, event_ids: Collection[str]
+    ) -> Dict[str, Optional[EventBase]]:
+        """Get the most recent edit (if any) that has happened for the given
+        events.
+
+        Correctly handles checking whether edits were allowed to happen.
+
+        Args:
+            event_ids: The original event IDs
+
+        Returns:
+            A map of the original event IDs to their most recent edit, if any.
+        """
+
+        # See `get_applicable_edit` for the constraints on edits. We fetch every
+        # applicable edit in ascending order, so the last one we see for each
+        # original event is the most recent.
+        sql = """
+            SELECT original.event_id, edit.event_id FROM events AS edit
+            INNER JOIN event_relations USING (event_id)
+            INNER JOIN events AS original ON
+                original.event_id = relates_to_id
+                AND edit.type = original.type
+                AND edit.sender = original.sender
+            WHERE
+                %s
+                AND relation_type = ?
+                AND edit.type = 'm.room.message'
+            ORDER by edit.origin_server_ts, edit.event_id
+        """
+
+        def _get_applicable_edits_txn(txn):
+            edit_ids = {}
+            for batch in batch_iter(event_ids, 100):
+                clause, args = make_in_list_sql_clause(
+                    self.database_engine, "relates_to_id", batch
+                )
+                args.append(RelationTypes.REPLACE)
+
+                txn.execute(sql % (clause,), args)
+                edit_ids.update(dict(txn))
+
+            return edit_ids
+
+        edit_ids = await self.db_pool.runInteraction(
+            "get_applicable_edits", _get_applicable_edits_txn
+        )
+
+        edits = await self.get_events(edit_ids.values())
+
+        return {event_id: edits.get(edit_ids.get(event_id)) for event_id in event_ids}
+
+    @cached()
+    async def event_has_relations(self, event_id: str) -> bool:
+        """Check whether any events relate to the given event.
+
+        This is a cheap check that allows us to avoid fetching the aggregations
+        for the (vast majority of) events which have none.
+
+        Args:
+            event_id: The event ID to check.
+
+        Returns:
+            True if there is at least one event which relates to the event.
+        """
+        sql = "SELECT 1 FROM event_relations WHERE relates_to_id = ? LIMIT 1"
+
+        def _event_has_relations_txn(txn):
+            txn.execute(sql, (event_id,))
+            return bool(txn.fetchone())
+
+        return await self.db_pool.runInteraction(
+            "event_has_relations", _event_has_relations_txn
+        )
+
+    @cachedList(cached_method_name="event_has_relations", list_name="event_ids")
+    async def events_have_relations(
+        self, event_ids: Collection[str]
+    ) -> Dict[str, bool]:
+        """Check which of the given events have other events relating to them.
+
+        Args:
+            event_ids: The event IDs to check.
+
+        Returns:
+            A map of the event IDs to whether there is at least one event which
+            relates to them.
+        """
+
+        def _events_have_relations_txn(txn):
+            related_event_ids = set()
+            for batch in batch_iter(event_ids, 100):
+                clause, args = make_in_list_sql_clause(
+                    self.database_engine, "relates_to_id", batch
+                )
+                txn.execute(
+                    "SELECT DISTINCT relates_to_id FROM event_relations WHERE %s"
+                    % (clause,),
+                    args,
+                )
+                related_event_ids.update(row[0] for row in txn)
+
+            return related_event_ids
+
+        related_event_ids = await self.db_pool.runInteraction(
+            "events_have_relations", _events_have_relations_txn
+        )
+
+        return {event_id: event_id in related_event_ids for event_id in event_ids}
+
     async def has_user_annotated_event(
         self, parent_id: str, event_type: str, aggregation_key: str, sender: str
     ) -> bool:
@@ -38,6 +38,7 @@ from synapse.types import Collection, PersistedEventPosition, get_domain_from_id
 from synapse.util.async_helpers import Linearizer
 from synapse.util.caches import intern_string
 from synapse.util.caches.descriptors import _CacheContext, cached, cachedList
+from synapse.util.iterutils import batch_iter
 from synapse.util.metrics import Measure
 
 if TYPE_CHECKING:
@@ -440,6 +441,68 @@ class RoomMemberWorkerStore(EventsWorkerStore):
             for room_id, instance, stream_id in txn
         )
 
+    @cachedList(
+        cached_method_name="get_rooms_for_user_with_stream_ordering",
+        list_name="user_ids",
+    )
+    async def get_rooms_for_users_with_stream_ordering(
+        self, user_ids: Collection[str]
+    ) -> Dict[str, FrozenSet[GetRoomsForUserWithStreamOrdering]]:
+        """A batched version of `get_rooms_for_user_with_stream_ordering`.
+
+        Returns:
+            Map from user_id to set of rooms that is currently in.
+        """
+        return await self.db_pool.runInteraction(
+            "get_rooms_for_users_with_stream_ordering",
+            self._get_rooms_for_users_with_stream_ordering_txn,
+            user_ids,
+        )
+
+    def _get_rooms_for_users_with_stream_ordering_txn(
+        self, txn, user_ids: Collection[str]
+    ) -> Dict[str, FrozenSet[GetRoomsForUserWithStreamOrdering]]:
+        if self._current_state_events_membership_up_to_date:
+            sql = """
+                SELECT c.state_key, room_id, e.instance_name, e.stream_ordering
+                FROM current_state_events AS c
+                INNER JOIN events AS e USING (room_id, event_id)
+                WHERE
+                    c.type = 'm.room.member'
+                    AND c.membership = ?
+                    AND %s
+            """
+        else:
+            sql = """
+                SELECT c.state_key, room_id, e.instance_name, e.stream_ordering
+                FROM current_state_events AS c
+                INNER JOIN room_memberships AS m USING (room_id, event_id)
+                INNER JOIN events AS e USING (room_id, event_id)
+                WHERE
+                    c.type = 'm.room.member'
+                    AND m.membership = ?
+                    AND %s
+            """
+
+        result = {}  # type: Dict[str, Set[GetRoomsForUserWithStreamOrdering]]
+        for user_id in user_ids:
+            result[user_id] = set()
+
+        for chunk in batch_iter(user_ids, 500):
+            clause, args = make_in_list_sql_clause(
+                self.database_engine, "c.state_key", chunk
+            )
+            txn.execute(sql % (clause,), [Membership.JOIN] + args)
+
+            for user_id, room_id, instance, stream_id in txn:
+                result[user_id].add(
+                    GetRoomsForUserWithStreamOrdering(
+                        room_id, PersistedEventPosition(instance, stream_id)
+                    )
+                )
+
+        return {user_id: frozenset(rooms) for user_id, rooms in result.items()}
+
     async def get_users_server_still_shares_room_with(
         self, user_ids: Collection[str]
     ) -> Set[str]:
@@ -484,6 +547,32 @@ class RoomMemberWorkerStore(EventsWorkerStore):
         )
         return frozenset(r.room_id for r in rooms)
 
+    async def filter_users_who_share_room_with_user(
+        self, user_id: str, other_user_ids: Collection[str]
+    ) -> Set[str]:
+        """Returns which of `other_user_ids` share a room with `user_id`.
+
+        This looks up the rooms of each of the other users, rather than all the
+        members of the user's rooms, so is much cheaper than
+        `get_users_who_share_room_with_user` when the other users are few and
+        the user's rooms are large.
+        """
+        if not other_user_ids:
+            return set()
+
+        room_ids = await self.get_rooms_for_user(user_id)
+        if not room_ids:
+            return set()
+
+        rooms_by_user = await self.get_rooms_for_users_with_stream_ordering(
+            other_user_ids
+        )
+        return {
+            other_user_id
+            for other_user_id, rooms in rooms_by_user.items()
+            if any(r.room_id in room_ids for r in rooms)
+        }
+
     @cached(max_entries=500000, cache_context=True, iterable=True)
     async def get_users_who_share_room_with_user(
         self, user_id: str, cache_context: _CacheContext
@@ -0,0 +1,58 @@
+/* Copyright 2020 The Matrix.org Foundation C.I.C
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- A chain cover index of the auth graph of state events, used to calculate
+-- auth chains and auth chain differences without walking the graph. See
+-- docs/auth_chain_difference_algorithm.md for details.
+
+-- Every indexed state event is in exactly one chain. Each event in a chain is
+-- in the auth chain of every event later in the same chain.
+CREATE TABLE IF NOT EXISTS event_auth_chains (
+  event_id TEXT PRIMARY KEY,
+  chain_id BIGINT NOT NULL,
+  sequence_number BIGINT NOT NULL
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS event_auth_chains_c_seq_index ON event_auth_chains (chain_id, sequence_number);
+
+-- Links between chains. The event at the origin chain and sequence number (and
+-- so every later event in the origin chain) has the event at the target chain
+-- and sequence number (and so every earlier event in the target chain) in its
+-- auth chain.
+CREATE TABLE IF NOT EXISTS event_auth_chain_links (
+  origin_chain_id BIGINT NOT NULL,
+  origin_sequence_number BIGINT NOT NULL,
+
+  target_chain_id BIGINT NOT NULL,
+  target_sequence_number BIGINT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS event_auth_chain_links_idx ON event_auth_chain_links (origin_chain_id, target_chain_id);
+
+-- State events that we have persisted but couldn't add to the index because
+-- we didn't have their auth chain, e.g. out of band memberships.
+CREATE TABLE IF NOT EXISTS event_auth_chain_to_calculate (
+  event_id TEXT PRIMARY KEY,
+  room_id TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS event_auth_chain_to_calculate_rm_id ON event_auth_chain_to_calculate(room_id);
+
+-- Whether every state event in the room has been added to the index (or the
+-- queue above). New events are only added to the index for such rooms.
+ALTER TABLE rooms ADD COLUMN has_auth_chain_index BOOLEAN;
+
+INSERT INTO background_updates (ordering, update_name, progress_json) VALUES
+  (5825, 'chain_cover', '{}');
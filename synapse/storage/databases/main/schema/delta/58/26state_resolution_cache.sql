@@ -0,0 +1,32 @@
+/* Copyright 2020 The Matrix.org Foundation C.I.C
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- The results of resolving the state of sets of state groups, so that they can
+-- be shared between workers and survive restarts.
+--
+-- `state_groups` is the sorted, comma separated list of the state groups that
+-- were resolved. The result is stored as a delta against one of those groups,
+-- `prev_group`: `delta_json` is a list of [type, state_key, event_id] triples,
+-- where a null event_id means that the entry was removed.
+CREATE TABLE IF NOT EXISTS state_resolution_cache (
+    state_groups TEXT NOT NULL PRIMARY KEY,
+    room_id TEXT NOT NULL,
+    prev_group BIGINT NOT NULL,
+    delta_json TEXT NOT NULL,
+    inserted_ts BIGINT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS state_resolution_cache_ts ON state_resolution_cache(inserted_ts);
+CREATE INDEX IF NOT EXISTS state_resolution_cache_room_id ON state_resolution_cache(room_id);
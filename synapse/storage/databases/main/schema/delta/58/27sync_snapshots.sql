@@ -0,0 +1,42 @@
+/* Copyright 2020 The Matrix.org Foundation C.I.C
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+
+-- Snapshots of the rooms section of users' initial syncs, so that the entries
+-- for rooms which haven't changed can be reused by later initial syncs.
+--
+-- There is a snapshot for each filter (and set of ignored users) a user syncs
+-- with, identified by `filter_key`.
+CREATE TABLE IF NOT EXISTS sync_snapshots (
+    user_id TEXT NOT NULL,
+    filter_key TEXT NOT NULL,
+    last_used_ts BIGINT NOT NULL
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS sync_snapshots_key ON sync_snapshots(user_id, filter_key);
+CREATE INDEX IF NOT EXISTS sync_snapshots_last_used_ts ON sync_snapshots(last_used_ts);
+
+-- The entries of each snapshot. `stream_ordering` is the position in the
+-- events stream that the entry is correct as of, and `entry_json` lists the
+-- event IDs of the room's timeline and state.
+CREATE TABLE IF NOT EXISTS sync_snapshot_rooms (
+    user_id TEXT NOT NULL,
+    filter_key TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    stream_ordering BIGINT NOT NULL,
+    entry_json TEXT NOT NULL
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS sync_snapshot_rooms_key ON sync_snapshot_rooms(user_id, filter_key, room_id);
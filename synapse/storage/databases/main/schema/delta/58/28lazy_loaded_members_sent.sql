@@ -0,0 +1,32 @@
+/* Copyright 2020 The Matrix.org Foundation C.I.C
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+
+-- The member events which have been sent to each device which lazy-loads
+-- members, so that they aren't sent again after a restart or when the
+-- device's syncs move to a different worker.
+--
+-- To keep this compact, `members` is the concatenation of the first 8 bytes
+-- of the SHA-256 hash of each member event ID, oldest first.
+CREATE TABLE IF NOT EXISTS lazy_loaded_members_sent (
+    user_id TEXT NOT NULL,
+    device_id TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    members BYTEA NOT NULL,
+    last_used_ts BIGINT NOT NULL
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS lazy_loaded_members_sent_key ON lazy_loaded_members_sent(user_id, device_id, room_id);
+CREATE INDEX IF NOT EXISTS lazy_loaded_members_sent_last_used_ts ON lazy_loaded_members_sent(last_used_ts);
@@ -16,18 +16,20 @@
 import collections.abc
 import logging
 from collections import namedtuple
-from typing import Iterable, Optional, Set
+from typing import Iterable, Optional, Set, Tuple
 
 from synapse.api.constants import EventTypes, Membership
 from synapse.api.errors import NotFoundError, UnsupportedRoomVersionError
 from synapse.api.room_versions import KNOWN_ROOM_VERSIONS, RoomVersion
 from synapse.events import EventBase
-from synapse.storage._base import SQLBaseStore
+from synapse.metrics.background_process_metrics import wrap_as_background_process
+from synapse.storage._base import SQLBaseStore, db_to_json
 from synapse.storage.database import DatabasePool
 from synapse.storage.databases.main.events_worker import EventsWorkerStore
 from synapse.storage.databases.main.roommember import RoomMemberWorkerStore
 from synapse.storage.state import StateFilter
-from synapse.types import StateMap
+from synapse.types import Collection, StateMap
+from synapse.util import json_encoder
 from synapse.util.caches import intern_string
 from synapse.util.caches.descriptors import cached, cachedList
 
@@ -36,6 +38,10 @@ logger = logging.getLogger(__name__)
 
 MAX_STATE_DELTA_HOPS = 100
 
+# How long we keep the results of state resolutions in the
+# `state_resolution_cache` table.
+STATE_RESOLUTION_CACHE_MAX_AGE_MS = 7 * 24 * 60 * 60 * 1000
+
 
 class _GetStateGroupDelta(
     namedtuple("_GetStateGroupDelta", ("prev_group", "delta_ids"))
@@ -58,6 +64,11 @@ class StateGroupWorkerStore(EventsWorkerStore, SQLBaseStore):
     def __init__(self, database: DatabasePool, db_conn, hs):
         super().__init__(database, db_conn, hs)
 
+        if hs.config.run_background_tasks:
+            self._clock.looping_call(
+                self._delete_old_state_resolution_results, 60 * 60 * 1000
+            )
+
     async def get_room_version(self, room_id: str) -> RoomVersion:
         """Get the room_version of a given room
 
@@ -312,6 +323,92 @@ class StateGroupWorkerStore(EventsWorkerStore, SQLBaseStore):
 
         return {row["state_group"] for row in rows}
 
+    async def get_state_resolution_result(
+        self, state_groups: Collection[int]
+    ) -> Optional[Tuple[int, StateMap[Optional[str]]]]:
+        """Get the stored result of resolving the state of the given state groups.
+
+        Args:
+            state_groups: the state groups that were resolved
+
+        Returns:
+            None if we have no stored result, otherwise the result as a delta
+            against one of the given state groups: a (prev_group, delta_ids)
+            tuple, where removed entries map to None in `delta_ids`.
+        """
+        row = await self.db_pool.simple_select_one(
+            table="state_resolution_cache",
+            keyvalues={"state_groups": _state_groups_key(state_groups)},
+            retcols=("prev_group", "delta_json"),
+            allow_none=True,
+            desc="get_state_resolution_result",
+        )
+
+        if not row:
+            return None
+
+        delta_ids = {
+            (intern_string(typ), intern_string(state_key)): event_id
+            for typ, state_key, event_id in db_to_json(row["delta_json"])
+        }
+        return row["prev_group"], delta_ids
+
+    async def store_state_resolution_result(
+        self,
+        room_id: str,
+        state_groups: Collection[int],
+        prev_group: int,
+        delta_ids: StateMap[Optional[str]],
+    ) -> None:
+        """Store the result of resolving the state of the given state groups, so
+        that other workers (and future processes) can reuse it.
+
+        Args:
+            room_id: the room the state groups belong to
+            state_groups: the state groups that were resolved
+            prev_group: one of `state_groups`, which `delta_ids` is relative to
+            delta_ids: the difference between the state of `prev_group` and the
+                resolved state. Removed entries should map to None.
+        """
+        await self.db_pool.simple_upsert(
+            table="state_resolution_cache",
+            keyvalues={"state_groups": _state_groups_key(state_groups)},
+            values={
+                "room_id": room_id,
+                "prev_group": prev_group,
+                "delta_json": json_encoder.encode(
+                    [
+                        (typ, state_key, event_id)
+                        for (typ, state_key), event_id in delta_ids.items()
+                    ]
+                ),
+                "inserted_ts": self._clock.time_msec(),
+            },
+            # state_groups is the primary key, so no need to lock when doing
+            # an emulated upsert.
+            lock=False,
+            desc="store_state_resolution_result",
+        )
+
+    @wrap_as_background_process("delete_old_state_resolution_results")
+    async def _delete_old_state_resolution_results(self) -> None:
+        def _delete_old_state_resolution_results_txn(txn):
+            txn.execute(
+                "DELETE FROM state_resolution_cache WHERE inserted_ts < ?",
+                (self._clock.time_msec() - STATE_RESOLUTION_CACHE_MAX_AGE_MS,),
+            )
+
+        await self.db_pool.runInteraction(
+            "_delete_old_state_resolution_results",
+            _delete_old_state_resolution_results_txn,
+        )
+
+
+def _state_groups_key(state_groups: Iterable[int]) -> str:
+    """The key we store the result of resolving the given state groups under.
+    """
+    return ",".join(str(sg) for sg in sorted(state_groups))
+
 
 class MainStateBackgroundUpdateStore(RoomMemberWorkerStore):
 
@@ -40,11 +40,8 @@ import logging
 from collections import namedtuple
 from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple
 
-from twisted.internet import defer
-
 from synapse.api.filtering import Filter
 from synapse.events import EventBase
-from synapse.logging.context import make_deferred_yieldable, run_in_background
 from synapse.storage._base import SQLBaseStore
 from synapse.storage.database import (
     DatabasePool,
@@ -55,7 +52,7 @@ from synapse.storage.databases.main.events_worker import EventsWorkerStore
 from synapse.storage.engines import BaseDatabaseEngine, PostgresEngine
 from synapse.storage.util.id_generators import MultiWriterIdGenerator
 from synapse.types import Collection, PersistedEventPosition, RoomStreamToken
-from synapse.util.caches.descriptors import cached
+from synapse.util.caches.descriptors import cached, cachedList
 from synapse.util.caches.stream_change_cache import StreamChangeCache
 
 if TYPE_CHECKING:
@@ -415,28 +412,32 @@ class StreamWorkerStore(EventsWorkerStore, SQLBaseStore, metaclass=abc.ABCMeta):
         if not room_ids:
             return {}
 
-        results = {}
-        room_ids = list(room_ids)
-        for rm_ids in (room_ids[i : i + 20] for i in range(0, len(room_ids), 20)):
-            res = await make_deferred_yieldable(
-                defer.gatherResults(
-                    [
-                        run_in_background(
-                            self.get_room_events_stream_for_room,
-                            room_id,
-                            from_key,
-                            to_key,
-                            limit,
-                            order=order,
-                        )
-                        for room_id in rm_ids
-                    ],
-                    consumeErrors=True,
+        if from_key == to_key:
+            return {room_id: ([], from_key) for room_id in room_ids}
+
+        # We look up the events for all the rooms in one transaction, and then
+        # fetch all the events in one go.
+        def f(txn):
+            return {
+                room_id: self._get_room_events_stream_for_room_txn(
+                    txn, room_id, from_key, to_key, limit, order
                 )
-            )
-            results.update(dict(zip(rm_ids, res)))
+                for room_id in room_ids
+            }
 
-        return results
+        rows_by_room = await self.db_pool.runInteraction(
+            "get_room_events_stream_for_rooms", f
+        )
+
+        events = await self.get_events(
+            [r.event_id for rows in rows_by_room.values() for r in rows],
+            get_prev_content=True,
+        )
+
+        return {
+            room_id: self._rows_to_room_events_stream(rows, events, from_key, order)
+            for room_id, rows in rows_by_room.items()
+        }
 
     def get_rooms_that_changed(
         self, room_ids: Collection[str], from_key: RoomStreamToken
@@ -486,43 +487,81 @@ class StreamWorkerStore(EventsWorkerStore, SQLBaseStore, metaclass=abc.ABCMeta):
         if not has_changed:
             return [], from_key
 
-        def f(txn):
-            # To handle tokens with a non-empty instance_map we fetch more
-            # results than necessary and then filter down
-            min_from_id = from_key.stream
-            max_to_id = to_key.get_max_stream_pos()
+        rows = await self.db_pool.runInteraction(
+            "get_room_events_stream_for_room",
+            self._get_room_events_stream_for_room_txn,
+            room_id,
+            from_key,
+            to_key,
+            limit,
+            order,
+        )
 
-            sql = """
-                SELECT event_id, instance_name, topological_ordering, stream_ordering
-                FROM events
-                WHERE
-                    room_id = ?
-                    AND not outlier
-                    AND stream_ordering > ? AND stream_ordering <= ?
-                ORDER BY stream_ordering %s LIMIT ?
-            """ % (
-                order,
-            )
-            txn.execute(sql, (room_id, min_from_id, max_to_id, 2 * limit))
+        events = await self.get_events(
+            [r.event_id for r in rows], get_prev_content=True
+        )
 
-            rows = [
-                _EventDictReturn(event_id, None, stream_ordering)
-                for event_id, instance_name, topological_ordering, stream_ordering in txn
-                if _filter_results(
-                    from_key,
-                    to_key,
-                    instance_name,
-                    topological_ordering,
-                    stream_ordering,
-                )
-            ][:limit]
-            return rows
+        return self._rows_to_room_events_stream(rows, events, from_key, order)
 
-        rows = await self.db_pool.runInteraction("get_room_events_stream_for_room", f)
+    def _get_room_events_stream_for_room_txn(
+        self,
+        txn: LoggingTransaction,
+        room_id: str,
+        from_key: RoomStreamToken,
+        to_key: RoomStreamToken,
+        limit: int,
+        order: str,
+    ) -> List[_EventDictReturn]:
+        # To handle tokens with a non-empty instance_map we fetch more
+        # results than necessary and then filter down
+        min_from_id = from_key.stream
+        max_to_id = to_key.get_max_stream_pos()
 
-        ret = await self.get_events_as_list(
-            [r.event_id for r in rows], get_prev_content=True
+        sql = """
+            SELECT event_id, instance_name, topological_ordering, stream_ordering
+            FROM events
+            WHERE
+                room_id = ?
+                AND not outlier
+                AND stream_ordering > ? AND stream_ordering <= ?
+            ORDER BY stream_ordering %s LIMIT ?
+        """ % (
+            order,
         )
+        txn.execute(sql, (room_id, min_from_id, max_to_id, 2 * limit))
+
+        rows = [
+            _EventDictReturn(event_id, None, stream_ordering)
+            for event_id, instance_name, topological_ordering, stream_ordering in txn
+            if _filter_results(
+                from_key, to_key, instance_name, topological_ordering, stream_ordering,
+            )
+        ][:limit]
+        return rows
+
+    def _rows_to_room_events_stream(
+        self,
+        rows: List[_EventDictReturn],
+        events: Dict[str, EventBase],
+        from_key: RoomStreamToken,
+        order: str,
+    ) -> Tuple[List[EventBase], RoomStreamToken]:
+        """Build the result of `get_room_events_stream_for_room` from the rows
+        returned by `_get_room_events_stream_for_room_txn`.
+
+        Args:
+            rows: the rows for the room
+            events: the events fetched for the rows. Events which couldn't be
+                fetched are skipped.
+            from_key
+            order
+
+        Returns:
+            The list of events (in ascending order) and the token from the start
+            of the chunk of events returned.
+        """
+        rows = [r for r in rows if r.event_id in events]
+        ret = [events[r.event_id] for r in rows]
 
         self._set_before_and_after(ret, rows, topo_order=False)
 
@@ -1030,6 +1069,93 @@ class StreamWorkerStore(EventsWorkerStore, SQLBaseStore, metaclass=abc.ABCMeta):
     def has_room_changed_since(self, room_id: str, stream_id: int) -> bool:
         return self._events_stream_cache.has_entity_changed(room_id, stream_id)
 
+    async def get_rooms_by_recency(
+        self, room_ids: Collection[str], limit: int
+    ) -> List[str]:
+        """Order rooms by the stream ordering of their most recent event.
+
+        Args:
+            room_ids: the rooms to order
+            limit: the maximum number of rooms to return
+
+        Returns:
+            The `limit` rooms with the most recent events, most recent first.
+        """
+        last_positions = {}  # type: Dict[str, int]
+        unknown_room_ids = []
+        for room_id in room_ids:
+            pos = self._events_stream_cache.get_last_change_pos(room_id)
+            if pos is None:
+                unknown_room_ids.append(room_id)
+            else:
+                last_positions[room_id] = pos
+
+        ordered = sorted(
+            last_positions, key=lambda r: (last_positions[r], r), reverse=True
+        )
+
+        # Rooms which the stream change cache doesn't know about haven't had
+        # any events since its earliest known position, so are less recent
+        # than all the rooms which it does know about. We only need to look
+        # them up if they might be in the result.
+        if len(ordered) >= limit or not unknown_room_ids:
+            return ordered[:limit]
+
+        unknown_positions = await self.get_last_event_stream_orderings(unknown_room_ids)
+        ordered.extend(
+            sorted(
+                unknown_room_ids,
+                key=lambda r: (unknown_positions.get(r) or 0, r),
+                reverse=True,
+            )
+        )
+        return ordered[:limit]
+
+    @cached(max_entries=100000)
+    async def get_last_event_stream_ordering(self, room_id: str) -> Optional[int]:
+        """Get the stream ordering of the most recent event in a room, or None
+        if we have no events in the room.
+        """
+        results = await self.db_pool.runInteraction(
+            "get_last_event_stream_ordering",
+            self._get_last_event_stream_orderings_txn,
+            [room_id],
+        )
+        return results[room_id]
+
+    @cachedList(
+        cached_method_name="get_last_event_stream_ordering", list_name="room_ids",
+    )
+    async def get_last_event_stream_orderings(
+        self, room_ids: Collection[str]
+    ) -> Dict[str, Optional[int]]:
+        return await self.db_pool.runInteraction(
+            "get_last_event_stream_orderings",
+            self._get_last_event_stream_orderings_txn,
+            room_ids,
+        )
+
+    def _get_last_event_stream_orderings_txn(
+        self, txn: LoggingTransaction, room_ids: Collection[str]
+    ) -> Dict[str, Optional[int]]:
+        # We look up each room separately, as this only reads the end of the
+        # room's entries in the `events_room_stream` index, whereas
+        # `MAX(stream_ordering) ... GROUP BY room_id` reads all of them.
+        sql = """
+            SELECT stream_ordering FROM events
+            WHERE room_id = ?
+            ORDER BY stream_ordering DESC
+            LIMIT 1
+        """
+
+        results = {}  # type: Dict[str, Optional[int]]
+        for room_id in room_ids:
+            txn.execute(sql, (room_id,))
+            row = txn.fetchone()
+            results[room_id] = row[0] if row else None
+
+        return results
+
     def _paginate_room_events_txn(
         self,
         txn: LoggingTransaction,
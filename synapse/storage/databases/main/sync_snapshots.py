@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+from typing import Collection, Dict, Tuple
+
+from synapse.metrics.background_process_metrics import wrap_as_background_process
+from synapse.storage._base import SQLBaseStore, db_to_json
+from synapse.storage.database import DatabasePool, LoggingTransaction
+from synapse.types import JsonDict
+from synapse.util import json_encoder
+
+logger = logging.getLogger(__name__)
+
+# The maximum number of stale snapshots to delete in one go.
+STALE_SYNC_SNAPSHOTS_BATCH_SIZE = 100
+
+
+class SyncSnapshotStore(SQLBaseStore):
+    """Stores snapshots of the rooms section of users' initial syncs.
+
+    A snapshot is identified by a user ID and a "filter key", and consists of
+    an entry for each room, along with the position in the events stream that
+    the entry is correct as of.
+    """
+
+    def __init__(self, database: DatabasePool, db_conn, hs):
+        super().__init__(database, db_conn, hs)
+
+        self._sync_snapshots_max_age_ms = hs.config.sync_snapshots_max_age_ms
+        self._sync_snapshots_max_per_user = hs.config.sync_snapshots_max_per_user
+
+        if hs.config.sync_snapshots_enabled and hs.config.run_background_tasks:
+            self._clock.looping_call(self._delete_stale_sync_snapshots, 60 * 60 * 1000)
+
+    async def get_sync_snapshot(
+        self, user_id: str, filter_key: str
+    ) -> Dict[str, Tuple[int, JsonDict]]:
+        """Get the entries of a user's sync snapshot.
+
+        Args:
+            user_id
+            filter_key
+
+        Returns:
+            A map from room ID to the stream ordering the room's entry is correct
+            as of and the entry. Empty if there is no (recently used) snapshot.
+        """
+
+        def _get_sync_snapshot_txn(txn: LoggingTransaction):
+            last_used_ts = self.db_pool.simple_select_one_onecol_txn(
+                txn,
+                table="sync_snapshots",
+                keyvalues={"user_id": user_id, "filter_key": filter_key},
+                retcol="last_used_ts",
+                allow_none=True,
+            )
+            if (
+                last_used_ts is None
+                or last_used_ts
+                < self._clock.time_msec() - self._sync_snapshots_max_age_ms
+            ):
+                return []
+
+            return self.db_pool.simple_select_list_txn(
+                txn,
+                table="sync_snapshot_rooms",
+                keyvalues={"user_id": user_id, "filter_key": filter_key},
+                retcols=("room_id", "stream_ordering", "entry_json"),
+            )
+
+        rows = await self.db_pool.runInteraction(
+            "get_sync_snapshot", _get_sync_snapshot_txn
+        )
+
+        return {
+            row["room_id"]: (row["stream_ordering"], db_to_json(row["entry_json"]))
+            for row in rows
+        }
+
+    async def update_sync_snapshot(
+        self,
+        user_id: str,
+        filter_key: str,
+        updated_entries: Dict[str, Tuple[int, JsonDict]],
+        removed_room_ids: Collection[str],
+    ) -> None:
+        """Update a user's sync snapshot, creating it if necessary, and mark it
+        as recently used.
+
+        If the user has too many snapshots, the least recently used ones are
+        deleted.
+
+        Args:
+            user_id
+            filter_key
+            updated_entries: a map from room ID to the stream ordering the
+                room's new entry is correct as of and the entry.
+            removed_room_ids: rooms whose entries should be deleted.
+        """
+
+        def _update_sync_snapshot_txn(txn: LoggingTransaction):
+            self.db_pool.simple_upsert_txn(
+                txn,
+                table="sync_snapshots",
+                keyvalues={"user_id": user_id, "filter_key": filter_key},
+                values={"last_used_ts": self._clock.time_msec()},
+                lock=False,
+            )
+
+            if updated_entries:
+                self.db_pool.simple_upsert_many_txn(
+                    txn,
+                    table="sync_snapshot_rooms",
+                    key_names=("user_id", "filter_key", "room_id"),
+                    key_values=[
+                        (user_id, filter_key, room_id) for room_id in updated_entries
+                    ],
+                    value_names=("stream_ordering", "entry_json"),
+                    value_values=[
+                        (stream_ordering, json_encoder.encode(entry))
+                        for stream_ordering, entry in updated_entries.values()
+                    ],
+                )
+
+            for room_id in removed_room_ids:
+                self.db_pool.simple_delete_txn(
+                    txn,
+                    table="sync_snapshot_rooms",
+                    keyvalues={
+                        "user_id": user_id,
+                        "filter_key": filter_key,
+                        "room_id": room_id,
+                    },
+                )
+
+            # Only keep the user's most recently used snapshots.
+            txn.execute(
+                """
+                SELECT filter_key FROM sync_snapshots WHERE user_id = ?
+                ORDER BY last_used_ts DESC
+                """,
+                (user_id,),
+            )
+            for (old_filter_key,) in txn.fetchall()[
+                self._sync_snapshots_max_per_user :
+            ]:
+                self._delete_sync_snapshot_txn(txn, user_id, old_filter_key)
+
+        await self.db_pool.runInteraction(
+            "update_sync_snapshot", _update_sync_snapshot_txn
+        )
+
+    def _delete_sync_snapshot_txn(
+        self, txn: LoggingTransaction, user_id: str, filter_key: str
+    ) -> None:
+        for table in ("sync_snapshot_rooms", "sync_snapshots"):
+            self.db_pool.simple_delete_txn(
+                txn,
+                table=table,
+                keyvalues={"user_id": user_id, "filter_key": filter_key},
+            )
+
+    @wrap_as_background_process("delete_stale_sync_snapshots")
+    async def _delete_stale_sync_snapshots(self) -> None:
+        def _delete_stale_sync_snapshots_txn(txn: LoggingTransaction) -> int:
+            txn.execute(
+                "SELECT user_id, filter_key FROM sync_snapshots"
+                " WHERE last_used_ts < ? LIMIT ?",
+                (
+                    self._clock.time_msec() - self._sync_snapshots_max_age_ms,
+                    STALE_SYNC_SNAPSHOTS_BATCH_SIZE,
+                ),
+            )
+            rows = txn.fetchall()
+            for user_id, filter_key in rows:
+                self._delete_sync_snapshot_txn(txn, user_id, filter_key)
+            return len(rows)
+
+        while True:
+            deleted = await self.db_pool.runInteraction(
+                "_delete_stale_sync_snapshots", _delete_stale_sync_snapshots_txn
+            )
+            if deleted < STALE_SYNC_SNAPSHOTS_BATCH_SIZE:
+                break
@@ -0,0 +1,787 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Online compression of state groups.
+
+State groups are stored as chains of deltas (`state_group_edges` and
+`state_groups_state`). Deltas are created against whichever group happened to
+be the previous state, and chains are only cut once they hit
+`MAX_STATE_DELTA_HOPS`, at which point a full snapshot of the state is
+stored. This leads to both long chains (which make reading state slow) and lots
+of snapshots (which take up a lot of space).
+
+The compressor rewrites the state groups of each room, in order, into a
+layout made up of a number of "levels": each group is stored as a delta
+against the most recent group in the lowest level which has room in its chain,
+so that the length of every chain is bounded by the sum of the level sizes and
+snapshots are only needed once every level is full.
+"""
+
+import itertools
+import logging
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import attr
+from prometheus_client import Counter, Histogram
+
+from synapse.storage._base import SQLBaseStore, db_to_json, make_in_list_sql_clause
+from synapse.storage.database import LoggingTransaction
+from synapse.storage.databases.state.bg_updates import StateGroupBackgroundUpdateStore
+from synapse.storage.state import StateFilter
+from synapse.types import StateMap
+from synapse.util import json_encoder
+from synapse.util.iterutils import batch_iter
+
+logger = logging.getLogger(__name__)
+
+
+# The maximum length of the chain in each level. Every chain in the compressed
+# layout is at most `sum(DEFAULT_LEVEL_SIZES)` long, which must stay below
+# `MAX_STATE_DELTA_HOPS`.
+DEFAULT_LEVEL_SIZES = (32, 16, 8)
+
+# How much bigger (in rows) we let a room's state groups get in exchange for
+# shortening their delta chains. Building up the levels for a room costs some
+# extra rows at first, which is paid back by needing far fewer snapshots later.
+MAX_ROW_GROWTH_FOR_SHORTER_CHAINS = 1.5
+
+# The maximum number of state groups to compress at a time, however few rows
+# they have.
+MAX_GROUPS_PER_CHUNK = 1000
+
+state_compressor_groups_counter = Counter(
+    "synapse_state_compressor_groups",
+    "Number of state groups examined by the state compressor",
+)
+
+state_compressor_rows_counter = Counter(
+    "synapse_state_compressor_rows",
+    "Number of rows in state_groups_state for the state groups rewritten by the "
+    "state compressor, before and after compression",
+    ["layout"],
+)
+
+state_compressor_bytes_counter = Counter(
+    "synapse_state_compressor_bytes",
+    "Estimated size in bytes of the rows in state_groups_state for the state "
+    "groups rewritten by the state compressor, before and after compression",
+    ["layout"],
+)
+
+state_compressor_chain_length_histogram = Histogram(
+    "synapse_state_compressor_chain_length",
+    "Length of the delta chains of the state groups rewritten by the state "
+    "compressor, before and after compression. The cost of reading the state of "
+    "a group grows with the length of its chain.",
+    ["layout"],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, "+Inf"),
+)
+
+
+@attr.s(slots=True)
+class _Level:
+    """A level in the compressed layout.
+
+    Attributes:
+        max_length: the maximum length of the chain in this level
+        current_chain_length: the length of the current chain in this level
+        head: the most recent group added to this level, if any
+    """
+
+    max_length = attr.ib(type=int)
+    current_chain_length = attr.ib(type=int, default=0)
+    head = attr.ib(type=Optional[int], default=None)
+
+    def has_space(self) -> bool:
+        return self.current_chain_length < self.max_length
+
+    def update(self, new_head: int, delta: bool) -> None:
+        """Add a group to this level, either continuing the current chain (if
+        `delta` is true) or starting a new one.
+        """
+        self.head = new_head
+        if delta:
+            self.current_chain_length += 1
+        else:
+            self.current_chain_length = 1
+
+
+def assign_prev_groups(
+    levels: List[_Level], state_groups: Iterable[int]
+) -> Dict[int, Optional[int]]:
+    """Work out which group each of the given groups should be stored as a
+    delta against in the compressed layout, updating `levels` as we go.
+
+    Args:
+        levels: the levels of the layout, lowest first
+        state_groups: the groups to add to the layout, in increasing order
+
+    Returns:
+        A map from group to the group it should be a delta against, or None if
+        it should be a snapshot.
+    """
+    result = {}  # type: Dict[int, Optional[int]]
+    for state_group in state_groups:
+        prev_group = None
+        for idx, level in enumerate(levels):
+            if level.has_space():
+                prev_group = level.head
+                level.update(state_group, True)
+                if prev_group is None:
+                    # This group is a snapshot, so can start a new chain in
+                    # any of the higher levels too.
+                    for higher_level in levels[idx + 1 :]:
+                        higher_level.update(state_group, False)
+                break
+            else:
+                level.update(state_group, False)
+
+        result[state_group] = prev_group
+
+    return result
+
+
+@attr.s(slots=True, frozen=True)
+class _CompressionResult:
+    """The outcome of compressing a chunk of a room's state groups.
+    """
+
+    groups = attr.ib(type=int)
+    cost = attr.ib(type=int)
+    rows_before = attr.ib(type=int)
+    rows_after = attr.ib(type=int)
+    bytes_before = attr.ib(type=int)
+    bytes_after = attr.ib(type=int)
+    chain_lengths_before = attr.ib(type=List[int])
+    chain_lengths_after = attr.ib(type=List[int])
+
+
+class StateCompressorStore(StateGroupBackgroundUpdateStore, SQLBaseStore):
+    """Rewrites the state groups of rooms into a compact layout.
+    """
+
+    async def compress_state_groups(self, max_rows: int) -> int:
+        """Compress the state groups with up to about `max_rows` rows of
+        state, continuing from where we got to last time.
+
+        Returns:
+            The number of state groups that were looked at.
+        """
+        processed_groups = 0
+        processed_rows = 0
+        while processed_rows < max_rows:
+            room_id = await self.db_pool.simple_select_one_onecol(
+                table="state_compressor_position",
+                keyvalues={},
+                retcol="room_id",
+                desc="get_state_compressor_position",
+            )
+
+            if room_id:
+                result = await self.db_pool.runInteraction(
+                    "compress_state_groups",
+                    self._compress_room_chunk_txn,
+                    room_id,
+                    max_rows - processed_rows,
+                )
+                if result:
+                    processed_groups += result.groups
+                    processed_rows += result.cost
+                    self._report_compression(room_id, result)
+                    continue
+
+            # We've finished with this room, so move on to the next one.
+            next_room_id = await self.db_pool.runInteraction(
+                "advance_state_compressor_position",
+                self._advance_state_compressor_position_txn,
+                room_id,
+            )
+            if not next_room_id:
+                break
+
+        return processed_groups
+
+    def _advance_state_compressor_position_txn(
+        self, txn: LoggingTransaction, room_id: str
+    ) -> str:
+        txn.execute(
+            "SELECT room_id FROM state_groups WHERE room_id > ?"
+            " ORDER BY room_id LIMIT 1",
+            (room_id,),
+        )
+        row = txn.fetchone()
+        next_room_id = row[0] if row else ""
+
+        self.db_pool.simple_update_one_txn(
+            txn,
+            table="state_compressor_position",
+            keyvalues={},
+            updatevalues={"room_id": next_room_id},
+        )
+
+        return next_room_id
+
+    def _compress_room_chunk_txn(
+        self, txn: LoggingTransaction, room_id: str, max_rows: int
+    ) -> Optional[_CompressionResult]:
+        """Compress the next chunk of state groups in the room, made up of the
+        groups with up to about `max_rows` rows of state.
+
+        Returns:
+            None if there are no more groups in the room to compress.
+        """
+        progress = self.db_pool.simple_select_one_txn(
+            txn,
+            table="state_compressor_progress",
+            keyvalues={"room_id": room_id},
+            retcols=("last_compressed_group", "levels", "rows_before", "rows_after"),
+            allow_none=True,
+        )
+        if progress:
+            last_compressed_group = progress["last_compressed_group"]
+            levels = [
+                _Level(max_length, length, head)
+                for max_length, length, head in db_to_json(progress["levels"])
+            ]
+            room_rows_before = progress["rows_before"]
+            room_rows_after = progress["rows_after"]
+        else:
+            last_compressed_group = 0
+            levels = [_Level(max_length) for max_length in DEFAULT_LEVEL_SIZES]
+            room_rows_before = room_rows_after = 0
+
+        # If any of the heads of the levels have since been purged we can't
+        # use them, so we start the levels again.
+        heads = {level.head for level in levels if level.head is not None}
+        if heads:
+            rows = self.db_pool.simple_select_many_txn(
+                txn,
+                table="state_groups",
+                column="id",
+                iterable=heads,
+                keyvalues={},
+                retcols=("id",),
+            )
+            if len(rows) != len(heads):
+                levels = [_Level(level.max_length) for level in levels]
+
+        state_groups, row_sizes = self._get_next_chunk_txn(
+            txn, room_id, last_compressed_group, max_rows
+        )
+        if not state_groups:
+            return None
+
+        new_prev_groups = assign_prev_groups(levels, state_groups)
+
+        # Load the existing delta chains of the groups in the chunk and of their
+        # new prev groups.
+        prev_groups = self._get_prev_groups_recursive_txn(
+            txn,
+            set(state_groups).union(
+                prev_group
+                for prev_group in new_prev_groups.values()
+                if prev_group is not None
+            ),
+        )
+
+        # The groups whose position in the layout has changed.
+        changed_groups = [
+            state_group
+            for state_group in state_groups
+            if new_prev_groups[state_group] != prev_groups[state_group]
+        ]
+
+        new_deltas = self._get_new_deltas_txn(
+            txn, changed_groups, new_prev_groups, prev_groups
+        )
+
+        old_rows = sum(row_sizes[sg][0] for sg in new_deltas)
+        old_bytes = sum(row_sizes[sg][1] for sg in new_deltas)
+        unchanged_rows = sum(
+            row_sizes[sg][0] for sg in state_groups if sg not in new_deltas
+        )
+        new_rows = sum(len(delta) for _, delta in new_deltas.values())
+        new_bytes = sum(
+            _estimate_row_size(room_id, key, event_id)
+            for _, delta in new_deltas.values()
+            for key, event_id in delta.items()
+        )
+
+        chain_lengths_before = {
+            state_group: _get_chain_length(prev_groups, state_group)
+            for state_group in state_groups
+        }
+
+        # Work out the chain lengths in the new layout. Groups outside this
+        # chunk have already been compressed, so their chains are unchanged.
+        chain_lengths_after = {}  # type: Dict[int, int]
+        for state_group in state_groups:
+            if state_group in new_deltas:
+                prev_group = new_deltas[state_group][0]
+            else:
+                prev_group = prev_groups[state_group]
+
+            if prev_group is None:
+                chain_lengths_after[state_group] = 0
+            elif prev_group in chain_lengths_after:
+                chain_lengths_after[state_group] = chain_lengths_after[prev_group] + 1
+            else:
+                chain_lengths_after[state_group] = (
+                    _get_chain_length(prev_groups, prev_group) + 1
+                )
+
+        # We accept the new layout if it takes up less space, or if it
+        # shortens the chains (and so speeds up reading state) without taking
+        # up too much more space. The growth is measured over all of the room's
+        # groups we've looked at so far, rather than just this chunk, as the
+        # extra rows of building up the levels are usually paid back in later
+        # chunks, by the snapshots which are no longer needed.
+        max_length_before = max(chain_lengths_before.values())
+        max_length_after = max(chain_lengths_after.values())
+        total_rows_before = room_rows_before + old_rows + unchanged_rows
+        total_rows_after = room_rows_after + new_rows + unchanged_rows
+        if not new_deltas:
+            # The chunk is already laid out as we want.
+            rewritten = True
+        elif new_rows < old_rows or (
+            max_length_after < max_length_before
+            and total_rows_after
+            <= total_rows_before * MAX_ROW_GROWTH_FOR_SHORTER_CHAINS
+        ):
+            rewritten = self._rewrite_state_groups_txn(txn, room_id, new_deltas)
+        else:
+            rewritten = False
+
+        if not rewritten:
+            # Compressing this chunk isn't worth it (or some of the groups
+            # have gone), so we leave it alone. Nothing can now be stored as a
+            # delta against groups in this chunk, so we start the levels again.
+            new_rows, new_bytes = old_rows, old_bytes
+            levels = [_Level(level.max_length) for level in levels]
+            chain_lengths_after = chain_lengths_before
+            total_rows_after = room_rows_after + old_rows + unchanged_rows
+
+        self.db_pool.simple_upsert_txn(
+            txn,
+            table="state_compressor_progress",
+            keyvalues={"room_id": room_id},
+            values={
+                "last_compressed_group": state_groups[-1],
+                "levels": json_encoder.encode(
+                    [
+                        (level.max_length, level.current_chain_length, level.head)
+                        for level in levels
+                    ]
+                ),
+                "rows_before": total_rows_before,
+                "rows_after": total_rows_after,
+            },
+            lock=False,
+        )
+
+        return _CompressionResult(
+            groups=len(state_groups),
+            cost=sum(_get_chunk_cost(row_sizes[sg][0]) for sg in state_groups),
+            rows_before=old_rows,
+            rows_after=new_rows,
+            bytes_before=old_bytes,
+            bytes_after=new_bytes,
+            chain_lengths_before=list(chain_lengths_before.values()),
+            chain_lengths_after=[chain_lengths_after[sg] for sg in state_groups],
+        )
+
+    def _get_next_chunk_txn(
+        self,
+        txn: LoggingTransaction,
+        room_id: str,
+        last_compressed_group: int,
+        max_rows: int,
+    ) -> Tuple[List[int], Dict[int, Tuple[int, int]]]:
+        """Get the next chunk of state groups in the room to compress, made up
+        of the groups after `last_compressed_group` with up to about `max_rows`
+        rows of state between them.
+
+        Returns:
+            The state groups in the chunk, in increasing order, and the number of
+            rows and estimated size in bytes of each of them.
+        """
+        txn.execute(
+            "SELECT id FROM state_groups WHERE room_id = ? AND id > ?"
+            " ORDER BY id LIMIT ?",
+            (room_id, last_compressed_group, min(max_rows, MAX_GROUPS_PER_CHUNK)),
+        )
+        candidates = [row[0] for row in txn]
+        row_sizes = self._get_state_row_sizes_txn(txn, candidates)
+
+        # We always take at least one group, so that we make progress however
+        # big it is.
+        state_groups = []  # type: List[int]
+        cost = 0
+        for state_group in candidates:
+            cost += _get_chunk_cost(row_sizes[state_group][0])
+            if state_groups and cost > max_rows:
+                break
+            state_groups.append(state_group)
+
+        return state_groups, row_sizes
+
+    def _get_new_deltas_txn(
+        self,
+        txn: LoggingTransaction,
+        state_groups: Sequence[int],
+        new_prev_groups: Dict[int, Optional[int]],
+        prev_groups: Dict[int, Optional[int]],
+    ) -> Dict[int, Tuple[Optional[int], StateMap[str]]]:
+        """Work out the new delta of each of the given groups against its new
+        prev group.
+
+        Rather than loading the full state of the groups, we combine the
+        existing deltas on the paths from each group and its new prev group back
+        to the most recent group they have in common, which only requires the
+        state of the common group for the keys changed on the prev group's side.
+
+        Args:
+            state_groups: the groups to get new deltas for
+            new_prev_groups: map from group to its new prev group, if any
+            prev_groups: map from group to its current prev group, if any, for
+                every group in the delta chains of the given groups and their
+                new prev groups
+
+        Returns:
+            A map from group to its new prev group and its delta against it (or
+            None and its full state, if it must be a snapshot).
+        """
+        # The groups which have to be snapshots.
+        snapshots = []  # type: List[int]
+
+        # Map from group to the paths from it and from its new prev group back
+        # to their most recent common group, and that group (if any).
+        paths = {}  # type: Dict[int, Tuple[List[int], List[int], Optional[int]]]
+
+        for state_group in state_groups:
+            new_prev_group = new_prev_groups[state_group]
+            if new_prev_group is None:
+                snapshots.append(state_group)
+                continue
+
+            chain = _get_chain(prev_groups, state_group)
+            positions = {group: idx for idx, group in enumerate(chain)}
+            prev_chain = _get_chain(prev_groups, new_prev_group)
+            common_idx = next(
+                (idx for idx, group in enumerate(prev_chain) if group in positions),
+                None,
+            )
+            if common_idx is None:
+                # The group and its new prev group are in unrelated chains, so
+                # we have to compare their full state, which we get by combining
+                # the whole of both chains.
+                paths[state_group] = (chain, prev_chain, None)
+                continue
+
+            common_group = prev_chain[common_idx]
+            paths[state_group] = (
+                chain[: positions[common_group]],
+                prev_chain[:common_idx],
+                common_group,
+            )
+
+        deltas = self._get_state_group_deltas_txn(
+            txn,
+            {
+                group
+                for path, prev_path, _ in paths.values()
+                for group in itertools.chain(path, prev_path)
+            },
+        )
+
+        # The state of each group relative to the common group, i.e. the
+        # combined deltas on each path.
+        relative_states = {}  # type: Dict[int, Tuple[StateMap[str], StateMap[str]]]
+        common_keys = {}  # type: Dict[int, Set[Tuple[str, str]]]
+        for state_group, (path, prev_path, common_group) in paths.items():
+            state = _combine_deltas(deltas, path)
+            prev_state = _combine_deltas(deltas, prev_path)
+            relative_states[state_group] = (state, prev_state)
+
+            # For state which has changed since the common group on the prev
+            # group's side but not on this group's, this group has the common
+            # group's state.
+            keys = prev_state.keys() - state.keys()
+            if keys and common_group is not None:
+                common_keys.setdefault(common_group, set()).update(keys)
+
+        common_states = {}  # type: Dict[int, StateMap[str]]
+        for common_group, keys in common_keys.items():
+            common_states.update(
+                self._get_state_groups_from_groups_txn(
+                    txn, [common_group], state_filter=StateFilter.from_types(keys)
+                )
+            )
+
+        new_deltas = {}  # type: Dict[int, Tuple[Optional[int], StateMap[str]]]
+        for state_group, (state, prev_state) in relative_states.items():
+            common_state = common_states.get(paths[state_group][2], {})
+
+            delta = {k: v for k, v in state.items() if prev_state.get(k) != v}
+            for key in prev_state.keys() - state.keys():
+                event_id = common_state.get(key)
+                if event_id is None:
+                    # We can't remove entries with a delta, so this has to be
+                    # a snapshot.
+                    snapshots.append(state_group)
+                    break
+                if event_id != prev_state[key]:
+                    delta[key] = event_id
+            else:
+                new_deltas[state_group] = (new_prev_groups[state_group], delta)
+
+        for state_group in snapshots:
+            new_deltas[state_group] = (
+                None,
+                self._get_state_groups_from_groups_txn(txn, [state_group])[state_group],
+            )
+
+        return new_deltas
+
+    def _get_prev_groups_txn(
+        self, txn: LoggingTransaction, state_groups: Iterable[int]
+    ) -> Dict[int, int]:
+        rows = self.db_pool.simple_select_many_txn(
+            txn,
+            table="state_group_edges",
+            column="state_group",
+            iterable=state_groups,
+            keyvalues={},
+            retcols=("state_group", "prev_state_group"),
+        )
+        return {row["state_group"]: row["prev_state_group"] for row in rows}
+
+    def _get_prev_groups_recursive_txn(
+        self, txn: LoggingTransaction, state_groups: Iterable[int]
+    ) -> Dict[int, Optional[int]]:
+        """Get the prev group of each of the given groups, and of every group
+        in their delta chains.
+
+        Returns:
+            A map from group to its prev group, or None for snapshots.
+        """
+        prev_groups = {}  # type: Dict[int, Optional[int]]
+        to_fetch = set(state_groups)
+        while to_fetch:
+            fetched = self._get_prev_groups_txn(txn, to_fetch)
+            for state_group in to_fetch:
+                prev_groups[state_group] = fetched.get(state_group)
+
+            to_fetch = {
+                prev_group
+                for prev_group in fetched.values()
+                if prev_group not in prev_groups
+            }
+
+        return prev_groups
+
+    def _get_state_group_deltas_txn(
+        self, txn: LoggingTransaction, state_groups: Iterable[int]
+    ) -> Dict[int, StateMap[str]]:
+        """Get the rows stored for each of the given groups, i.e. their delta
+        against their prev group (or their full state, for snapshots).
+        """
+        rows = self.db_pool.simple_select_many_txn(
+            txn,
+            table="state_groups_state",
+            column="state_group",
+            iterable=state_groups,
+            keyvalues={},
+            retcols=("state_group", "type", "state_key", "event_id"),
+        )
+
+        deltas = {state_group: {} for state_group in state_groups}
+        for row in rows:
+            deltas[row["state_group"]][(row["type"], row["state_key"])] = row[
+                "event_id"
+            ]
+
+        return deltas
+
+    def _get_state_row_sizes_txn(
+        self, txn: LoggingTransaction, state_groups: Iterable[int]
+    ) -> Dict[int, Tuple[int, int]]:
+        """Count the rows in state_groups_state for each of the given groups.
+
+        Returns:
+            A map from group to its number of rows and an estimate of their size
+            in bytes.
+        """
+        sizes = {state_group: (0, 0) for state_group in state_groups}
+        for batch in batch_iter(state_groups, 100):
+            clause, args = make_in_list_sql_clause(
+                txn.database_engine, "state_group", batch
+            )
+            txn.execute(
+                "SELECT state_group, COUNT(*), SUM(LENGTH(room_id) + LENGTH(type)"
+                " + LENGTH(state_key) + LENGTH(event_id))"
+                " FROM state_groups_state WHERE " + clause + " GROUP BY state_group",
+                args,
+            )
+            for state_group, count, size in txn:
+                sizes[state_group] = (count, size + 8 * count)
+
+        return sizes
+
+    def _rewrite_state_groups_txn(
+        self,
+        txn: LoggingTransaction,
+        room_id: str,
+        new_deltas: Dict[int, Tuple[Optional[int], StateMap[str]]],
+    ) -> bool:
+        """Replace the stored edges and state of the given groups.
+
+        Returns:
+            False, without changing anything, if any of the groups or their new
+            prev groups have been purged.
+        """
+        # Make sure that none of the groups are purged from under us. A purge
+        # works out which groups are deltas against the groups it deletes (so
+        # that it can turn them into snapshots) before deleting them, so it
+        # would miss the edges we add here. We therefore "update" the groups, so
+        # that a concurrent purge of any of them conflicts with this transaction
+        # and is retried once we're done, and check that they still exist. (On
+        # postgres, locking the rows with `SELECT ... FOR SHARE` wouldn't be
+        # enough, as a repeatable read transaction only conflicts with rows
+        # which have been updated or deleted.)
+        groups = set(new_deltas)
+        groups.update(
+            prev_group
+            for prev_group, _ in new_deltas.values()
+            if prev_group is not None
+        )
+        updated = 0
+        for batch in batch_iter(groups, 100):
+            clause, args = make_in_list_sql_clause(txn.database_engine, "id", batch)
+            txn.execute(
+                "UPDATE state_groups SET room_id = room_id WHERE " + clause, args
+            )
+            updated += txn.rowcount
+
+        if updated != len(groups):
+            return False
+
+        for state_group, (prev_group, delta_ids) in new_deltas.items():
+            self.db_pool.simple_delete_txn(
+                txn, table="state_group_edges", keyvalues={"state_group": state_group}
+            )
+            if prev_group is not None:
+                self.db_pool.simple_insert_txn(
+                    txn,
+                    table="state_group_edges",
+                    values={"state_group": state_group, "prev_state_group": prev_group},
+                )
+
+            self.db_pool.simple_delete_txn(
+                txn, table="state_groups_state", keyvalues={"state_group": state_group}
+            )
+            self.db_pool.simple_insert_many_txn(
+                txn,
+                table="state_groups_state",
+                values=[
+                    {
+                        "state_group": state_group,
+                        "room_id": room_id,
+                        "type": key[0],
+                        "state_key": key[1],
+                        "event_id": event_id,
+                    }
+                    for key, event_id in delta_ids.items()
+                ],
+            )
+
+            # The full state of the group hasn't changed, so the state caches
+            # are still valid, but the cached delta is not.
+            txn.call_after(self.get_state_group_delta.invalidate, (state_group,))
+
+        return True
+
+    def _report_compression(self, room_id: str, result: _CompressionResult) -> None:
+        state_compressor_groups_counter.inc(result.groups)
+        state_compressor_rows_counter.labels("before").inc(result.rows_before)
+        state_compressor_rows_counter.labels("after").inc(result.rows_after)
+        state_compressor_bytes_counter.labels("before").inc(result.bytes_before)
+        state_compressor_bytes_counter.labels("after").inc(result.bytes_after)
+        for length in result.chain_lengths_before:
+            state_compressor_chain_length_histogram.labels("before").observe(length)
+        for length in result.chain_lengths_after:
+            state_compressor_chain_length_histogram.labels("after").observe(length)
+
+        if result.chain_lengths_before != result.chain_lengths_after:
+            logger.info(
+                "Compressed %d state groups in %s: %d -> %d rows (~%d -> %d bytes), "
+                "max chain length %d -> %d",
+                result.groups,
+                room_id,
+                result.rows_before,
+                result.rows_after,
+                result.bytes_before,
+                result.bytes_after,
+                max(result.chain_lengths_before),
+                max(result.chain_lengths_after),
+            )
+
+
+def _estimate_row_size(room_id: str, key: Tuple[str, str], event_id: str) -> int:
+    """Estimate the size of a row in state_groups_state, in the same way as
+    `_get_state_row_sizes_txn`.
+    """
+    return len(room_id) + len(key[0]) + len(key[1]) + len(event_id) + 8
+
+
+def _get_chunk_cost(rows: int) -> int:
+    """The cost of a state group with the given number of rows towards the size
+    of a chunk. Every group costs something, so that chunks of empty deltas are
+    still bounded.
+    """
+    return max(rows, 1)
+
+
+def _get_chain(prev_groups: Dict[int, Optional[int]], state_group: int) -> List[int]:
+    """Get the delta chain of the group, from the group back to its snapshot.
+
+    Args:
+        prev_groups: map from group to its prev group, for every group in the
+            chain
+        state_group
+    """
+    chain = [state_group]
+    prev_group = prev_groups[state_group]
+    while prev_group is not None:
+        chain.append(prev_group)
+        prev_group = prev_groups[prev_group]
+    return chain
+
+
+def _get_chain_length(prev_groups: Dict[int, Optional[int]], state_group: int) -> int:
+    return len(_get_chain(prev_groups, state_group)) - 1
+
+
+def _combine_deltas(
+    deltas: Dict[int, StateMap[str]], path: Sequence[int]
+) -> StateMap[str]:
+    """Combine the deltas of the groups on a path back along a delta chain,
+    giving the state of the first group relative to the group the path leads
+    back to.
+    """
+    state = {}  # type: Dict[Tuple[str, str], str]
+    for state_group in reversed(path):
+        state.update(deltas[state_group])
+    return state
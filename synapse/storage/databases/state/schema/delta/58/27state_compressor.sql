@@ -0,0 +1,31 @@
+/* Copyright 2020 The Matrix.org Foundation C.I.C
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- How far the state compressor has got with each room: the last state group it
+-- has looked at, and the state of its delta chain levels (as JSON).
+CREATE TABLE IF NOT EXISTS state_compressor_progress (
+    room_id TEXT NOT NULL PRIMARY KEY,
+    last_compressed_group BIGINT NOT NULL,
+    levels TEXT NOT NULL
+);
+
+-- single-row table to track which room the state compressor is working on.
+CREATE TABLE IF NOT EXISTS state_compressor_position (
+    Lock CHAR(1) NOT NULL DEFAULT 'X' UNIQUE,  -- Makes sure this table only has one row.
+    room_id TEXT NOT NULL,
+    CHECK (Lock='X')
+);
+
+INSERT INTO state_compressor_position (room_id) VALUES ('');
@@ -0,0 +1,21 @@
+/* Copyright 2020 The Matrix.org Foundation C.I.C
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- The number of rows of state that the groups the state compressor has looked
+-- at in each room took up before compression, and take up now. The compressor uses
+-- these to decide whether compressing each chunk is worth it over the room as a
+-- whole.
+ALTER TABLE state_compressor_progress ADD COLUMN rows_before BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE state_compressor_progress ADD COLUMN rows_after BIGINT NOT NULL DEFAULT 0;
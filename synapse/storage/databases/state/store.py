@@ -15,24 +15,50 @@
 
 import logging
 from collections import namedtuple
-from typing import Dict, Iterable, List, Set, Tuple
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from prometheus_client import Counter
 
 from synapse.api.constants import EventTypes
+from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.storage._base import SQLBaseStore
-from synapse.storage.database import DatabasePool
+from synapse.storage.database import DatabasePool, LoggingTransaction
 from synapse.storage.databases.state.bg_updates import StateBackgroundUpdateStore
+from synapse.storage.databases.state.compressor import StateCompressorStore
 from synapse.storage.state import StateFilter
 from synapse.storage.types import Cursor
 from synapse.storage.util.sequence import build_sequence_generator
 from synapse.types import MutableStateMap, StateMap
 from synapse.util.caches.descriptors import cached
 from synapse.util.caches.dictionary_cache import DictionaryCache
+from synapse.util.state_map import FrozenStateMap
 
 logger = logging.getLogger(__name__)
 
 
 MAX_STATE_DELTA_HOPS = 100
 
+# How far back we look for a cached state group that we can apply deltas to,
+# when the state of a group isn't in the caches.
+MAX_CACHED_ANCESTOR_HOPS = 5
+
+state_group_cache_derived_counter = Counter(
+    "synapse_state_group_cache_derived",
+    "Number of state group cache misses which were filled by applying deltas "
+    "to the cached state of an earlier state group",
+    ["cache"],
+)
+
+
+def _split_state(state: StateMap[str], members: bool) -> MutableStateMap[str]:
+    """Returns either the member or the non-member entries of the given state.
+    """
+    return {
+        key: event_id
+        for key, event_id in state.items()
+        if (key[0] == EventTypes.Member) == members
+    }
+
 
 class _GetStateGroupDelta(
     namedtuple("_GetStateGroupDelta", ("prev_group", "delta_ids"))
@@ -47,7 +73,9 @@ class _GetStateGroupDelta(
         return len(self.delta_ids) if self.delta_ids else 0
 
 
-class StateGroupDataStore(StateBackgroundUpdateStore, SQLBaseStore):
+class StateGroupDataStore(
+    StateBackgroundUpdateStore, StateCompressorStore, SQLBaseStore
+):
     """A data store for fetching/storing state groups.
     """
 
@@ -103,6 +131,16 @@ class StateGroupDataStore(StateBackgroundUpdateStore, SQLBaseStore):
             db_conn, table="state_groups", id_column="id"
         )
 
+        if hs.config.run_background_tasks and hs.config.state_compression_enabled:
+            chunk_size = hs.config.state_compression_chunk_size
+            self._clock.looping_call(
+                run_as_background_process,
+                hs.config.state_compression_interval_ms,
+                "compress_state_groups",
+                self.compress_state_groups,
+                chunk_size,
+            )
+
     @cached(max_entries=10000, iterable=True)
     async def get_state_group_delta(self, state_group):
         """Given a state group try to return a previous group and a delta between
@@ -243,6 +281,26 @@ class StateGroupDataStore(StateBackgroundUpdateStore, SQLBaseStore):
 
         incomplete_groups = incomplete_groups_m | incomplete_groups_nm
 
+        if not incomplete_groups:
+            return state
+
+        # Groups are usually stored as a delta against a recent group, whose
+        # state we may well have cached, so try building the missing state
+        # from that before we load it all from the database.
+        derived_m, derived_nm = await self._get_state_for_groups_from_ancestors(
+            [
+                (self._state_group_members_cache, member_filter, incomplete_groups_m),
+                (self._state_group_cache, non_member_filter, incomplete_groups_nm),
+            ]
+        )
+        for derived in (derived_m, derived_nm):
+            for group, group_state in derived.items():
+                state[group].update(group_state)
+
+        incomplete_groups = (incomplete_groups_m - derived_m.keys()) | (
+            incomplete_groups_nm - derived_nm.keys()
+        )
+
         if not incomplete_groups:
             return state
 
@@ -305,6 +363,148 @@ class StateGroupDataStore(StateBackgroundUpdateStore, SQLBaseStore):
 
         return results, incomplete_groups
 
+    async def _get_state_for_groups_from_ancestors(
+        self, lookups: List[Tuple[DictionaryCache, StateFilter, Set[int]]]
+    ) -> List[Dict[int, StateMap[str]]]:
+        """Tries to work out the state of groups which are missing from the
+        caches by applying the deltas between them and an ancestor group whose
+        state is in the caches.
+
+        Args:
+            lookups: list of (cache, state_filter, groups) tuples, where
+                `groups` are the groups which could not be fetched from `cache`
+                using `state_filter`.
+
+        Returns:
+            For each lookup, a map from state group to the filtered state of
+            those groups which we could work out.
+        """
+        results = [{} for _ in lookups]  # type: List[Dict[int, StateMap[str]]]
+
+        all_groups = set()  # type: Set[int]
+        for _, _, groups in lookups:
+            all_groups.update(groups)
+
+        if not all_groups:
+            return results
+
+        sequences = [cache.sequence for cache, _, _ in lookups]
+
+        ancestors, deltas = await self.db_pool.runInteraction(
+            "get_state_group_delta_chains",
+            self._get_state_group_delta_chains_txn,
+            all_groups,
+            MAX_CACHED_ANCESTOR_HOPS,
+        )
+
+        for (cache, state_filter, groups), sequence, result in zip(
+            lookups, sequences, results
+        ):
+            is_members_cache = cache is self._state_group_members_cache
+            wanted_keys = set(state_filter.concrete_types())
+
+            for group in groups:
+                # The state accumulated from the deltas between the group and
+                # the ancestor we're looking at, which take precedence over the
+                # ancestor's state.
+                delta_state = {}  # type: MutableStateMap[str]
+                prev_group = group
+                for ancestor in ancestors.get(group, []):
+                    for key, event_id in deltas[prev_group].items():
+                        if (key[0] == EventTypes.Member) == is_members_cache:
+                            delta_state.setdefault(key, event_id)
+                    prev_group = ancestor
+
+                    is_all, known_absent, ancestor_state = cache.get(ancestor)
+                    if not is_all and (
+                        state_filter.has_wildcards()
+                        or any(
+                            key not in delta_state
+                            and key not in ancestor_state
+                            and key not in known_absent
+                            for key in wanted_keys
+                        )
+                    ):
+                        continue
+
+                    group_state = dict(ancestor_state)
+                    group_state.update(delta_state)
+
+                    if is_all:
+                        # Share the ancestor's entries rather than copying them.
+                        ancestor_map = cache.get_full_value(ancestor)
+                        if isinstance(ancestor_map, FrozenStateMap):
+                            group_map = ancestor_map.with_delta(delta_state)
+                        else:
+                            group_map = FrozenStateMap(group_state)
+                        cache.update(sequence, key=group, value=group_map)
+                        group_state = state_filter.filter_state(group_state)
+                    else:
+                        group_state = state_filter.filter_state(group_state)
+                        cache.update(
+                            sequence,
+                            key=group,
+                            value=dict(group_state),
+                            fetched_keys=wanted_keys,
+                        )
+
+                    result[group] = group_state
+                    state_group_cache_derived_counter.labels(cache.name).inc()
+                    break
+
+        return results
+
+    def _get_state_group_delta_chains_txn(
+        self, txn: LoggingTransaction, state_groups: Iterable[int], max_hops: int
+    ) -> Tuple[Dict[int, List[int]], Dict[int, StateMap[str]]]:
+        """Walks back up to `max_hops` steps along the delta chains of the
+        given state groups.
+
+        Returns:
+            A map from state group to its ancestors (most recent first), and a
+            map from state group to its delta against its previous group, for
+            the given groups and their ancestors which are stored as deltas.
+        """
+        ancestors = {
+            state_group: [] for state_group in state_groups
+        }  # type: Dict[int, List[int]]
+        current = {state_group: state_group for state_group in state_groups}
+        delta_groups = set()  # type: Set[int]
+
+        for _ in range(max_hops):
+            if not current:
+                break
+
+            prev_groups = self._get_prev_groups_txn(txn, set(current.values()))
+            delta_groups.update(prev_groups)
+
+            next_groups = {}
+            for state_group, head in current.items():
+                prev_group = prev_groups.get(head)
+                if prev_group is not None:
+                    ancestors[state_group].append(prev_group)
+                    next_groups[state_group] = prev_group
+            current = next_groups
+
+        rows = self.db_pool.simple_select_many_txn(
+            txn,
+            table="state_groups_state",
+            column="state_group",
+            iterable=delta_groups,
+            keyvalues={},
+            retcols=("state_group", "type", "state_key", "event_id"),
+        )
+
+        deltas = {
+            state_group: {} for state_group in delta_groups
+        }  # type: Dict[int, MutableStateMap[str]]
+        for row in rows:
+            deltas[row["state_group"]][(row["type"], row["state_key"])] = row[
+                "event_id"
+            ]
+
+        return ancestors, deltas
+
     def _insert_into_cache(
         self,
         group_to_state_dict,
@@ -354,20 +554,50 @@ class StateGroupDataStore(StateBackgroundUpdateStore, SQLBaseStore):
                 else:
                     state_dict_non_members[k] = v
 
+            # Complete maps are stored as `FrozenStateMap`s, so that they can
+            # be shared with the maps of their descendants.
             self._state_group_members_cache.update(
                 cache_seq_num_members,
                 key=group,
-                value=state_dict_members,
+                value=state_dict_members
+                if member_types is not None
+                else FrozenStateMap(state_dict_members),
                 fetched_keys=member_types,
             )
 
             self._state_group_cache.update(
                 cache_seq_num_non_members,
                 key=group,
-                value=state_dict_non_members,
+                value=state_dict_non_members
+                if non_member_types is not None
+                else FrozenStateMap(state_dict_non_members),
                 fetched_keys=non_member_types,
             )
 
+    def _prefill_state_group_cache(
+        self,
+        cache: DictionaryCache,
+        sequence: int,
+        state_group: int,
+        prev_group: Optional[int],
+        delta_ids: Optional[StateMap[str]],
+        current_state_ids: StateMap[str],
+    ) -> None:
+        """Add the state of a newly stored state group to one of the state group
+        caches. If the cache has the state of the previous group then the new
+        map shares its entries.
+        """
+        prev_state = None
+        if prev_group is not None and delta_ids is not None:
+            prev_state = cache.get_full_value(prev_group)
+
+        if isinstance(prev_state, FrozenStateMap):
+            state = prev_state.with_delta(delta_ids)
+        else:
+            state = FrozenStateMap(current_state_ids)
+
+        cache.update(sequence, key=state_group, value=state)
+
     async def store_state_group(
         self, event_id, room_id, prev_group, delta_ids, current_state_ids
     ) -> int:
@@ -459,29 +689,19 @@ class StateGroupDataStore(StateBackgroundUpdateStore, SQLBaseStore):
             # is immutable. (If the map wasn't immutable then this prefill could
             # race with another update)
 
-            current_member_state_ids = {
-                s: ev
-                for (s, ev) in current_state_ids.items()
-                if s[0] == EventTypes.Member
-            }
-            txn.call_after(
-                self._state_group_members_cache.update,
-                self._state_group_members_cache.sequence,
-                key=state_group,
-                value=dict(current_member_state_ids),
-            )
-
-            current_non_member_state_ids = {
-                s: ev
-                for (s, ev) in current_state_ids.items()
-                if s[0] != EventTypes.Member
-            }
-            txn.call_after(
-                self._state_group_cache.update,
-                self._state_group_cache.sequence,
-                key=state_group,
-                value=dict(current_non_member_state_ids),
-            )
+            for cache, is_members_cache in (
+                (self._state_group_members_cache, True),
+                (self._state_group_cache, False),
+            ):
+                txn.call_after(
+                    self._prefill_state_group_cache,
+                    cache,
+                    cache.sequence,
+                    state_group,
+                    prev_group,
+                    _split_state(delta_ids, is_members_cache) if delta_ids else None,
+                    _split_state(current_state_ids, is_members_cache),
+                )
 
             return state_group
 
@@ -645,3 +865,8 @@ class StateGroupDataStore(StateBackgroundUpdateStore, SQLBaseStore):
             iterable=state_groups_to_delete,
             keyvalues={},
         )
+
+        # ... and the state compressor's progress through the room
+        self.db_pool.simple_delete_txn(
+            txn, table="state_compressor_progress", keyvalues={"room_id": room_id}
+        )
@@ -21,6 +21,7 @@ import attr
 from synapse.api.constants import EventTypes
 from synapse.events import EventBase
 from synapse.types import MutableStateMap, StateMap
+from synapse.util.state_map import copy_state_map
 
 logger = logging.getLogger(__name__)
 
@@ -243,7 +244,7 @@ class StateFilter:
             The filtered state map
         """
         if self.is_full():
-            return dict(state_dict)
+            return copy_state_map(state_dict)
 
         filtered_state = {}
         for k, v in state_dict.items():
@@ -347,6 +348,16 @@ class StateGroupStorage:
 
         return await self.stores.state.get_state_group_delta(state_group)
 
+    async def get_state_group_for_events(
+        self, event_ids: Iterable[str]
+    ) -> Dict[str, int]:
+        """Returns mapping event_id -> state_group
+
+        The mapping is cached, so this can be used to look up the state groups
+        of a batch of events in one go before looking up their state.
+        """
+        return await self.stores.main._get_state_group_for_events(event_ids)
+
     async def get_state_groups_ids(
         self, _room_id: str, event_ids: Iterable[str]
     ) -> Dict[int, MutableStateMap[str]]:
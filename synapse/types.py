@@ -646,12 +646,11 @@ class StreamToken:
             )
             return new_token
 
-        new_token = self.copy_and_replace(key, new_value)
-        new_id = int(getattr(new_token, key))
+        new_id = int(new_value)
         old_id = int(getattr(self, key))
 
         if old_id < new_id:
-            return new_token
+            return self.copy_and_replace(key, new_value)
         else:
             return self
 
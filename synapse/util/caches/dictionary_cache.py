@@ -19,6 +19,7 @@ from collections import namedtuple
 from typing import Any
 
 from synapse.util.caches.lrucache import LruCache
+from synapse.util.state_map import copy_state_map
 
 logger = logging.getLogger(__name__)
 
@@ -84,7 +85,7 @@ class DictionaryCache:
         if entry is not _Sentinel.sentinel:
             if dict_keys is None:
                 return DictionaryEntry(
-                    entry.full, entry.known_absent, dict(entry.value)
+                    entry.full, entry.known_absent, copy_state_map(entry.value)
                 )
             else:
                 return DictionaryEntry(
@@ -95,6 +96,18 @@ class DictionaryCache:
 
         return DictionaryEntry(False, set(), {})
 
+    def get_full_value(self, key):
+        """Fetch the complete dict for `key` without copying it, if the cache
+        has it. The returned value must not be modified.
+
+        Returns:
+            The dict, or None if the cache does not have all of it.
+        """
+        entry = self.cache.get(key, _Sentinel.sentinel, update_metrics=False)
+        if entry is not _Sentinel.sentinel and entry.full:
+            return entry.value
+        return None
+
     def invalidate(self, key):
         self.check_thread()
 
@@ -136,8 +149,10 @@ class DictionaryCache:
         # changed
 
         entry = self.cache.pop(key, DictionaryEntry(False, set(), {}))
-        entry.value.update(value)
-        entry.known_absent.update(known_absent)
+        if not entry.full:
+            # (full entries already have everything, and may be immutable)
+            entry.value.update(value)
+            entry.known_absent.update(known_absent)
         self.cache[key] = entry
 
     def _insert(self, key, value, known_absent):
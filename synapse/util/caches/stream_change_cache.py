@@ -212,3 +212,9 @@ class StreamChangeCache:
         entity.
         """
         return self._entity_to_key.get(entity, self._earliest_known_stream_pos)
+
+    def get_last_change_pos(self, entity: EntityType) -> Optional[int]:
+        """Returns the stream id of the last change to an entity, or None if the
+        entity hasn't changed since the earliest position the cache knows about.
+        """
+        return self._entity_to_key.get(entity)
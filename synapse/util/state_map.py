@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A compact, immutable representation of the state of a room.
+
+Rooms with lots of members have state maps with tens or hundreds of thousands
+of entries, and we hold many such maps in memory at once (e.g. one per cached
+state group), most of which differ from each other by only a handful of
+entries. `FrozenStateMap` reduces the memory used by these maps in two ways:
+
+ * the type, state key and event ID strings are interned, so that they are
+   shared between all the maps which contain them, rather than each map loaded
+   from the database having its own copies.
+ * a map can be built as a delta against another map (typically the state of
+   the previous state group), in which case it shares that map's entries,
+   rather than copying them.
+"""
+
+from sys import intern
+from typing import Dict, Iterator, Mapping, Optional, Set, TypeVar
+
+from synapse.types import StateKey, StateMap
+
+T = TypeVar("T")
+
+# The maximum number of maps that a `FrozenStateMap` will be layered on top
+# of. Beyond this we flatten the map, to keep lookups fast.
+MAX_STATE_MAP_DEPTH = 8
+
+
+def _intern_state(state: StateMap[str]) -> Dict[StateKey, str]:
+    return {
+        (intern(typ), intern(state_key)): intern(event_id)
+        for (typ, state_key), event_id in state.items()
+    }
+
+
+class FrozenStateMap(Mapping[StateKey, str]):
+    """An immutable map from (type, state_key) to event ID.
+
+    Args:
+        state: the contents of the map
+    """
+
+    __slots__ = ("_delta", "_parent", "_len", "_depth")
+
+    def __init__(self, state: Optional[StateMap[str]] = None):
+        # The entries in this map which are not in (or differ from) the parent
+        self._delta = _intern_state(state) if state else {}
+        self._parent = None  # type: Optional[FrozenStateMap]
+        self._len = len(self._delta)
+        self._depth = 0
+
+    def with_delta(self, delta: StateMap[str]) -> "FrozenStateMap":
+        """Returns a new map with the entries of this map, updated with the
+        given delta. The new map shares the entries of this map rather than
+        copying them.
+        """
+        if not delta:
+            return self
+
+        if self._depth >= MAX_STATE_MAP_DEPTH or len(delta) * 2 > self._len:
+            # Sharing isn't worth it (or we'd make the chain too long), so
+            # build a new flat map.
+            state = dict(self)
+            state.update(delta)
+            return FrozenStateMap(state)
+
+        new_map = FrozenStateMap(delta)
+        new_map._parent = self
+        new_map._len = self._len + sum(1 for key in new_map._delta if key not in self)
+        new_map._depth = self._depth + 1
+        return new_map
+
+    def _layers(self) -> Iterator["FrozenStateMap"]:
+        state_map = self  # type: Optional[FrozenStateMap]
+        while state_map is not None:
+            yield state_map
+            state_map = state_map._parent
+
+    def __getitem__(self, key: StateKey) -> str:
+        state_map = self  # type: Optional[FrozenStateMap]
+        while state_map is not None:
+            event_id = state_map._delta.get(key)
+            if event_id is not None:
+                return event_id
+            state_map = state_map._parent
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key) -> bool:
+        state_map = self  # type: Optional[FrozenStateMap]
+        while state_map is not None:
+            if key in state_map._delta:
+                return True
+            state_map = state_map._parent
+        return False
+
+    def __iter__(self) -> Iterator[StateKey]:
+        if self._parent is None:
+            return iter(self._delta)
+        return self._iter_layers()
+
+    def _iter_layers(self) -> Iterator[StateKey]:
+        # The keys we have already returned from higher layers. We don't need
+        # to track the keys of the bottom layer, which is usually the biggest.
+        seen = set()  # type: Set[StateKey]
+        for layer in self._layers():
+            if layer._parent is None:
+                for key in layer._delta:
+                    if key not in seen:
+                        yield key
+                return
+
+            for key in layer._delta:
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def to_dict(self) -> Dict[StateKey, str]:
+        """Returns a flat, mutable copy of this map.
+
+        This is much faster than `dict(state_map)`, which looks up every key
+        through all of the layers.
+        """
+        layers = list(self._layers())
+        state = dict(layers[-1]._delta)
+        for layer in reversed(layers[:-1]):
+            state.update(layer._delta)
+        return state
+
+    def items(self):
+        if self._parent is None:
+            return self._delta.items()
+        return self.to_dict().items()
+
+    def values(self):
+        if self._parent is None:
+            return self._delta.values()
+        return self.to_dict().values()
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __repr__(self) -> str:
+        return "FrozenStateMap(%r)" % (dict(self),)
+
+
+def copy_state_map(state: Mapping[StateKey, T]) -> Dict[StateKey, T]:
+    """Returns a flat, mutable copy of the given state map, which may be a
+    `FrozenStateMap`.
+    """
+    if isinstance(state, FrozenStateMap):
+        return state.to_dict()  # type: ignore
+    return dict(state)
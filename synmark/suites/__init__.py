@@ -1,4 +1,16 @@
-from . import logging, lrucache, lrucache_evict
+from . import (
+    event_auth,
+    event_auth_batch,
+    json_encoding,
+    json_encoding_fast,
+    logging,
+    lrucache,
+    lrucache_evict,
+    notifier,
+    state_res,
+    state_res_pool,
+    state_res_replay,
+)
 
 SUITES = [
     (logging, 1000),
@@ -6,4 +18,13 @@ SUITES = [
     (logging, None),
     (lrucache, None),
     (lrucache_evict, None),
+    (notifier, 10000),
+    (notifier, 50000),
+    (json_encoding, None),
+    (json_encoding_fast, None),
+    (state_res, None),
+    (state_res_pool, None),
+    (state_res_replay, None),
+    (event_auth, None),
+    (event_auth_batch, None),
 ]
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from pyperf import perf_counter
+
+from synapse import event_auth
+from synapse.api.constants import EventTypes, JoinRules, Membership
+from synapse.api.room_versions import RoomVersions
+from synapse.events import make_event_from_dict
+
+ROOM_ID = "!bench:example.com"
+CREATOR = "@creator:example.com"
+ROOM_VERSION = RoomVersions.V2
+
+
+def make_events(num_members=1000, events_per_member=5):
+    """
+    Build the events of a busy room, along with the auth events for each, in
+    the form that they'd arrive in a `/send_join` response or a backfill.
+    """
+    next_id = [0]
+
+    def make_event(event_type, sender, content, state_key=None):
+        event_dict = {
+            "event_id": "$%d:example.com" % (next_id[0],),
+            "room_id": ROOM_ID,
+            "type": event_type,
+            "sender": sender,
+            "content": content,
+            "origin_server_ts": next_id[0],
+            "prev_events": [],
+            "auth_events": [],
+        }
+        if state_key is not None:
+            event_dict["state_key"] = state_key
+        next_id[0] += 1
+        return make_event_from_dict(event_dict, ROOM_VERSION)
+
+    members = ["@user%d:example.com" % (i,) for i in range(num_members)]
+
+    create = make_event(EventTypes.Create, CREATOR, {"creator": CREATOR}, "")
+    power_levels = make_event(
+        EventTypes.PowerLevels,
+        CREATOR,
+        {
+            "users": dict(
+                [(CREATOR, 100)]
+                + [(user_id, i % 50) for i, user_id in enumerate(members)]
+            ),
+            "events": {EventTypes.Name: 50, EventTypes.Topic: 20},
+        },
+        "",
+    )
+    join_rules = make_event(
+        EventTypes.JoinRules, CREATOR, {"join_rule": JoinRules.PUBLIC}, ""
+    )
+
+    base_auth_events = {
+        (EventTypes.Create, ""): create,
+        (EventTypes.PowerLevels, ""): power_levels,
+        (EventTypes.JoinRules, ""): join_rules,
+    }
+
+    events_and_auth = []
+    for user_id in members:
+        auth_events = dict(base_auth_events)
+        join = make_event(
+            EventTypes.Member, user_id, {"membership": Membership.JOIN}, user_id
+        )
+        events_and_auth.append((join, dict(auth_events)))
+
+        auth_events[(EventTypes.Member, user_id)] = join
+        for i in range(events_per_member):
+            if i % 2:
+                event = make_event(EventTypes.Topic, user_id, {"topic": "x"}, "")
+            else:
+                event = make_event(EventTypes.Message, user_id, {"body": "x"})
+            events_and_auth.append((event, auth_events))
+
+    return events_and_auth
+
+
+async def main(reactor, loops):
+    """
+    Benchmark auth checking `loops` batches of events, one event at a time.
+    """
+    events_and_auth = make_events()
+
+    start = perf_counter()
+
+    for i in range(loops):
+        for event, auth_events in events_and_auth:
+            try:
+                event_auth.check(
+                    ROOM_VERSION,
+                    event,
+                    auth_events,
+                    do_sig_check=False,
+                    do_size_check=False,
+                )
+            except Exception:
+                pass
+
+    end = perf_counter() - start
+
+    return end
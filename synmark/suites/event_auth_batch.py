@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from pyperf import perf_counter
+
+from synapse import event_auth
+
+from synmark.suites.event_auth import ROOM_VERSION, make_events
+
+
+async def main(reactor, loops):
+    """
+    Benchmark auth checking `loops` batches of events, using `check_batch`.
+    """
+    events_and_auth = make_events()
+
+    start = perf_counter()
+
+    for i in range(loops):
+        event_auth.check_batch(
+            ROOM_VERSION, events_and_auth, do_sig_check=False, do_size_check=False
+        )
+
+    end = perf_counter() - start
+
+    return end
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from pyperf import perf_counter
+
+from synapse.http.server import _encode_json_bytes
+
+
+def make_sync_response(num_rooms=50, num_events=20):
+    """
+    Build a dict shaped like a /sync response, with `num_events` timeline and
+    state events in each of `num_rooms` rooms.
+    """
+
+    def make_event(room_id, i):
+        return {
+            "type": "m.room.message",
+            "sender": "@user%d:example.com" % (i,),
+            "event_id": "$%s_%d:example.com" % (room_id, i),
+            "origin_server_ts": 1600000000000 + i,
+            "content": {"msgtype": "m.text", "body": "Message number %d ☃" % (i,)},
+            "unsigned": {"age": 1234},
+        }
+
+    def make_state_event(room_id, i):
+        return {
+            "type": "m.room.member",
+            "sender": "@user%d:example.com" % (i,),
+            "state_key": "@user%d:example.com" % (i,),
+            "event_id": "$%s_state_%d:example.com" % (room_id, i),
+            "origin_server_ts": 1600000000000 + i,
+            "content": {"membership": "join", "displayname": "User %d" % (i,)},
+            "unsigned": {"age": 1234},
+        }
+
+    rooms = {}
+    for r in range(num_rooms):
+        room_id = "!room%d:example.com" % (r,)
+        rooms[room_id] = {
+            "timeline": {
+                "events": [make_event(room_id, i) for i in range(num_events)],
+                "limited": True,
+                "prev_batch": "t1-2_3_4_5_6_7_8_9",
+            },
+            "state": {
+                "events": [make_state_event(room_id, i) for i in range(num_events)]
+            },
+            "account_data": {"events": []},
+            "ephemeral": {"events": []},
+            "unread_notifications": {"notification_count": 0, "highlight_count": 0},
+            "summary": {},
+        }
+
+    return {
+        "next_batch": "s1_2_3_4_5_6_7_8_9",
+        "rooms": {"join": rooms, "invite": {}, "leave": {}},
+        "presence": {"events": []},
+        "account_data": {"events": []},
+        "to_device": {"events": []},
+        "device_lists": {"changed": [], "left": []},
+        "device_one_time_keys_count": {},
+    }
+
+
+async def main(reactor, loops):
+    """
+    Benchmark `loops` number of encodings of a large /sync response with the
+    pure-python JSON encoder.
+    """
+    response = make_sync_response()
+
+    start = perf_counter()
+
+    for i in range(loops):
+        b"".join(_encode_json_bytes(response))
+
+    end = perf_counter() - start
+
+    return end
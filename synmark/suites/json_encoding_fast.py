@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from pyperf import perf_counter
+
+from synapse.util import fast_encode_json
+
+from synmark.suites.json_encoding import make_sync_response
+
+
+async def main(reactor, loops):
+    """
+    Benchmark `loops` number of encodings of a large /sync response with the
+    fast (orjson) JSON encoder. Requires orjson to be installed.
+    """
+    response = make_sync_response()
+
+    if fast_encode_json(response) is None:
+        raise Exception("orjson is not installed")
+
+    start = perf_counter()
+
+    for i in range(loops):
+        fast_encode_json(response)
+
+    end = perf_counter() - start
+
+    return end
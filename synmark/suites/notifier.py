@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import Mock
+
+from pyperf import perf_counter
+
+from synapse.notifier import Notifier, _NotifierUserStream
+from synapse.types import StreamToken
+
+# Each user is in this many rooms, and each room has this many users.
+ROOMS_PER_USER = 10
+USERS_PER_ROOM = 100
+
+
+class _Clock:
+    """A clock which only moves when told to, and never calls anything."""
+
+    def __init__(self):
+        self.now_ms = 0
+
+    def time(self):
+        return self.now_ms / 1000.0
+
+    def time_msec(self):
+        return self.now_ms
+
+    def looping_call(self, f, msec, *args, **kwargs):
+        pass
+
+    def call_later(self, delay, callback, *args, **kwargs):
+        pass
+
+
+async def main(reactor, loops):
+    """
+    Benchmark registering `loops` user streams with the notifier and waiting
+    on them, notifying every room they are in, and then expiring them.
+    """
+    clock = _Clock()
+    hs = Mock()
+    hs.get_clock.return_value = clock
+    hs.config.notifier_coalescing_enabled = False
+    hs.should_send_federation.return_value = False
+    notifier = Notifier(hs)
+
+    num_rooms = max(loops * ROOMS_PER_USER // USERS_PER_ROOM, 1)
+    room_ids = ["!room%d:test" % (i,) for i in range(num_rooms)]
+
+    start = perf_counter()
+
+    for i in range(loops):
+        user_stream = _NotifierUserStream(
+            user_id="@user%d:test" % (i,),
+            rooms=[
+                room_ids[(i * ROOMS_PER_USER + j) % num_rooms]
+                for j in range(ROOMS_PER_USER)
+            ],
+            current_token=StreamToken.START,
+            time_now_ms=clock.time_msec(),
+        )
+        notifier._register_with_keys(user_stream)
+
+        # Each user is waiting for something to happen.
+        user_stream.new_listener(StreamToken.START)
+
+    for i, room_id in enumerate(room_ids):
+        notifier.on_new_event("typing_key", i + 1, rooms=[room_id])
+
+    # Check for expired streams as often as a homeserver would, until they
+    # have all expired.
+    expire_at_ms = clock.now_ms + 2 * notifier.UNUSED_STREAM_EXPIRY_MS
+    while clock.now_ms < expire_at_ms:
+        clock.now_ms += notifier.STREAM_EXPIRY_CHECK_INTERVAL_MS
+        notifier.remove_expired_streams()
+
+    end = perf_counter() - start
+
+    assert not notifier.user_to_user_stream
+
+    return end
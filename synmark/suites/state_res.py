@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from pyperf import perf_counter
+
+from synapse.api.constants import EventTypes, JoinRules, Membership
+from synapse.api.room_versions import RoomVersions
+from synapse.event_auth import auth_types_for_event
+from synapse.events import make_event_from_dict
+from synapse.state import v2
+from synapse.util import Clock
+
+ROOM_ID = "!bench:example.com"
+CREATOR = "@creator:example.com"
+MODERATOR = "@moderator:example.com"
+ROOM_VERSION = RoomVersions.V2
+
+
+class ForkedRoom:
+    """
+    A synthetic room whose DAG has forked into two branches, each of which has
+    changed the power levels and membership of the room.
+    """
+
+    def __init__(self, num_members=200, fork_length=100):
+        self.event_map = {}
+        self._next_ts = 0
+
+        state = {}
+        self._add_event(state, EventTypes.Create, "", CREATOR, {"creator": CREATOR})
+        self._add_event(
+            state, EventTypes.Member, CREATOR, CREATOR, {"membership": Membership.JOIN}
+        )
+        self._add_event(
+            state,
+            EventTypes.PowerLevels,
+            "",
+            CREATOR,
+            {"users": {CREATOR: 100, MODERATOR: 50}},
+        )
+        self._add_event(
+            state, EventTypes.JoinRules, "", CREATOR, {"join_rule": JoinRules.PUBLIC}
+        )
+
+        members = [MODERATOR] + [
+            "@user%d:example.com" % (i,) for i in range(num_members)
+        ]
+        for user_id in members:
+            self._add_event(
+                state, EventTypes.Member, user_id, user_id, {"membership": "join"}
+            )
+
+        # on one branch the creator keeps changing the power levels...
+        fork_a = dict(state)
+        for i in range(fork_length):
+            users = {CREATOR: 100, MODERATOR: 50 if i % 2 else 0}
+            self._add_event(
+                fork_a, EventTypes.PowerLevels, "", CREATOR, {"users": users}
+            )
+
+        # ... while on the other the moderator bans people.
+        fork_b = dict(state)
+        for user_id in members[1 : fork_length + 1]:
+            self._add_event(
+                fork_b, EventTypes.Member, user_id, MODERATOR, {"membership": "ban"}
+            )
+
+        self.state_sets = [fork_a, fork_b]
+
+    def _add_event(self, state, event_type, state_key, sender, content):
+        event_id = "$%d:example.com" % (len(self.event_map),)
+        event_dict = {
+            "event_id": event_id,
+            "room_id": ROOM_ID,
+            "type": event_type,
+            "state_key": state_key,
+            "sender": sender,
+            "content": content,
+            "origin_server_ts": self._next_ts,
+            "prev_events": [],
+            "auth_events": [],
+        }
+        self._next_ts += 1
+
+        auth_types = auth_types_for_event(make_event_from_dict(event_dict))
+        event_dict["auth_events"] = [
+            (state[key], {}) for key in auth_types if key in state
+        ]
+
+        self.event_map[event_id] = make_event_from_dict(event_dict, ROOM_VERSION)
+        state[(event_type, state_key)] = event_id
+
+
+class ForkedRoomStore:
+    """
+    A `StateResolutionStore` for a `ForkedRoom`.
+    """
+
+    def __init__(self, room):
+        self._room = room
+
+    async def get_events(self, event_ids, allow_rejected=False):
+        return {
+            eid: self._room.event_map[eid]
+            for eid in event_ids
+            if eid in self._room.event_map
+        }
+
+    def _get_auth_chain(self, event_ids):
+        result = set()
+        stack = list(event_ids)
+        while stack:
+            event_id = stack.pop()
+            if event_id in result:
+                continue
+
+            result.add(event_id)
+            stack.extend(self._room.event_map[event_id].auth_event_ids())
+
+        return result
+
+    async def get_auth_chain_difference(self, room_id, state_sets):
+        chains = [self._get_auth_chain(s) for s in state_sets]
+        return set.union(*chains) - set.intersection(*chains)
+
+
+async def main(reactor, loops):
+    """
+    Benchmark `loops` number of v2 state resolutions of a forked room, in the
+    main process.
+    """
+    room = ForkedRoom()
+    store = ForkedRoomStore(room)
+    clock = Clock(reactor)
+
+    start = perf_counter()
+
+    for i in range(loops):
+        await v2.resolve_events_with_store(
+            clock, ROOM_ID, ROOM_VERSION.identifier, room.state_sets, {}, store
+        )
+
+    end = perf_counter() - start
+
+    return end
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from pyperf import perf_counter
+
+from synapse.state.process_pool import StateResolutionProcessPool
+from synapse.util import Clock
+
+from synmark.suites.state_res import ROOM_ID, ROOM_VERSION, ForkedRoom, ForkedRoomStore
+
+
+async def main(reactor, loops):
+    """
+    Benchmark `loops` number of v2 state resolutions of a forked room, using
+    the state resolution process pool.
+    """
+    room = ForkedRoom()
+    store = ForkedRoomStore(room)
+    clock = Clock(reactor)
+    pool = StateResolutionProcessPool(reactor, 2)
+
+    # warm up the pool, so that we don't measure starting the processes.
+    await pool.resolve_events_with_store(
+        clock, ROOM_ID, ROOM_VERSION.identifier, room.state_sets, {}, store
+    )
+
+    start = perf_counter()
+
+    for i in range(loops):
+        await pool.resolve_events_with_store(
+            clock, ROOM_ID, ROOM_VERSION.identifier, room.state_sets, {}, store
+        )
+
+    end = perf_counter() - start
+
+    return end
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+
+from pyperf import perf_counter
+
+from synapse.api.room_versions import KNOWN_ROOM_VERSIONS, StateResolutionVersions
+from synapse.state import v1, v2
+from synapse.state.dump import RecordingStateResolutionStore, decode_dump
+from synapse.util import Clock
+
+from synmark.suites.state_res import ROOM_ID, ROOM_VERSION, ForkedRoom, ForkedRoomStore
+
+
+async def _load_dump(clock):
+    """
+    Load the dump named by the SYNMARK_STATE_RES_DUMP environment variable, or
+    if it isn't set, record a dump of resolving a forked room.
+    """
+    path = os.environ.get("SYNMARK_STATE_RES_DUMP")
+    if path:
+        with open(path) as f:
+            return decode_dump(json.load(f))
+
+    room = ForkedRoom()
+    store = RecordingStateResolutionStore(ForkedRoomStore(room))
+    await v2.resolve_events_with_store(
+        clock, ROOM_ID, ROOM_VERSION.identifier, room.state_sets, {}, store
+    )
+    dump = store.encode(ROOM_ID, ROOM_VERSION.identifier, room.state_sets)
+    return decode_dump(json.loads(json.dumps(dump)))
+
+
+async def main(reactor, loops):
+    """
+    Benchmark `loops` number of replays of a dumped state resolution.
+    """
+    clock = Clock(reactor)
+    room_id, room_version, state_sets, store = await _load_dump(clock)
+
+    start = perf_counter()
+
+    for i in range(loops):
+        if KNOWN_ROOM_VERSIONS[room_version].state_res == StateResolutionVersions.V1:
+            await v1.resolve_events_with_store(
+                room_id, state_sets, {}, store.get_events
+            )
+        else:
+            await v2.resolve_events_with_store(
+                clock, room_id, room_version, state_sets, {}, store
+            )
+
+    end = perf_counter() - start
+
+    return end
@@ -82,3 +82,20 @@ class FrontendProxyTests(HomeserverTestCase):
         # 401, because the stub servlet still checks authentication
         self.assertEqual(channel.code, 401)
         self.assertEqual(channel.json_body["errcode"], "M_MISSING_TOKEN")
+
+    def test_listen_http_serves_slow_syncs(self):
+        """
+        The slow syncs admin API is served alongside /sync.
+        """
+        self.hs._listen_http(self.hs.config.worker.worker_listeners[0])
+
+        self.assertEqual(len(self.reactor.tcpServers), 1)
+        site = self.reactor.tcpServers[0][1]
+
+        _, channel = make_request(
+            self.reactor, site, "GET", "/_synapse/admin/v1/sync/slowest"
+        )
+
+        # 401, because the servlet is registered and checks authentication
+        self.assertEqual(channel.code, 401)
+        self.assertEqual(channel.json_body["errcode"], "M_MISSING_TOKEN")
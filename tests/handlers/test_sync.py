@@ -13,13 +13,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from synapse.api.constants import EventTypes
 from synapse.api.errors import Codes, ResourceLimitError
-from synapse.api.filtering import DEFAULT_FILTER_COLLECTION
+from synapse.api.filtering import DEFAULT_FILTER_COLLECTION, FilterCollection
 from synapse.handlers.sync import SyncConfig
+from synapse.rest import admin
+from synapse.rest.client.v1 import login, room
+from synapse.storage.databases.main.lazy_loaded_members import hash_member_event_id
 from synapse.types import UserID, create_requester
 
 import tests.unittest
 import tests.utils
+from tests.unittest import override_config
 
 
 class SyncTestCase(tests.unittest.HomeserverTestCase):
@@ -77,3 +82,338 @@ class SyncTestCase(tests.unittest.HomeserverTestCase):
             request_key="request_key",
             device_id="device_id",
         )
+
+
+class BaseSyncRoomTestCase(tests.unittest.HomeserverTestCase):
+    """Base class for tests which sync two users who share a room."""
+
+    servlets = [
+        admin.register_servlets,
+        login.register_servlets,
+        room.register_servlets,
+    ]
+
+    def prepare(self, reactor, clock, hs):
+        self.sync_handler = hs.get_sync_handler()
+        self.store = hs.get_datastore()
+
+        self.user_id1 = self.register_user("user1", "pass")
+        self.tok1 = self.login("user1", "pass")
+        self.user_id2 = self.register_user("user2", "pass")
+        self.tok2 = self.login("user2", "pass")
+
+        self.room_id = self.helper.create_room_as(self.user_id1, tok=self.tok1)
+        self.helper.join(self.room_id, self.user_id2, tok=self.tok2)
+
+    def _sync(
+        self, user_id, since_token=None, filter_collection=DEFAULT_FILTER_COLLECTION
+    ):
+        return self.get_success(
+            self.sync_handler.wait_for_sync_for_user(
+                create_requester(user_id),
+                SyncConfig(
+                    user=UserID.from_string(user_id),
+                    filter_collection=filter_collection,
+                    is_guest=False,
+                    request_key=("request_key", user_id, since_token),
+                    device_id="device_id",
+                ),
+                since_token=since_token,
+            )
+        )
+
+
+class SyncSnapshotTestCase(BaseSyncRoomTestCase):
+    """Tests reusing room entries from sync snapshots in initial syncs."""
+
+    def default_config(self):
+        config = super().default_config()
+        config["sync_snapshots"] = {"enabled": True, "min_rooms": 1}
+        return config
+
+    def prepare(self, reactor, clock, hs):
+        super().prepare(reactor, clock, hs)
+
+        # Record which rooms we calculate timelines for.
+        self.loaded_rooms = []
+        load_filtered_recents = self.sync_handler._load_filtered_recents
+
+        async def _load_filtered_recents(room_id, *args, **kwargs):
+            self.loaded_rooms.append(room_id)
+            return await load_filtered_recents(room_id, *args, **kwargs)
+
+        self.sync_handler._load_filtered_recents = _load_filtered_recents
+
+    def _initial_sync(self):
+        self.loaded_rooms = []
+        result = self._sync(self.user_id1)
+        return {
+            room_result.room_id: [e.event_id for e in room_result.timeline.events]
+            for room_result in result.joined
+        }
+
+    def test_reuse_snapshot(self):
+        room_id1 = self.room_id
+        room_id2 = self.helper.create_room_as(self.user_id1, tok=self.tok1)
+
+        first = self._initial_sync()
+        self.assertCountEqual(self.loaded_rooms, [room_id1, room_id2])
+
+        # The room entries should now have been stored in the snapshot, so will
+        # be reused by the next initial sync.
+        second = self._initial_sync()
+        self.assertEqual(self.loaded_rooms, [])
+        self.assertEqual(second, first)
+
+        # Only the room which has changed since should be recalculated.
+        event_id = self.helper.send(room_id2, "hello", tok=self.tok1)["event_id"]
+
+        third = self._initial_sync()
+        self.assertEqual(self.loaded_rooms, [room_id2])
+        self.assertEqual(third[room_id1], first[room_id1])
+        self.assertEqual(third[room_id2][-1], event_id)
+
+    def _initial_sync_events(self, user_id):
+        """Do an initial sync, and return the timeline and state events of each
+        room as dicts.
+        """
+        self.loaded_rooms = []
+        result = self._sync(user_id)
+        return {
+            room_result.room_id: (
+                [
+                    dict(e.get_dict(), event_id=e.event_id)
+                    for e in room_result.timeline.events
+                ],
+                {k: e.get_dict() for k, e in room_result.state.items()},
+            )
+            for room_result in result.joined
+        }
+
+    def test_snapshot_matches_fresh_sync(self):
+        for name in ("first name", "second name"):
+            self.helper.send_state(
+                self.room_id, EventTypes.Name, {"name": name}, tok=self.tok1
+            )
+        event_id = self.helper.send(self.room_id, "hello", tok=self.tok2)["event_id"]
+
+        # Erasure only affects users who join after the event was sent.
+        user_id3 = self.register_user("user3", "pass")
+        tok3 = self.login("user3", "pass")
+        self.helper.join(self.room_id, user_id3, tok=tok3)
+
+        self._initial_sync_events(user_id3)
+        self.get_success(self.store.mark_user_erased(self.user_id2))
+
+        from_snapshot = self._initial_sync_events(user_id3)
+        self.assertEqual(self.loaded_rooms, [])
+
+        self.sync_handler._sync_snapshots_enabled = False
+        fresh = self._initial_sync_events(user_id3)
+        self.assertEqual(self.loaded_rooms, [self.room_id])
+        self.assertEqual(from_snapshot, fresh)
+
+        # The erased sender's message is pruned, and state events in the
+        # timeline have their previous content.
+        timeline = {e["event_id"]: e for e in from_snapshot[self.room_id][0]}
+        self.assertEqual(timeline[event_id]["content"], {})
+        (name_event,) = [
+            e
+            for e in timeline.values()
+            if e["type"] == EventTypes.Name and e["content"]["name"] == "second name"
+        ]
+        self.assertEqual(name_event["unsigned"]["prev_content"], {"name": "first name"})
+
+    def test_left_room_removed_from_snapshot(self):
+        room_id1 = self.room_id
+        room_id2 = self.helper.create_room_as(self.user_id1, tok=self.tok1)
+
+        self._initial_sync()
+        self.helper.leave(room_id2, self.user_id1, tok=self.tok1)
+
+        self.assertEqual(list(self._initial_sync()), [room_id1])
+
+        snapshots = self.get_success(
+            self.store.db_pool.simple_select_onecol(
+                table="sync_snapshot_rooms",
+                keyvalues={"user_id": self.user_id1},
+                retcol="room_id",
+            )
+        )
+        self.assertEqual(snapshots, [room_id1])
+
+
+class SyncFragmentCacheTestCase(BaseSyncRoomTestCase):
+    """Tests sharing timeline and state delta fragments between users' syncs."""
+
+    def test_gappy_sync_shares_state_delta(self):
+        since_token = self._sync(self.user_id1).next_batch
+
+        # Send more events than fit in the timeline, so that the syncs are
+        # gappy.
+        for i in range(15):
+            self.helper.send(self.room_id, "message %d" % (i,), tok=self.tok1)
+
+        # Record the state lookups which the fragments should save.
+        state_loads = []
+        get_state_at = self.sync_handler.get_state_at
+
+        async def _get_state_at(room_id, *args, **kwargs):
+            state_loads.append(room_id)
+            return await get_state_at(room_id, *args, **kwargs)
+
+        self.sync_handler.get_state_at = _get_state_at
+
+        result1 = self._sync(self.user_id1, since_token)
+        self.assertEqual(state_loads, [self.room_id])
+
+        # The second user sees the same timeline, so should reuse the state
+        # delta calculated for the first.
+        result2 = self._sync(self.user_id2, since_token)
+        self.assertEqual(state_loads, [self.room_id])
+
+        self.assertEqual(len(result1.joined), 1)
+        self.assertEqual(len(result2.joined), 1)
+        room1 = result1.joined[0]
+        room2 = result2.joined[0]
+        self.assertTrue(room2.timeline.limited)
+        self.assertEqual(
+            [e.event_id for e in room2.timeline.events],
+            [e.event_id for e in room1.timeline.events],
+        )
+        self.assertEqual(
+            room2.timeline.prev_batch.room_key.stream,
+            room1.timeline.prev_batch.room_key.stream,
+        )
+        self.assertEqual(
+            {k: e.event_id for k, e in room2.state.items()},
+            {k: e.event_id for k, e in room1.state.items()},
+        )
+
+    def test_timeline_fragment_applies_redactions(self):
+        event_id = self.helper.send(self.room_id, "hello", tok=self.tok1)["event_id"]
+        end_key = self.store.get_room_max_token()
+
+        events, _ = self.get_success(
+            self.sync_handler._load_timeline_fragment(self.room_id, None, end_key, 5)
+        )
+        self.assertEqual(events[-1].event_id, event_id)
+        self.assertEqual(events[-1].content, {"body": "hello", "msgtype": "m.text"})
+        after = events[-1].internal_metadata.after
+
+        request, channel = self.make_request(
+            "POST",
+            "/_matrix/client/r0/rooms/%s/redact/%s" % (self.room_id, event_id),
+            content={},
+            access_token=self.tok1,
+        )
+        self.assertEqual(channel.code, 200, channel.json_body)
+
+        events, _ = self.get_success(
+            self.sync_handler._load_timeline_fragment(self.room_id, None, end_key, 5)
+        )
+        self.assertEqual(events[-1].event_id, event_id)
+        self.assertEqual(events[-1].content, {})
+        self.assertEqual(events[-1].internal_metadata.after.stream, after.stream)
+
+
+class LazyLoadedMembersPersistenceTestCase(BaseSyncRoomTestCase):
+    """Tests remembering the lazy-loaded members sent to clients in the
+    database.
+    """
+
+    def _sync_user2(self, since_token=None):
+        return self._sync(
+            self.user_id2,
+            since_token,
+            FilterCollection({"room": {"state": {"lazy_load_members": True}}}),
+        )
+
+    def _restart(self):
+        """Write the members sent to the database, and forget everything
+        remembered in memory, as if the server had restarted.
+        """
+        self.reactor.advance(10)
+        self.sync_handler.lazy_loaded_members_cache.pop(
+            (self.user_id2, "device_id"), None
+        )
+        self.sync_handler._persisted_lazy_loaded_members.pop(
+            (self.user_id2, "device_id", self.room_id), None
+        )
+
+    def _sync_members_sent(self, since_token):
+        """Send a message from the first user, and return the member state
+        events sent to the second user in an incremental sync.
+        """
+        self.helper.send(self.room_id, "hello", tok=self.tok1)
+        result = self._sync_user2(since_token)
+        self.assertEqual(len(result.joined), 1)
+        members = [
+            state_key
+            for (typ, state_key) in result.joined[0].state
+            if typ == EventTypes.Member
+        ]
+        return members, result.next_batch
+
+    @override_config({"lazy_loaded_members_persistence": {"enabled": True}})
+    def test_members_not_resent_after_restart(self):
+        result = self._sync_user2()
+        room_result = result.joined[0]
+        self.assertIn(
+            (EventTypes.Member, self.user_id1),
+            [(e.type, e.state_key) for e in room_result.timeline.events]
+            + list(room_result.state),
+        )
+
+        self._restart()
+
+        members, _ = self._sync_members_sent(result.next_batch)
+        self.assertEqual(members, [])
+
+    @override_config({"lazy_loaded_members_persistence": {"enabled": True}})
+    def test_new_sync_sequence_resets_members(self):
+        self._sync_user2()
+        self._restart()
+
+        key = (self.user_id2, "device_id", self.room_id)
+        sent = self.get_success(self.store.get_lazy_loaded_members_sent(*key))
+        self.assertNotEqual(sent, [])
+
+        # Pretend we sent another member in the first sync sequence.
+        other = hash_member_event_id("$other")
+        self.get_success(
+            self.store.update_lazy_loaded_members_sent({key: (False, [other])})
+        )
+
+        # A new sync sequence should forget the members sent in previous ones.
+        self._sync_user2()
+        self._restart()
+        self.assertEqual(
+            self.get_success(self.store.get_lazy_loaded_members_sent(*key)), sent
+        )
+
+    @override_config({"lazy_loaded_members_persistence": {"enabled": True}})
+    def test_cache_size_is_number_of_hashes(self):
+        cache = self.sync_handler._persisted_lazy_loaded_members
+        key = (self.user_id2, "device_id", self.room_id)
+
+        since_token = self._sync_user2().next_batch
+        self.assertEqual(len(cache), len(cache.get(key)[1]))
+        size = len(cache)
+
+        # A new member sent in an incremental sync grows the cached entry, and
+        # the size of the cache with it.
+        user_id3 = self.register_user("user3", "pass")
+        tok3 = self.login("user3", "pass")
+        self.helper.join(self.room_id, user_id3, tok=tok3)
+        self.helper.send(self.room_id, "hello", tok=tok3)
+        self._sync_user2(since_token)
+        self.assertEqual(len(cache.get(key)[1]), size + 1)
+        self.assertEqual(len(cache), size + 1)
+
+    def test_members_resent_after_restart_when_disabled(self):
+        since_token = self._sync_user2().next_batch
+        self._restart()
+
+        members, _ = self._sync_members_sent(since_token)
+        self.assertEqual(members, [self.user_id1])
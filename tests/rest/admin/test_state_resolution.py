@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+
+from mock import Mock
+
+import synapse.rest.admin
+from synapse.api.constants import EventTypes
+from synapse.api.errors import Codes
+from synapse.api.room_versions import RoomVersions
+from synapse.events import make_event_from_dict
+from synapse.rest.client.v1 import login
+from synapse.state.dump import decode_dump
+
+from tests import unittest
+from tests.test_utils import make_awaitable
+
+ROOM_ID = "!room:test"
+
+EVENTS = {
+    "$create:test": make_event_from_dict(
+        {
+            "event_id": "$create:test",
+            "room_id": ROOM_ID,
+            "type": EventTypes.Create,
+            "state_key": "",
+            "sender": "@creator:test",
+            "content": {"creator": "@creator:test"},
+            "auth_events": [],
+            "prev_events": [],
+            "origin_server_ts": 0,
+        },
+        RoomVersions.V2,
+    ),
+    "$name:test": make_event_from_dict(
+        {
+            "event_id": "$name:test",
+            "room_id": ROOM_ID,
+            "type": EventTypes.Name,
+            "state_key": "",
+            "sender": "@creator:test",
+            "content": {"name": "A room"},
+            "auth_events": [("$create:test", {})],
+            "prev_events": [],
+            "origin_server_ts": 1,
+        },
+        RoomVersions.V2,
+    ),
+}
+
+STATE_SETS = [
+    {(EventTypes.Create, ""): "$create:test", (EventTypes.Name, ""): "$name:test"},
+    {(EventTypes.Create, ""): "$create:test"},
+]
+
+
+class SlowStateResolutionsTestCase(unittest.HomeserverTestCase):
+    servlets = [
+        synapse.rest.admin.register_servlets,
+        login.register_servlets,
+    ]
+
+    def default_config(self):
+        config = super().default_config()
+
+        self.dump_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dump_directory)
+        config["state_resolution_profiling"] = {
+            "dump_directory": self.dump_directory,
+            "dump_threshold": 0,
+        }
+        return config
+
+    def prepare(self, reactor, clock, hs):
+        self.state_res_handler = hs.get_state_resolution_handler()
+
+        self.admin_user = self.register_user("admin", "pass", admin=True)
+        self.admin_user_tok = self.login("admin", "pass")
+
+        self.other_user = self.register_user("user", "pass")
+        self.other_user_tok = self.login("user", "pass")
+
+        self.url = "/_synapse/admin/v1/state_resolution/slowest"
+
+    def _resolve(self):
+        store = Mock()
+        store.get_events.side_effect = lambda event_ids, allow_rejected: (
+            make_awaitable({eid: EVENTS[eid] for eid in event_ids if eid in EVENTS})
+        )
+        store.get_auth_chain_difference.return_value = make_awaitable(set())
+
+        return self.get_success(
+            self.state_res_handler.resolve_events_with_store(
+                ROOM_ID, RoomVersions.V2.identifier, STATE_SETS, {}, store
+            )
+        )
+
+    def test_requester_is_no_admin(self):
+        """
+        If the user is not a server admin, an error 403 is returned.
+        """
+        request, channel = self.make_request(
+            "GET", self.url, access_token=self.other_user_tok,
+        )
+
+        self.assertEqual(403, int(channel.result["code"]), msg=channel.result["body"])
+        self.assertEqual(Codes.FORBIDDEN, channel.json_body["errcode"])
+
+    def test_slowest(self):
+        """
+        Recent resolutions are returned, with the size of their conflicts.
+        """
+        self._resolve()
+        self._resolve()
+
+        request, channel = self.make_request(
+            "GET", self.url + "?limit=1", access_token=self.admin_user_tok,
+        )
+
+        self.assertEqual(200, int(channel.result["code"]), msg=channel.result["body"])
+        self.assertEqual(channel.json_body["total"], 2)
+        self.assertEqual(len(channel.json_body["resolutions"]), 1)
+
+        resolution = channel.json_body["resolutions"][0]
+        self.assertEqual(resolution["room_id"], ROOM_ID)
+        self.assertEqual(resolution["room_version"], RoomVersions.V2.identifier)
+        self.assertEqual(resolution["state_sets"], 2)
+        self.assertEqual(resolution["conflicted_state_keys"], 1)
+        self.assertEqual(resolution["conflicted_events"], 1)
+
+        # old resolutions should be forgotten.
+        self.reactor.advance(2 * 60 * 60)
+
+        request, channel = self.make_request(
+            "GET", self.url, access_token=self.admin_user_tok,
+        )
+
+        self.assertEqual(200, int(channel.result["code"]), msg=channel.result["body"])
+        self.assertEqual(channel.json_body, {"resolutions": [], "total": 0})
+
+    def test_dump(self):
+        """
+        The inputs of slow resolutions are dumped to the configured directory.
+        """
+        self._resolve()
+        self.pump()
+
+        (filename,) = os.listdir(self.dump_directory)
+        with open(os.path.join(self.dump_directory, filename)) as f:
+            room_id, room_version, state_sets, _ = decode_dump(json.load(f))
+
+        self.assertEqual(room_id, ROOM_ID)
+        self.assertEqual(room_version, RoomVersions.V2.identifier)
+        self.assertEqual(state_sets, STATE_SETS)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import synapse.rest.admin
+from synapse.api.errors import Codes
+from synapse.rest.client.v1 import login
+from synapse.rest.client.v2_alpha import sync
+
+from tests import unittest
+from tests.unittest import override_config
+
+
+class SlowSyncsTestCase(unittest.HomeserverTestCase):
+    servlets = [
+        synapse.rest.admin.register_servlets,
+        login.register_servlets,
+        sync.register_servlets,
+    ]
+
+    def prepare(self, reactor, clock, hs):
+        self.admin_user = self.register_user("admin", "pass", admin=True)
+        self.admin_user_tok = self.login("admin", "pass")
+
+        self.other_user = self.register_user("user", "pass")
+        self.other_user_tok = self.login("user", "pass")
+
+        self.url = "/_synapse/admin/v1/sync/slowest"
+
+    def _sync(self):
+        request, channel = self.make_request(
+            "GET", "/sync", access_token=self.other_user_tok
+        )
+        self.assertEqual(200, channel.code, msg=channel.result["body"])
+
+    def _get_slowest(self, query=""):
+        request, channel = self.make_request(
+            "GET", self.url + query, access_token=self.admin_user_tok,
+        )
+        self.assertEqual(200, int(channel.result["code"]), msg=channel.result["body"])
+        return channel.json_body
+
+    def test_requester_is_no_admin(self):
+        """
+        If the user is not a server admin, an error 403 is returned.
+        """
+        request, channel = self.make_request(
+            "GET", self.url, access_token=self.other_user_tok,
+        )
+
+        self.assertEqual(403, int(channel.result["code"]), msg=channel.result["body"])
+        self.assertEqual(Codes.FORBIDDEN, channel.json_body["errcode"])
+
+    def test_slowest(self):
+        """
+        Recent syncs are returned, with the time taken by each stage.
+        """
+        self._sync()
+        self._sync()
+
+        body = self._get_slowest("?limit=1")
+        self.assertEqual(body["total"], 2)
+        self.assertEqual(len(body["syncs"]), 1)
+
+        slow_sync = body["syncs"][0]
+        self.assertEqual(slow_sync["user_id"], self.other_user)
+        self.assertEqual(slow_sync["sync_type"], "initial_sync")
+        self.assertIn("rooms", slow_sync["stages"])
+        self.assertIn("encode", slow_sync["stages"])
+        self.assertIsNone(slow_sync["profile"])
+
+        # Profiling is disabled by default.
+        self.assertEqual(self._get_slowest("?profiled=true"), {"syncs": [], "total": 0})
+
+        # old syncs should be forgotten.
+        self.reactor.advance(2 * 60 * 60)
+        self.assertEqual(self._get_slowest(), {"syncs": [], "total": 0})
+
+    @override_config({"sync_profiling": {"enabled": True, "sample_rate": 1}})
+    def test_profiled(self):
+        """
+        Syncs sampled for profiling are returned with their profiles.
+        """
+        self._sync()
+
+        body = self._get_slowest("?profiled=true")
+        self.assertEqual(body["total"], 1)
+        self.assertIn("generate_sync_result", body["syncs"][0]["profile"])
+        self.assertEqual(
+            body["syncs"][0]["profile"], self._get_slowest()["syncs"][0]["profile"]
+        )
@@ -911,6 +911,99 @@ class RoomMessageListTestCase(RoomBase):
         self.assertEqual(len(chunk), 0, [event["content"] for event in chunk])
 
 
+class RoomMessageListFilteredTestCase(unittest.HomeserverTestCase):
+    """Tests that /messages keeps paginating until it has enough events the
+    requester is allowed to see.
+    """
+
+    servlets = [
+        synapse.rest.admin.register_servlets_for_client_rest_resource,
+        room.register_servlets,
+        login.register_servlets,
+    ]
+
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+
+        self.user_id = self.register_user("user", "pass")
+        self.access_token = self.login("user", "pass")
+
+        self.other_user_id = self.register_user("otheruser", "pass")
+        self.other_access_token = self.login("otheruser", "pass")
+
+        self.room = self.helper.create_room_as(self.user_id, tok=self.access_token)
+        self.helper.invite(
+            room=self.room,
+            src=self.user_id,
+            tok=self.access_token,
+            targ=self.other_user_id,
+        )
+        self.helper.join(
+            room=self.room, user=self.other_user_id, tok=self.other_access_token
+        )
+
+        # The user ignores the other user, so won't see any of their events.
+        self.get_success(
+            self.store.add_account_data_for_user(
+                self.user_id,
+                "m.ignored_user_list",
+                {"ignored_users": {self.other_user_id: {}}},
+            )
+        )
+
+    def _get_messages(self, from_token, limit):
+        request, channel = self.make_request(
+            "GET",
+            "/rooms/%s/messages?access_token=%s&from=%s&dir=b&limit=%d"
+            % (self.room, self.access_token, from_token, limit),
+        )
+        self.assertEqual(channel.code, 200, channel.json_body)
+        return channel.json_body
+
+    def test_skips_filtered_events(self):
+        first_id = self.helper.send(self.room, "1", tok=self.access_token)["event_id"]
+        self.helper.send(self.room, "2", tok=self.other_access_token)
+        self.helper.send(self.room, "3", tok=self.other_access_token)
+        second_id = self.helper.send(self.room, "4", tok=self.access_token)["event_id"]
+        self.helper.send(self.room, "5", tok=self.other_access_token)
+
+        token = self.get_success(
+            self.hs.get_event_sources().get_current_token_for_pagination()
+        )
+        token_str = self.get_success(token.to_string(self.store))
+
+        # The first batch only contains one visible event and the second none,
+        # so the server has to pull a third batch to fill the page.
+        body = self._get_messages(token_str, 2)
+        self.assertEqual(
+            [event["event_id"] for event in body["chunk"]], [second_id, first_id]
+        )
+
+    def test_token_points_at_last_returned_event(self):
+        """If the last batch has more visible events than needed, the returned
+        token must not skip over the ones we didn't return.
+        """
+        self.helper.send(self.room, "1", tok=self.access_token)
+        first_id = self.helper.send(self.room, "2", tok=self.access_token)["event_id"]
+        self.helper.send(self.room, "3", tok=self.other_access_token)
+        self.helper.send(self.room, "4", tok=self.other_access_token)
+        second_id = self.helper.send(self.room, "5", tok=self.access_token)["event_id"]
+        self.helper.send(self.room, "6", tok=self.other_access_token)
+
+        token = self.get_success(
+            self.hs.get_event_sources().get_current_token_for_pagination()
+        )
+        token_str = self.get_success(token.to_string(self.store))
+
+        body = self._get_messages(token_str, 2)
+        self.assertEqual(
+            [event["event_id"] for event in body["chunk"]], [second_id, first_id]
+        )
+
+        body = self._get_messages(body["end"], 1)
+        self.assertEqual(body["chunk"][0]["content"]["body"], "1")
+
+
 class RoomSearchTestCase(unittest.HomeserverTestCase):
     servlets = [
         synapse.rest.admin.register_servlets_for_client_rest_resource,
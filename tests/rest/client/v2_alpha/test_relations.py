@@ -527,6 +527,48 @@ class RelationsTestCase(unittest.HomeserverTestCase):
             {"event_id": edit_event_id, "sender": self.user_id}, m_replace_dict
         )
 
+    def test_bundled_aggregations_in_messages(self):
+        """Test that aggregations are bundled correctly when serializing a batch
+        of events, only some of which have relations.
+        """
+        channel = self._send_relation(RelationTypes.ANNOTATION, "m.reaction", "a")
+        self.assertEquals(200, channel.code, channel.json_body)
+
+        new_body = {"msgtype": "m.text", "body": "I've been edited!"}
+        channel = self._send_relation(
+            RelationTypes.REPLACE,
+            "m.room.message",
+            content={"msgtype": "m.text", "body": "foo", "m.new_content": new_body},
+        )
+        self.assertEquals(200, channel.code, channel.json_body)
+        edit_event_id = channel.json_body["event_id"]
+
+        other_id = self.helper.send(self.room, body="Hello", tok=self.user_token)[
+            "event_id"
+        ]
+
+        request, channel = self.make_request(
+            "GET",
+            "/rooms/%s/messages?dir=b" % (self.room,),
+            access_token=self.user_token,
+        )
+        self.assertEquals(200, channel.code, channel.json_body)
+
+        events = {event["event_id"]: event for event in channel.json_body["chunk"]}
+
+        parent = events[self.parent_id]
+        self.assertEquals(parent["content"], new_body)
+        relations_dict = parent["unsigned"]["m.relations"]
+        self.assertEquals(
+            relations_dict[RelationTypes.ANNOTATION],
+            {"chunk": [{"type": "m.reaction", "key": "a", "count": 1}]},
+        )
+        self.assertEquals(
+            relations_dict[RelationTypes.REPLACE]["event_id"], edit_event_id
+        )
+
+        self.assertNotIn("m.relations", events[other_id]["unsigned"])
+
     def test_relations_redaction_redacts_edits(self):
         """Test that edits of an event are redacted when the original event
         is redacted.
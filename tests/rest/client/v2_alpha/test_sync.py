@@ -19,6 +19,7 @@ import synapse.rest.admin
 from synapse.api.constants import EventContentFields, EventTypes, RelationTypes
 from synapse.rest.client.v1 import login, room
 from synapse.rest.client.v2_alpha import read_marker, sync
+from synapse.util.caches.stream_change_cache import StreamChangeCache
 
 from tests import unittest
 from tests.server import TimedOutException
@@ -447,6 +448,56 @@ class UnreadMessagesTestCase(unittest.HomeserverTestCase):
         )
         self._check_unread_count(5)
 
+    def test_unread_counts_multiple_rooms(self):
+        """Tests that /sync returns the right unread counts when several rooms
+        have changed, with and without read receipts.
+        """
+        room_id2 = self.helper.create_room_as(self.user_id, tok=self.tok)
+        self.helper.join(room=self.room_id, user=self.user2, tok=self.tok2)
+        self.helper.join(room=room_id2, user=self.user2, tok=self.tok2)
+        self._check_unread_count(0)
+
+        res = self.helper.send(self.room_id, "hello", tok=self.tok2)
+        self.helper.send(room_id2, "hello", tok=self.tok2)
+        self.helper.send(room_id2, "hello", tok=self.tok2)
+
+        # Mark the first room as read.
+        body = json.dumps({"m.read": res["event_id"]}).encode("utf8")
+        request, channel = self.make_request(
+            "POST",
+            "/rooms/%s/read_markers" % self.room_id,
+            body,
+            access_token=self.tok,
+        )
+        self.assertEqual(channel.code, 200, channel.json_body)
+
+        request, channel = self.make_request(
+            "GET", self.url % self.next_batch, access_token=self.tok,
+        )
+        self.assertEqual(channel.code, 200, channel.json_body)
+
+        rooms = channel.json_body["rooms"]["join"]
+        self.assertEqual(rooms[self.room_id]["org.matrix.msc2654.unread_count"], 0)
+        self.assertEqual(rooms[room_id2]["org.matrix.msc2654.unread_count"], 2)
+        self.assertEqual(
+            rooms[room_id2]["unread_notifications"]["notification_count"], 2
+        )
+
+        # The counts should have been added to the per-room cache.
+        cache = self.hs.get_datastore().get_unread_event_push_actions_by_room_for_user
+        self.assertEqual(
+            cache.cache.get_immediate(
+                (self.room_id, self.user_id, res["event_id"]), None
+            ),
+            {"notify_count": 0, "unread_count": 0, "highlight_count": 0},
+        )
+        self.assertEqual(
+            cache.cache.get_immediate((room_id2, self.user_id, None), None)[
+                "unread_count"
+            ],
+            2,
+        )
+
     def _check_unread_count(self, expected_count: True):
         """Syncs and compares the unread count with the expected value."""
 
@@ -463,3 +514,248 @@ class UnreadMessagesTestCase(unittest.HomeserverTestCase):
 
         # Store the next batch for the next request.
         self.next_batch = channel.json_body["next_batch"]
+
+
+class RoomWindowSyncTestCase(unittest.HomeserverTestCase):
+    servlets = [
+        synapse.rest.admin.register_servlets,
+        login.register_servlets,
+        room.register_servlets,
+        sync.register_servlets,
+    ]
+
+    def prepare(self, reactor, clock, hs):
+        self.url = "/_matrix/client/unstable/org.matrix.room_window/sync"
+
+        self.user_id = self.register_user("kermit", "monkey")
+        self.tok = self.login("kermit", "monkey")
+
+        # Create some rooms, the last of which has the most recent event.
+        self.room_ids = [
+            self.helper.create_room_as(self.user_id, tok=self.tok) for _ in range(3)
+        ]
+
+    def _sync(self, query):
+        request, channel = self.make_request(
+            "GET", self.url + query, access_token=self.tok
+        )
+        self.assertEqual(channel.code, 200, channel.json_body)
+        return channel.json_body
+
+    def test_window(self):
+        body = self._sync("?room_limit=2")
+        window = body["org.matrix.room_window"]
+        self.assertEqual(window["rooms"], [self.room_ids[2], self.room_ids[1]])
+        self.assertEqual(window["count"], 3)
+        self.assertEqual(window["changed"], [])
+        self.assertCountEqual(
+            body["rooms"]["join"], [self.room_ids[2], self.room_ids[1]]
+        )
+
+        body = self._sync("?room_offset=2&room_limit=2")
+        self.assertEqual(body["org.matrix.room_window"]["rooms"], [self.room_ids[0]])
+        self.assertEqual(list(body["rooms"]["join"]), [self.room_ids[0]])
+
+    def test_changed_rooms_outside_window(self):
+        next_batch = self._sync("?room_limit=1")["next_batch"]
+
+        # Sending an event in the oldest room moves it to the top, so it should
+        # now be in the window.
+        self.helper.send(self.room_ids[0], "hello", tok=self.tok)
+        body = self._sync("?room_limit=1&since=" + next_batch)
+        window = body["org.matrix.room_window"]
+        self.assertEqual(window["rooms"], [self.room_ids[0]])
+        self.assertEqual(window["changed"], [])
+        self.assertEqual(list(body["rooms"]["join"]), [self.room_ids[0]])
+
+        # Changes to rooms outside the window are only listed.
+        next_batch = body["next_batch"]
+        self.helper.send(self.room_ids[1], "hello", tok=self.tok)
+        self.helper.send(self.room_ids[2], "hello", tok=self.tok)
+        body = self._sync("?room_offset=2&room_limit=1&since=" + next_batch)
+        window = body["org.matrix.room_window"]
+        self.assertEqual(window["rooms"], [self.room_ids[0]])
+        self.assertCountEqual(window["changed"], [self.room_ids[1], self.room_ids[2]])
+        self.assertEqual(body["rooms"]["join"], {})
+
+    def test_order_rooms_from_database(self):
+        """Rooms which the stream change cache doesn't know about should still
+        be ordered correctly.
+        """
+        store = self.hs.get_datastore()
+        store._events_stream_cache = StreamChangeCache(
+            "EventsRoomStreamChangeCache", store.get_room_max_stream_ordering()
+        )
+
+        self.assertEqual(
+            self.get_success(store.get_rooms_by_recency(self.room_ids, 3)),
+            list(reversed(self.room_ids)),
+        )
+
+        # The cached positions are invalidated by new events.
+        self.helper.send(self.room_ids[0], "hello", tok=self.tok)
+        store._events_stream_cache = StreamChangeCache(
+            "EventsRoomStreamChangeCache", store.get_room_max_stream_ordering()
+        )
+        self.assertEqual(
+            self.get_success(store.get_rooms_by_recency(self.room_ids, 3)),
+            [self.room_ids[0], self.room_ids[2], self.room_ids[1]],
+        )
+
+    def test_invalid_window(self):
+        request, channel = self.make_request(
+            "GET", self.url + "?room_limit=0", access_token=self.tok
+        )
+        self.assertEqual(channel.code, 400, channel.json_body)
+
+
+class SyncResponseCacheTestCase(unittest.HomeserverTestCase):
+    servlets = [
+        synapse.rest.admin.register_servlets,
+        login.register_servlets,
+        room.register_servlets,
+        sync.register_servlets,
+    ]
+
+    def default_config(self):
+        config = super().default_config()
+        config.setdefault("sync_response_cache", {"enabled": True, "expiry": "1m"})
+        return config
+
+    def prepare(self, reactor, clock, hs):
+        self.user_id = self.register_user("kermit", "monkey")
+        self.tok = self.login("kermit", "monkey")
+        self.room_id = self.helper.create_room_as(self.user_id, tok=self.tok)
+
+        # Count the syncs which are calculated.
+        self.sync_count = 0
+        sync_handler = hs.get_sync_handler()
+        wait_for_sync_for_user = sync_handler.wait_for_sync_for_user
+
+        async def _wait_for_sync_for_user(*args, **kwargs):
+            self.sync_count += 1
+            return await wait_for_sync_for_user(*args, **kwargs)
+
+        sync_handler.wait_for_sync_for_user = _wait_for_sync_for_user
+
+    def _sync(self, query=""):
+        request, channel = self.make_request(
+            "GET", "/sync" + query, access_token=self.tok
+        )
+        self.assertEqual(channel.code, 200, channel.json_body)
+        return channel.json_body
+
+    def test_retry_served_from_cache(self):
+        next_batch = self._sync()["next_batch"]
+        self.helper.send(self.room_id, "hello", tok=self.tok)
+
+        first = self._sync("?since=" + next_batch)
+        self.assertEqual(self.sync_count, 2)
+        self.assertIn(self.room_id, first["rooms"]["join"])
+
+        # Retrying the request returns the same response, without calculating
+        # it again.
+        second = self._sync("?timeout=0&since=" + next_batch)
+        self.assertEqual(self.sync_count, 2)
+        self.assertEqual(second, first)
+
+        # A different filter gets a different response.
+        self._sync("?filter=%7B%7D&since=" + next_batch)
+        self.assertEqual(self.sync_count, 3)
+
+        # Until the response expires.
+        self.reactor.advance(120)
+        self._sync("?since=" + next_batch)
+        self.assertEqual(self.sync_count, 4)
+
+    def test_retry_counts_as_syncing(self):
+        presence_handler = self.hs.get_presence_handler()
+        user_syncing = presence_handler.user_syncing
+        syncing_users = []
+
+        async def _user_syncing(user_id, *args, **kwargs):
+            syncing_users.append(user_id)
+            return await user_syncing(user_id, *args, **kwargs)
+
+        presence_handler.user_syncing = _user_syncing
+
+        next_batch = self._sync()["next_batch"]
+        self.helper.send(self.room_id, "hello", tok=self.tok)
+        self._sync("?since=" + next_batch)
+        self._sync("?since=" + next_batch)
+
+        # The retry is served from the cache, but the user is still syncing.
+        self.assertEqual(self.sync_count, 2)
+        self.assertEqual(syncing_users, [self.user_id] * 3)
+
+    def test_empty_response_not_cached(self):
+        next_batch = self._sync()["next_batch"]
+
+        self._sync("?since=" + next_batch)
+        self._sync("?since=" + next_batch)
+        self.assertEqual(self.sync_count, 3)
+
+    @unittest.override_config(
+        {"sync_response_cache": {"enabled": True, "expiry": "1m", "max_size": 100}}
+    )
+    def test_size_bounded(self):
+        next_batch = self._sync()["next_batch"]
+        self.helper.send(self.room_id, "hello", tok=self.tok)
+
+        # Responses bigger than the whole cache are evicted straight away.
+        self._sync("?since=" + next_batch)
+        self._sync("?since=" + next_batch)
+        self.assertEqual(self.sync_count, 3)
+
+
+class DeviceListSyncTestCase(unittest.HomeserverTestCase):
+    servlets = [
+        synapse.rest.admin.register_servlets,
+        login.register_servlets,
+        room.register_servlets,
+        sync.register_servlets,
+    ]
+
+    def prepare(self, reactor, clock, hs):
+        self.user_id = self.register_user("kermit", "monkey")
+        self.tok = self.login("kermit", "monkey")
+
+        self.other_user_id = self.register_user("piggy", "monkey")
+        self.other_tok = self.login("piggy", "monkey")
+
+        self.stranger_user_id = self.register_user("animal", "monkey")
+
+        self.room_id = self.helper.create_room_as(self.user_id, tok=self.tok)
+        self.helper.join(self.room_id, self.other_user_id, tok=self.other_tok)
+
+    def _sync(self, since=None):
+        path = "/sync" if since is None else "/sync?timeout=0&since=" + since
+        request, channel = self.make_request("GET", path, access_token=self.tok)
+        self.assertEqual(channel.code, 200, channel.json_body)
+        return channel.json_body
+
+    def test_device_list_changes(self):
+        next_batch = self._sync()["next_batch"]
+
+        # Adding devices changes the device lists of both users, but only the
+        # one sharing a room with the syncing user is reported.
+        self.login("piggy", "monkey")
+        self.login("animal", "monkey")
+
+        body = self._sync(next_batch)
+        self.assertEqual(body["device_lists"]["changed"], [self.other_user_id])
+        self.assertEqual(body["device_lists"]["left"], [])
+
+        # The syncing user is told about their own device list changes.
+        next_batch = body["next_batch"]
+        self.login("kermit", "monkey")
+
+        body = self._sync(next_batch)
+        self.assertEqual(body["device_lists"]["changed"], [self.user_id])
+
+        # Once the other user leaves the room, they are reported as left.
+        next_batch = body["next_batch"]
+        self.helper.leave(self.room_id, self.other_user_id, tok=self.other_tok)
+
+        body = self._sync(next_batch)
+        self.assertEqual(body["device_lists"]["left"], [self.other_user_id])
@@ -14,17 +14,34 @@
 # limitations under the License.
 
 import itertools
+import json
+import pickle
+from concurrent.futures.process import BrokenProcessPool
 from typing import List
 
+from mock import Mock, patch
+
 import attr
 
 from twisted.internet import defer
 
+from synapse import event_auth
 from synapse.api.constants import EventTypes, JoinRules, Membership
 from synapse.api.room_versions import RoomVersions
 from synapse.event_auth import auth_types_for_event
 from synapse.events import make_event_from_dict
-from synapse.state.v2 import lexicographical_topological_sort, resolve_events_with_store
+from synapse.state.dump import RecordingStateResolutionStore, decode_dump
+from synapse.state.process_pool import (
+    EventProjection,
+    StateResolutionProcessPool,
+    get_event_projections,
+    resolve_with_projections,
+)
+from synapse.state.v2 import (
+    _seperate,
+    lexicographical_topological_sort,
+    resolve_events_with_store,
+)
 from synapse.types import EventID
 
 from tests import unittest
@@ -435,6 +452,23 @@ class StateTestCase(unittest.TestCase):
 
                 state_before = self.successResultOf(defer.ensureDeferred(state_d))
 
+                # resolving using projections of the events, as is done in the
+                # state resolution process pool, should give the same answer.
+                self.assertEqual(
+                    self._resolve_with_projections(
+                        [state_at_event[n] for n in prev_events], event_map
+                    ),
+                    state_before,
+                )
+
+                # as should replaying a dump of the resolution.
+                self.assertEqual(
+                    self._resolve_from_dump(
+                        [state_at_event[n] for n in prev_events], event_map
+                    ),
+                    state_before,
+                )
+
             state_after = dict(state_before)
             if fake_event.state_key is not None:
                 state_after[(fake_event.type, fake_event.state_key)] = event_id
@@ -471,6 +505,75 @@ class StateTestCase(unittest.TestCase):
 
         self.assertEqual(expected_state, end_state)
 
+    def _resolve_with_projections(self, state_sets, event_map):
+        store = TestStateResolutionStore(event_map)
+
+        unconflicted_state, conflicted_state = _seperate(state_sets)
+        auth_diff = self.successResultOf(
+            store.get_auth_chain_difference(
+                ROOM_ID, [set(state_set.values()) for state_set in state_sets]
+            )
+        )
+
+        projections, missing = self.successResultOf(
+            defer.ensureDeferred(
+                get_event_projections(
+                    unconflicted_state,
+                    conflicted_state,
+                    auth_diff,
+                    dict(event_map),
+                    store,
+                )
+            )
+        )
+
+        # the projections get pickled to send them to the worker processes.
+        projections, missing = pickle.loads(pickle.dumps((projections, missing)))
+
+        return resolve_with_projections(
+            ROOM_ID,
+            RoomVersions.V2.identifier,
+            unconflicted_state,
+            conflicted_state,
+            auth_diff,
+            projections,
+            missing,
+        )
+
+    def _resolve_from_dump(self, state_sets, event_map):
+        store = RecordingStateResolutionStore(TestStateResolutionStore(event_map))
+        self.successResultOf(
+            defer.ensureDeferred(
+                resolve_events_with_store(
+                    FakeClock(),
+                    ROOM_ID,
+                    RoomVersions.V2.identifier,
+                    state_sets,
+                    event_map={},
+                    state_res_store=store,
+                )
+            )
+        )
+
+        # the dump gets written to a file.
+        dump = json.loads(
+            json.dumps(store.encode(ROOM_ID, RoomVersions.V2.identifier, state_sets))
+        )
+        room_id, room_version, state_sets, replay_store = decode_dump(dump)
+
+        return self.successResultOf(
+            defer.ensureDeferred(
+                resolve_events_with_store(
+                    FakeClock(),
+                    room_id,
+                    room_version,
+                    state_sets,
+                    event_map={},
+                    state_res_store=replay_store,
+                )
+            )
+        )
+
 
 class LexicographicalTestCase(unittest.TestCase):
     def test_simple(self):
@@ -586,6 +689,147 @@ class SimpleParamStateTestCase(unittest.TestCase):
 
         self.assert_dict(self.expected_combined_state, state)
 
+    @patch("synapse.state.process_pool.MIN_EVENTS_FOR_PROCESS_POOL", 0)
+    def test_process_pool_falls_back_on_worker_failure(self):
+        # If resolving the state in the process pool fails for any reason, the
+        # state should be resolved in-process instead.
+        pool = StateResolutionProcessPool(Mock(), max_workers=1)
+        pool._run = Mock(side_effect=BrokenProcessPool())
+
+        state_d = pool.resolve_events_with_store(
+            FakeClock(),
+            ROOM_ID,
+            RoomVersions.V2.identifier,
+            [self.state_at_bob, self.state_at_charlie],
+            event_map=None,
+            state_res_store=TestStateResolutionStore(self.event_map),
+        )
+
+        state = self.successResultOf(defer.ensureDeferred(state_d))
+
+        pool._run.assert_called_once()
+        self.assert_dict(self.expected_combined_state, state)
+
+
+class EventProjectionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.event_map = {}
+        self.state = {}
+
+        self._add_event(ALICE, EventTypes.Create, "", {"creator": ALICE})
+        self._add_event(ALICE, EventTypes.Member, ALICE, MEMBERSHIP_CONTENT_JOIN)
+        self._add_event(
+            ALICE,
+            EventTypes.PowerLevels,
+            "",
+            # Anyone may send redaction events, but only alice may redact.
+            {"users": {ALICE: 100}, "events": {EventTypes.Redaction: 0}},
+        )
+        self._add_event(
+            ALICE, EventTypes.JoinRules, "", {"join_rule": JoinRules.PUBLIC}
+        )
+        self._add_event(BOB, EventTypes.Member, BOB, MEMBERSHIP_CONTENT_JOIN)
+
+    def _add_event(self, sender, type, state_key, content, state=None):
+        """Create a room version 6 event, authed against `state` (defaulting to
+        the current state), and add it to the current state.
+        """
+        if state is None:
+            state = self.state
+
+        # The auth rules only look at the auth events they need, so we can
+        # just use the whole state.
+        event_dict = {
+            "auth_events": list(state.values()),
+            "prev_events": [],
+            "sender": sender,
+            "type": type,
+            "state_key": state_key,
+            "content": content,
+            "origin_server_ts": len(self.event_map),
+            "room_id": ROOM_ID,
+        }
+        event = make_event_from_dict(event_dict, RoomVersions.V6)
+
+        self.event_map[event.event_id] = event
+        state[(type, state_key)] = event.event_id
+        return event
+
+    def test_check_redaction_state_event(self):
+        # The auth rules record on a redaction sent by a user without the power
+        # to redact that it should be rechecked, which projections must allow.
+        redaction = self._add_event(BOB, EventTypes.Redaction, "", {})
+        projection = EventProjection.from_event(redaction)
+
+        auth_events = {
+            key: EventProjection.from_event(self.event_map[event_id])
+            for key, event_id in self.state.items()
+            if event_id != redaction.event_id
+        }
+        event_auth.check(
+            RoomVersions.V6,
+            projection,
+            auth_events,
+            do_sig_check=False,
+            do_size_check=False,
+        )
+
+        self.assertTrue(projection.internal_metadata.recheck_redaction)
+
+    def test_resolve_redaction_state_event(self):
+        state_before = dict(self.state)
+
+        self._add_event(BOB, EventTypes.Redaction, "", {})
+        topic_state = dict(state_before)
+        self._add_event(ALICE, EventTypes.Topic, "", {"topic": "hi"}, topic_state)
+
+        state_sets = [self.state, topic_state]
+        store = TestStateResolutionStore(self.event_map)
+
+        expected_state = self.successResultOf(
+            defer.ensureDeferred(
+                resolve_events_with_store(
+                    FakeClock(),
+                    ROOM_ID,
+                    RoomVersions.V6.identifier,
+                    state_sets,
+                    event_map=dict(self.event_map),
+                    state_res_store=store,
+                )
+            )
+        )
+        self.assertIn((EventTypes.Redaction, ""), expected_state)
+
+        unconflicted_state, conflicted_state = _seperate(state_sets)
+        auth_diff = self.successResultOf(
+            store.get_auth_chain_difference(
+                ROOM_ID, [set(state_set.values()) for state_set in state_sets]
+            )
+        )
+        projections, missing = self.successResultOf(
+            defer.ensureDeferred(
+                get_event_projections(
+                    unconflicted_state,
+                    conflicted_state,
+                    auth_diff,
+                    dict(self.event_map),
+                    store,
+                )
+            )
+        )
+        projections, missing = pickle.loads(pickle.dumps((projections, missing)))
+
+        state = resolve_with_projections(
+            ROOM_ID,
+            RoomVersions.V6.identifier,
+            unconflicted_state,
+            conflicted_state,
+            auth_diff,
+            projections,
+            missing,
+        )
+        self.assertEqual(state, expected_state)
+
 
 def pairwise(iterable):
     "s -> (s0,s1), (s1,s2), (s2, s3), ..."
@@ -647,7 +891,7 @@ class TestStateResolutionStore:
 
         return list(result)
 
-    def get_auth_chain_difference(self, auth_sets):
+    def get_auth_chain_difference(self, room_id, auth_sets):
         chains = [frozenset(self._get_auth_chain(a)) for a in auth_sets]
 
         common = set(chains[0]).intersection(*chains[1:])
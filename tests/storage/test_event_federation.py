@@ -13,6 +13,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from parameterized import parameterized
+
+from synapse.api.room_versions import RoomVersions
+from synapse.storage.databases.main.events import PersistEventsStore
+
 import tests.unittest
 import tests.utils
 
@@ -113,7 +118,7 @@ class EventFederationWorkerStoreTestCase(tests.unittest.HomeserverTestCase):
         r = self.get_success(self.store.get_rooms_with_many_extremities(5, 1, [room1]))
         self.assertTrue(r == [room2] or r == [room3])
 
-    def test_auth_difference(self):
+    def _setup_auth_graph(self, use_chain_cover_index: bool):
         room_id = "@ROOM:local"
 
         # The silly auth graph we use to test the auth difference algorithm,
@@ -199,37 +204,173 @@ class EventFederationWorkerStoreTestCase(tests.unittest.HomeserverTestCase):
                 )
             )
 
-        # Now actually test that various combinations give the right result:
+        self.get_success(
+            self.store.db_pool.simple_insert(
+                table="rooms",
+                values={
+                    "room_id": room_id,
+                    "creator": "room_creator_user_id",
+                    "is_public": True,
+                    "room_version": "6",
+                    "has_auth_chain_index": use_chain_cover_index,
+                },
+            )
+        )
+
+        if use_chain_cover_index:
+            self.get_success(
+                self.store.db_pool.runInteraction(
+                    "add_chain_cover_index",
+                    PersistEventsStore._add_chain_cover_index,
+                    self.store.db_pool,
+                    self.store._event_chain_id_gen,
+                    {event_id: room_id for event_id in auth_graph},
+                    {event_id: ("m.test", event_id) for event_id in auth_graph},
+                    {event_id: list(auth_graph[event_id]) for event_id in auth_graph},
+                )
+            )
+
+        return room_id
 
+    def _assert_auth_differences(self, room_id: str):
         difference = self.get_success(
-            self.store.get_auth_chain_difference([{"a"}, {"b"}])
+            self.store.get_auth_chain_difference(room_id, [{"a"}, {"b"}])
         )
         self.assertSetEqual(difference, {"a", "b"})
 
         difference = self.get_success(
-            self.store.get_auth_chain_difference([{"a"}, {"b"}, {"c"}])
+            self.store.get_auth_chain_difference(room_id, [{"a"}, {"b"}, {"c"}])
         )
         self.assertSetEqual(difference, {"a", "b", "c", "e", "f"})
 
         difference = self.get_success(
-            self.store.get_auth_chain_difference([{"a", "c"}, {"b"}])
+            self.store.get_auth_chain_difference(room_id, [{"a", "c"}, {"b"}])
         )
         self.assertSetEqual(difference, {"a", "b", "c"})
 
         difference = self.get_success(
-            self.store.get_auth_chain_difference([{"a"}, {"b"}, {"d"}])
+            self.store.get_auth_chain_difference(room_id, [{"a"}, {"b"}, {"d"}])
         )
         self.assertSetEqual(difference, {"a", "b", "d", "e"})
 
         difference = self.get_success(
-            self.store.get_auth_chain_difference([{"a"}, {"b"}, {"c"}, {"d"}])
+            self.store.get_auth_chain_difference(room_id, [{"a"}, {"b"}, {"c"}, {"d"}])
         )
         self.assertSetEqual(difference, {"a", "b", "c", "d", "e", "f"})
 
         difference = self.get_success(
-            self.store.get_auth_chain_difference([{"a"}, {"b"}, {"e"}])
+            self.store.get_auth_chain_difference(room_id, [{"a"}, {"b"}, {"e"}])
         )
         self.assertSetEqual(difference, {"a", "b"})
 
-        difference = self.get_success(self.store.get_auth_chain_difference([{"a"}]))
+        difference = self.get_success(
+            self.store.get_auth_chain_difference(room_id, [{"a"}])
+        )
         self.assertSetEqual(difference, set())
+
+    @parameterized.expand([(True,), (False,)])
+    def test_auth_difference(self, use_chain_cover_index: bool):
+        room_id = self._setup_auth_graph(use_chain_cover_index)
+
+        # Now actually test that various combinations give the right result:
+        self._assert_auth_differences(room_id)
+
+    @parameterized.expand([(True,), (False,)])
+    def test_auth_chain_ids(self, use_chain_cover_index: bool):
+        room_id = self._setup_auth_graph(use_chain_cover_index)
+
+        auth_chain_ids = self.get_success(self.store.get_auth_chain_ids(room_id, ["a"]))
+        self.assertCountEqual(auth_chain_ids, ["e", "f", "g", "h", "i", "j", "k"])
+
+        auth_chain_ids = self.get_success(
+            self.store.get_auth_chain_ids(room_id, ["c", "d"], include_given=True)
+        )
+        self.assertCountEqual(auth_chain_ids, ["c", "d", "f", "g", "h", "i", "j", "k"])
+
+        auth_chain_ids = self.get_success(self.store.get_auth_chain_ids(room_id, ["j"]))
+        self.assertCountEqual(auth_chain_ids, [])
+
+    def test_has_auth_chain_index_after_invite(self):
+        """A room we were invited to over federation, and then joined, should
+        use the chain cover index.
+        """
+        room_id = "!invite:other"
+
+        self.get_success(
+            self.store.maybe_store_room_on_outlier_membership(room_id, RoomVersions.V6)
+        )
+
+        # The invite is then persisted as an outlier.
+        self.get_success(
+            self.store.db_pool.simple_insert(
+                table="events",
+                values={
+                    "event_id": "$invite",
+                    "room_id": room_id,
+                    "depth": 1,
+                    "topological_ordering": 1,
+                    "type": "m.room.member",
+                    "processed": True,
+                    "outlier": True,
+                    "stream_ordering": 1,
+                },
+            )
+        )
+
+        self.get_success(self.store.upsert_room_on_join(room_id, RoomVersions.V6))
+
+        self.assertTrue(self.get_success(self.store.has_auth_chain_index(room_id)))
+
+    def test_chain_cover_background_update(self):
+        """The background update should index existing rooms, after which
+        queries should use the index.
+        """
+        room_id = self._setup_auth_graph(use_chain_cover_index=False)
+
+        # Give the events types and state keys so that the background update
+        # picks them up.
+        self.get_success(
+            self.store.db_pool.simple_insert_many(
+                table="state_events",
+                values=[
+                    {
+                        "event_id": event_id,
+                        "room_id": room_id,
+                        "type": "m.test",
+                        "state_key": event_id,
+                    }
+                    for event_id in "abcdefghijk"
+                ],
+                desc="insert_state_events",
+            )
+        )
+
+        self.get_success(
+            self.store.db_pool.simple_insert(
+                "background_updates",
+                {"update_name": "chain_cover", "progress_json": "{}"},
+            )
+        )
+
+        # Use a small batch size so that the update takes several batches.
+        self.store.db_pool.updates._all_done = False
+        while not self.get_success(
+            self.store.db_pool.updates.has_completed_background_updates()
+        ):
+            self.get_success(
+                self.store.db_pool.updates.do_next_background_update(100), by=0.1
+            )
+
+        self.assertTrue(self.get_success(self.store.has_auth_chain_index(room_id)))
+
+        indexed = self.get_success(
+            self.store.db_pool.simple_select_onecol(
+                table="event_auth_chains",
+                keyvalues={},
+                retcol="event_id",
+                desc="get_indexed",
+            )
+        )
+        self.assertCountEqual(indexed, list("abcdefghijk"))
+
+        self._assert_auth_differences(room_id)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import Mock
+
+from twisted.internet import defer
+
+import synapse.rest.admin
+from synapse.logging.context import make_deferred_yieldable
+from synapse.rest.client.v1 import login, room
+
+from tests import unittest
+
+
+class EventFetchDeduplicationTestCase(unittest.HomeserverTestCase):
+    """Tests that concurrent requests for the same uncached events share a
+    single database fetch.
+    """
+
+    servlets = [
+        synapse.rest.admin.register_servlets,
+        room.register_servlets,
+        login.register_servlets,
+    ]
+
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+
+        self.user = self.register_user("user", "pass")
+        self.token = self.login("user", "pass")
+
+        self.room_id = self.helper.create_room_as(self.user, tok=self.token)
+        res = self.helper.send(self.room_id, "hi", tok=self.token)
+        self.event_id = res["event_id"]
+
+        # Reset the event cache so the following tests start with it empty.
+        self.store._get_event_cache.clear()
+
+    def _block_db_fetches(self):
+        """Replace `_get_events_from_db` with a mock which only completes when
+        the returned deferred is resolved.
+        """
+        real_get_events_from_db = self.store._get_events_from_db
+        unblock = defer.Deferred()
+
+        async def _get_events_from_db(*args, **kwargs):
+            await make_deferred_yieldable(unblock)
+            return await real_get_events_from_db(*args, **kwargs)
+
+        self.store._get_events_from_db = Mock(side_effect=_get_events_from_db)
+        return unblock
+
+    def test_concurrent_fetches_are_deduplicated(self):
+        unblock = self._block_db_fetches()
+
+        d1 = defer.ensureDeferred(self.store.get_event(self.event_id))
+        d2 = defer.ensureDeferred(self.store.get_event(self.event_id))
+        self.pump()
+
+        # Only one of the requests should have hit the database.
+        self.assertEqual(self.store._get_events_from_db.call_count, 1)
+        self.assertFalse(d1.called)
+        self.assertFalse(d2.called)
+
+        unblock.callback(None)
+
+        ev1 = self.get_success(d1)
+        ev2 = self.get_success(d2)
+        self.assertEqual(ev1.event_id, self.event_id)
+        self.assertEqual(ev2.event_id, self.event_id)
+
+        # The in-flight map should have been cleaned up.
+        self.assertEqual(self.store._current_event_fetches, {})
+
+    def test_failed_fetch_is_propagated(self):
+        unblock = self._block_db_fetches()
+
+        d1 = defer.ensureDeferred(self.store.get_event(self.event_id))
+        d2 = defer.ensureDeferred(self.store.get_event(self.event_id))
+        self.pump()
+
+        unblock.errback(Exception("Database failure"))
+
+        self.get_failure(d1, Exception)
+        self.get_failure(d2, Exception)
+        self.assertEqual(self.store._current_event_fetches, {})
+
+        # A subsequent request should be retried against the database.
+        del self.store._get_events_from_db
+        ev = self.get_success(self.store.get_event(self.event_id))
+        self.assertEqual(ev.event_id, self.event_id)
@@ -374,6 +374,19 @@ class RedactionTestCase(unittest.HomeserverTestCase):
 
         self.assert_dict({"content": {}}, json.loads(event_json))
 
+        # Now that the stored JSON has been pruned, the cache should only hold a
+        # single copy of the event, which is served whatever the redact behaviour.
+        entries = self.get_success(
+            self.store._get_events_from_cache_or_db([msg_event.event_id])
+        )
+        cache_entry = entries[msg_event.event_id]
+        self.assertIs(cache_entry.event, cache_entry.redacted_event)
+
+        event = cache_entry.redacted_event
+        self.assertTrue(event.internal_metadata.is_redacted())
+        self.assertEqual(event.content, {})
+        self.assertTrue("redacted_because" in event.unsigned)
+
     def test_redact_redaction(self):
         """Tests that we can redact a redaction and can fetch it again.
         """
@@ -170,6 +170,31 @@ class RoomMemberStoreTestCase(unittest.HomeserverTestCase):
         )
         self.assertEqual(users.keys(), {self.u_alice, self.u_bob})
 
+    def test_filter_users_who_share_room_with_user(self):
+        room = self.helper.create_room_as(self.u_alice, tok=self.t_alice)
+        t_bob = self.login("bob", "pass")
+        self.helper.join(room, self.u_bob, tok=t_bob)
+
+        u_carol = self.register_user("carol", "pass")
+        t_carol = self.login("carol", "pass")
+        self.helper.create_room_as(u_carol, tok=t_carol)
+
+        users = self.get_success(
+            self.store.filter_users_who_share_room_with_user(
+                self.u_alice, [self.u_alice, self.u_bob, u_carol, "@dave:test"]
+            )
+        )
+        self.assertEqual(users, {self.u_alice, self.u_bob})
+
+        # Once bob leaves, they no longer share a room with alice.
+        self.helper.leave(room, self.u_bob, tok=t_bob)
+        users = self.get_success(
+            self.store.filter_users_who_share_room_with_user(
+                self.u_alice, [self.u_bob, u_carol]
+            )
+        )
+        self.assertEqual(users, set())
+
 
 class CurrentStateMembershipUpdateTestCase(unittest.HomeserverTestCase):
     def prepare(self, reactor, clock, homeserver):
@@ -15,15 +15,20 @@
 
 import logging
 
+from mock import Mock
+
 from twisted.internet import defer
 
 from synapse.api.constants import EventTypes, Membership
 from synapse.api.room_versions import RoomVersions
+from synapse.storage.databases.main.state import STATE_RESOLUTION_CACHE_MAX_AGE_MS
 from synapse.storage.state import StateFilter
 from synapse.types import RoomID, UserID
+from synapse.util.state_map import FrozenStateMap
 
 import tests.unittest
 import tests.utils
+from tests.unittest import HomeserverTestCase
 
 logger = logging.getLogger(__name__)
 
@@ -543,3 +548,152 @@ class StateStoreTestCase(tests.unittest.TestCase):
 
         self.assertEqual(is_all, True)
         self.assertDictEqual({(e5.type, e5.state_key): e5.event_id}, state_dict)
+
+    @defer.inlineCallbacks
+    def test_state_resolution_results(self):
+        room_id = self.room.to_string()
+        delta_ids = {("m.room.name", ""): "$name", ("m.room.topic", ""): None}
+
+        result = yield defer.ensureDeferred(
+            self.store.get_state_resolution_result([3, 1, 2])
+        )
+        self.assertIsNone(result)
+
+        yield defer.ensureDeferred(
+            self.store.store_state_resolution_result(room_id, [3, 1, 2], 1, delta_ids)
+        )
+
+        # the order of the state groups shouldn't matter
+        result = yield defer.ensureDeferred(
+            self.store.get_state_resolution_result([1, 2, 3])
+        )
+        self.assertEqual(result, (1, delta_ids))
+
+        result = yield defer.ensureDeferred(
+            self.store.get_state_resolution_result([1, 2])
+        )
+        self.assertIsNone(result)
+
+        # old results should be deleted
+        self.store._clock.advance_time_msec(STATE_RESOLUTION_CACHE_MAX_AGE_MS + 1)
+        yield defer.ensureDeferred(self.store._delete_old_state_resolution_results())
+
+        result = yield defer.ensureDeferred(
+            self.store.get_state_resolution_result([1, 2, 3])
+        )
+        self.assertIsNone(result)
+
+
+class StateGroupCacheDerivationTestCase(HomeserverTestCase):
+    """Tests that missing state groups are worked out from cached ancestors.
+    """
+
+    def prepare(self, reactor, clock, hs):
+        self.state_datastore = hs.get_storage().state.stores.state
+
+        room_id = "!room:test"
+        self.state1 = {
+            (EventTypes.Create, ""): "$create",
+            (EventTypes.Name, ""): "$name1",
+            (EventTypes.Member, "@alice:test"): "$alice",
+        }
+        delta2 = {
+            (EventTypes.Member, "@bob:test"): "$bob",
+            (EventTypes.Topic, ""): "$topic",
+        }
+        delta3 = {(EventTypes.Name, ""): "$name3"}
+
+        self.state2 = dict(self.state1)
+        self.state2.update(delta2)
+        self.state3 = dict(self.state2)
+        self.state3.update(delta3)
+
+        self.sg1 = self.get_success(
+            self.state_datastore.store_state_group(
+                "$1", room_id, None, None, self.state1
+            )
+        )
+        self.sg2 = self.get_success(
+            self.state_datastore.store_state_group(
+                "$2", room_id, self.sg1, delta2, self.state2
+            )
+        )
+        self.sg3 = self.get_success(
+            self.state_datastore.store_state_group(
+                "$3", room_id, self.sg2, delta3, self.state3
+            )
+        )
+
+        # Only the first group is cached, and we should never need to load
+        # the state from the database.
+        for cache in self._caches():
+            cache.invalidate(self.sg2)
+            cache.invalidate(self.sg3)
+
+        self.state_datastore._get_state_groups_from_groups = Mock(
+            side_effect=AssertionError("loaded state from the database")
+        )
+
+    def _caches(self):
+        return (
+            self.state_datastore._state_group_cache,
+            self.state_datastore._state_group_members_cache,
+        )
+
+    def test_full_state(self):
+        state = self.get_success(
+            self.state_datastore._get_state_for_groups([self.sg2, self.sg3])
+        )
+        self.assertEqual(state, {self.sg2: self.state2, self.sg3: self.state3})
+
+        # the derived state should have been cached, sharing the entries of
+        # the ancestor.
+        for cache in self._caches():
+            self.assertTrue(cache.get(self.sg3).full)
+            self.assertIsInstance(cache.get_full_value(self.sg3), FrozenStateMap)
+
+    def test_prefill_shares_state(self):
+        delta = {(EventTypes.Topic, ""): "$topic4"}
+        state4 = dict(self.state1)
+        state4.update(delta)
+
+        sg4 = self.get_success(
+            self.state_datastore.store_state_group(
+                "$4", "!room:test", self.sg1, delta, state4
+            )
+        )
+
+        non_members_cache = self.state_datastore._state_group_cache
+        prefilled = non_members_cache.get_full_value(sg4)
+        self.assertIsInstance(prefilled, FrozenStateMap)
+        self.assertIs(prefilled._parent, non_members_cache.get_full_value(self.sg1))
+
+        state = self.get_success(self.state_datastore._get_state_for_groups([sg4]))
+        self.assertEqual(state, {sg4: state4})
+
+    def test_partial_state(self):
+        # only cache alice's membership in the first group
+        members_cache = self.state_datastore._state_group_members_cache
+        members_cache.invalidate(self.sg1)
+        members_cache.update(
+            members_cache.sequence,
+            key=self.sg1,
+            value={(EventTypes.Member, "@alice:test"): "$alice"},
+            fetched_keys=[(EventTypes.Member, "@alice:test")],
+        )
+
+        state_filter = StateFilter.from_types(
+            [(EventTypes.Member, "@alice:test"), (EventTypes.Member, "@bob:test")]
+        )
+        state = self.get_success(
+            self.state_datastore._get_state_for_groups([self.sg3], state_filter)
+        )
+        self.assertEqual(state, {self.sg3: state_filter.filter_state(self.state3)})
+
+        # we don't know whether other members were in the first group, so
+        # this has to come from the database.
+        state_filter = StateFilter.from_types([(EventTypes.Member, "@carol:test")])
+        self.get_failure(
+            self.state_datastore._get_state_for_groups([self.sg3], state_filter),
+            AssertionError,
+        )
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from synapse.storage.databases.state.compressor import (
+    DEFAULT_LEVEL_SIZES,
+    _get_chain_length,
+    _Level,
+    assign_prev_groups,
+)
+
+from tests.unittest import HomeserverTestCase, TestCase
+
+
+class AssignPrevGroupsTestCase(TestCase):
+    def test_levels(self):
+        levels = [_Level(2), _Level(2)]
+        prev_groups = assign_prev_groups(levels, range(1, 9))
+
+        self.assertEqual(
+            prev_groups, {1: None, 2: 1, 3: 1, 4: 3, 5: None, 6: 5, 7: 5, 8: 7},
+        )
+
+        # the levels should carry on where they left off.
+        self.assertEqual(assign_prev_groups(levels, [9, 10]), {9: None, 10: 9})
+
+
+class StateCompressorTestCase(HomeserverTestCase):
+    def prepare(self, reactor, clock, hs):
+        self.state_store = hs.get_storage().state.stores.state
+
+    def _store_state_groups(self, room_id, count):
+        """Store a chain of state groups which each add a member to a room which
+        already has a few hundred members.
+
+        Returns:
+            A map from state group to its full state.
+        """
+        states = {}
+        prev_group = None
+        state = {
+            ("m.room.member", "@old%d:test" % (i,)): "$old%d" % (i,) for i in range(200)
+        }
+        for i in range(count):
+            delta_ids = {("m.room.member", "@user%d:test" % (i,)): "$member%d" % (i,)}
+            if i % 10 == 0:
+                # change the name every so often, to overwrite earlier state.
+                delta_ids[("m.room.name", "")] = "$name%d" % (i,)
+            state = dict(state)
+            state.update(delta_ids)
+
+            prev_group = self.get_success(
+                self.state_store.store_state_group(
+                    "$event%d" % (i,), room_id, prev_group, delta_ids, state
+                )
+            )
+            states[prev_group] = state
+
+        return states
+
+    def _count_rows(self):
+        rows = self.get_success(
+            self.state_store.db_pool.execute(
+                "count_rows", None, "SELECT COUNT(*) FROM state_groups_state"
+            )
+        )
+        return rows[0][0]
+
+    def _get_chain_lengths(self, state_groups):
+        """Get the length of the delta chain of each of the given groups."""
+        prev_groups = self.get_success(
+            self.state_store.db_pool.runInteraction(
+                "get_chain_lengths",
+                self.state_store._get_prev_groups_recursive_txn,
+                list(state_groups),
+            )
+        )
+        return {
+            state_group: _get_chain_length(prev_groups, state_group)
+            for state_group in state_groups
+        }
+
+    def _assert_states(self, states):
+        # bypass the caches, so that we read what is in the database.
+        for state_group, state in states.items():
+            stored = self.get_success(
+                self.state_store.db_pool.runInteraction(
+                    "get_state",
+                    self.state_store._get_state_groups_from_groups_txn,
+                    [state_group],
+                )
+            )
+            self.assertEqual(stored[state_group], state)
+
+    def test_compress(self):
+        states = self._store_state_groups("!room1:test", 250)
+        other_states = self._store_state_groups("!room2:test", 20)
+
+        rows_before = self._count_rows()
+        self.assertEqual(max(self._get_chain_lengths(states).values()), 100)
+
+        # compress in a few chunks, so that we check that progress is kept.
+        processed = 0
+        while True:
+            n = self.get_success(self.state_store.compress_state_groups(100))
+            if not n:
+                break
+            processed += n
+
+        self.assertEqual(processed, 270)
+
+        # the state should be unchanged, but take up less space and have
+        # shorter chains.
+        self._assert_states(states)
+        self._assert_states(other_states)
+
+        self.assertLess(self._count_rows(), rows_before)
+        self.assertLessEqual(
+            max(self._get_chain_lengths(states).values()), sum(DEFAULT_LEVEL_SIZES)
+        )
+
+        # new groups should be compressed on the next pass.
+        delta_ids = {("m.room.topic", ""): "$topic"}
+        new_state = dict(states[max(states)])
+        new_state.update(delta_ids)
+        self.get_success(
+            self.state_store.store_state_group(
+                "$new", "!room1:test", max(states), delta_ids, new_state
+            )
+        )
+        self.assertEqual(
+            self.get_success(self.state_store.compress_state_groups(100)), 1
+        )
+
+    def test_removed_state(self):
+        """Groups which lack state that their new prev group has should be
+        stored as snapshots.
+        """
+        room_id = "!room:test"
+        state1 = {("a", ""): "$a", ("b", ""): "$b"}
+        state2 = {("a", ""): "$a2"}
+
+        sg1 = self.get_success(
+            self.state_store.store_state_group("$1", room_id, None, None, state1)
+        )
+        sg2 = self.get_success(
+            self.state_store.store_state_group("$2", room_id, None, None, state2)
+        )
+
+        self.get_success(self.state_store.compress_state_groups(100))
+
+        self._assert_states({sg1: state1, sg2: state2})
+
+    def test_chunks_bounded_by_rows(self):
+        # each group has a delta of one or two rows, apart from the snapshot at
+        # the start, which has over 200.
+        self._store_state_groups("!room:test", 50)
+
+        # the snapshot is compressed on its own...
+        self.assertEqual(
+            self.get_success(self.state_store.compress_state_groups(20)), 1
+        )
+
+        # ... and then the deltas, a few at a time.
+        n = self.get_success(self.state_store.compress_state_groups(20))
+        self.assertGreater(n, 1)
+        self.assertLess(n, 20)
+
+    def _get_new_deltas(self, new_prev_groups):
+        def get_new_deltas_txn(txn):
+            prev_groups = self.state_store._get_prev_groups_recursive_txn(
+                txn, set(new_prev_groups) | set(new_prev_groups.values())
+            )
+            return self.state_store._get_new_deltas_txn(
+                txn, list(new_prev_groups), new_prev_groups, prev_groups
+            )
+
+        return self.get_success(
+            self.state_store.db_pool.runInteraction(
+                "get_new_deltas", get_new_deltas_txn
+            )
+        )
+
+    def test_new_deltas_from_existing_deltas(self):
+        """The new deltas should be worked out from the existing deltas, even
+        when the new prev group is not an ancestor of the group.
+        """
+        room_id = "!room:test"
+        state1 = {("a", ""): "$a", ("b", ""): "$b"}
+        state2 = {("a", ""): "$a2", ("b", ""): "$b"}
+        state3 = {("a", ""): "$a", ("b", ""): "$b3"}
+
+        sg1 = self.get_success(
+            self.state_store.store_state_group("$1", room_id, None, None, state1)
+        )
+        sg2 = self.get_success(
+            self.state_store.store_state_group(
+                "$2", room_id, sg1, {("a", ""): "$a2"}, state2
+            )
+        )
+        # sg3 forks off from sg1, so it has the original value of "a".
+        sg3 = self.get_success(
+            self.state_store.store_state_group(
+                "$3", room_id, sg1, {("b", ""): "$b3"}, state3
+            )
+        )
+
+        self.assertEqual(
+            self._get_new_deltas({sg3: sg2}),
+            {sg3: (sg2, {("a", ""): "$a", ("b", ""): "$b3"})},
+        )
+
+        # if sg3 lacks state that its new prev group has, it has to be a
+        # snapshot.
+        state4 = dict(state2)
+        state4[("c", "")] = "$c"
+        sg4 = self.get_success(
+            self.state_store.store_state_group(
+                "$4", room_id, sg2, {("c", ""): "$c"}, state4
+            )
+        )
+        self.assertEqual(self._get_new_deltas({sg3: sg4}), {sg3: (None, state3)})
+
+    def test_purged_prev_group(self):
+        """Groups shouldn't be rewritten as deltas against groups which have
+        been purged.
+        """
+        room_id = "!room:test"
+        state = {("a", ""): "$a"}
+        sg1 = self.get_success(
+            self.state_store.store_state_group("$1", room_id, None, None, state)
+        )
+        sg2 = self.get_success(
+            self.state_store.store_state_group("$2", room_id, None, None, state)
+        )
+
+        self.get_success(self.state_store.purge_room_state(room_id, [sg1]))
+
+        rewritten = self.get_success(
+            self.state_store.db_pool.runInteraction(
+                "rewrite",
+                self.state_store._rewrite_state_groups_txn,
+                room_id,
+                {sg2: (sg1, {})},
+            )
+        )
+        self.assertFalse(rewritten)
+        self._assert_states({sg2: state})
@@ -192,6 +192,45 @@ class EventAuthTestCase(unittest.TestCase):
                 do_sig_check=False,
             )
 
+    def test_check_batch(self):
+        """
+        Events checked in a batch should get the same results as when checked
+        one at a time, including after the power levels change.
+        """
+        creator = "@creator:example.com"
+        pleb = "@joiner:example.com"
+
+        auth_events = {
+            ("m.room.create", ""): _create_event(creator),
+            ("m.room.member", creator): _join_event(creator),
+            ("m.room.power_levels", ""): _power_levels_event(
+                creator, {"state_default": "30", "users": {creator: "100"}}
+            ),
+            ("m.room.member", pleb): _join_event(pleb),
+        }
+
+        promoted_auth_events = dict(auth_events)
+        promoted_auth_events[("m.room.power_levels", "")] = _power_levels_event(
+            creator, {"state_default": "30", "users": {pleb: "30"}}
+        )
+
+        creator_event = _random_state_event(creator)
+        pleb_event = _random_state_event(pleb)
+        promoted_pleb_event = _random_state_event(pleb)
+
+        errors = event_auth.check_batch(
+            RoomVersions.V1,
+            [
+                (creator_event, auth_events),
+                (pleb_event, auth_events),
+                (promoted_pleb_event, promoted_auth_events),
+            ],
+            do_sig_check=False,
+        )
+
+        self.assertEqual(list(errors), [pleb_event.event_id])
+        self.assertIsInstance(errors[pleb_event.event_id], AuthError)
+
 
 # helpers for making events
 
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import defer
+
+from synapse.rest import admin
+from synapse.rest.client.v1 import login, room
+from synapse.types import create_requester
+
+from tests import unittest
+from tests.unittest import override_config
+
+
+class NotifierCoalescingTestCase(unittest.HomeserverTestCase):
+    """Tests coalescing wake-ups of user streams."""
+
+    servlets = [
+        admin.register_servlets,
+        login.register_servlets,
+        room.register_servlets,
+    ]
+
+    def prepare(self, reactor, clock, hs):
+        self.notifier = hs.get_notifier()
+
+        self.user_ids = []
+        toks = []
+        for i in range(3):
+            self.user_ids.append(self.register_user("user%d" % (i,), "pass"))
+            toks.append(self.login("user%d" % (i,), "pass"))
+
+        self.tok = toks[0]
+        self.room_id = self.helper.create_room_as(self.user_ids[0], tok=self.tok)
+        for user_id, tok in zip(self.user_ids[1:], toks[1:]):
+            self.helper.join(self.room_id, user_id, tok=tok)
+
+    def _send(self, body):
+        """Send a message into the room, without advancing the clock."""
+        self.get_success(
+            self.hs.get_event_creation_handler().create_and_send_nonmember_event(
+                create_requester(self.user_ids[0]),
+                {
+                    "type": "m.room.message",
+                    "room_id": self.room_id,
+                    "sender": self.user_ids[0],
+                    "content": {"msgtype": "m.text", "body": body},
+                },
+                ratelimit=False,
+            )
+        )
+
+    def _wait_for_room_events(self):
+        """Start waiting for room events for each of the users.
+
+        Returns:
+            A list of deferreds, which resolve to the room key of the token that
+            the user was woken up with.
+        """
+        from_token = self.hs.get_event_sources().get_current_token()
+
+        async def callback(before_token, after_token):
+            if after_token.room_key.stream == from_token.room_key.stream:
+                return None
+            return after_token.room_key.stream
+
+        return [
+            defer.ensureDeferred(
+                self.notifier.wait_for_events(
+                    user_id, 60000, callback, from_token=from_token
+                )
+            )
+            for user_id in self.user_ids
+        ]
+
+    def test_no_coalescing(self):
+        waiters = self._wait_for_room_events()
+        self._send("hello")
+
+        # Everyone should have been woken up straight away.
+        for d in waiters:
+            self.assertTrue(d.called)
+
+    @override_config(
+        {
+            "notifier_coalescing": {
+                "enabled": True,
+                "min_streams": 2,
+                "window": 100,
+                "batch_size": 2,
+                "batch_interval": 50,
+            }
+        }
+    )
+    def test_coalescing(self):
+        waiters = self._wait_for_room_events()
+
+        self._send("one")
+        self.reactor.advance(0.05)
+        self._send("two")
+        expected_stream = self.hs.get_datastore().get_room_max_stream_ordering()
+
+        # Nobody should be woken until the end of the coalescing window.
+        self.assertEqual([d.called for d in waiters], [False, False, False])
+
+        # Then the streams are woken in batches, with both events.
+        self.reactor.advance(0.06)
+        self.assertEqual(sorted(d.called for d in waiters), [False, True, True])
+
+        self.reactor.advance(0.1)
+        for d in waiters:
+            self.assertEqual(self.successResultOf(d), expected_stream)
+
+    @override_config({"notifier_coalescing": {"enabled": True, "min_streams": 10}})
+    def test_small_herds_not_coalesced(self):
+        waiters = self._wait_for_room_events()
+        self._send("hello")
+
+        for d in waiters:
+            self.assertTrue(d.called)
+
+
+class NotifierStreamExpiryTestCase(unittest.HomeserverTestCase):
+    """Tests expiring unused user streams."""
+
+    servlets = [
+        admin.register_servlets,
+        login.register_servlets,
+        room.register_servlets,
+    ]
+
+    def prepare(self, reactor, clock, hs):
+        self.notifier = hs.get_notifier()
+
+        self.user_id = self.register_user("user", "pass")
+        self.tok = self.login("user", "pass")
+        self.room_id = self.helper.create_room_as(self.user_id, tok=self.tok)
+
+    def _wait_for_events(self, timeout):
+        async def callback(before_token, after_token):
+            return None
+
+        return defer.ensureDeferred(
+            self.notifier.wait_for_events(self.user_id, timeout, callback)
+        )
+
+    def test_expire_unused_stream(self):
+        self.get_success(self._wait_for_events(0))
+        self.assertIn(self.user_id, self.notifier.user_to_user_stream)
+        self.assertIn(self.room_id, self.notifier.room_to_user_streams)
+
+        # Notifying the stream should put off its expiry.
+        self.reactor.advance(5 * 60)
+        self.helper.send(self.room_id, "hello", tok=self.tok)
+
+        self.reactor.advance(6 * 60)
+        self.assertIn(self.user_id, self.notifier.user_to_user_stream)
+
+        self.reactor.advance(5 * 60)
+        self.assertNotIn(self.user_id, self.notifier.user_to_user_stream)
+        self.assertNotIn(self.room_id, self.notifier.room_to_user_streams)
+
+    def test_stream_with_listeners_not_expired(self):
+        d = self._wait_for_events(20 * 60 * 1000)
+        self.pump()
+
+        self.reactor.advance(15 * 60)
+        self.assertIn(self.user_id, self.notifier.user_to_user_stream)
+
+        # Once the listener has gone the stream expires as usual.
+        self.reactor.advance(6 * 60)
+        self.assertTrue(d.called)
+
+        self.reactor.advance(10 * 60)
+        self.assertNotIn(self.user_id, self.notifier.user_to_user_stream)
@@ -22,7 +22,12 @@ from synapse.api.constants import EventTypes, Membership
 from synapse.api.room_versions import RoomVersions
 from synapse.events import make_event_from_dict
 from synapse.events.snapshot import EventContext
-from synapse.state import StateHandler, StateResolutionHandler
+from synapse.state import (
+    MIN_STORED_STATE_RESOLUTION_MS,
+    StateHandler,
+    StateResolutionHandler,
+    StateResolutionStore,
+)
 
 from tests import unittest
 
@@ -77,6 +82,7 @@ class StateGroupStore:
         self._group_to_state = {}
 
         self._event_id_to_event = {}
+        self._state_resolution_results = {}
 
         self._next_group = 1
 
@@ -109,6 +115,17 @@ class StateGroupStore:
     async def get_state_group_delta(self, name):
         return (None, None)
 
+    async def get_state_resolution_result(self, state_groups):
+        return self._state_resolution_results.get(frozenset(state_groups))
+
+    async def store_state_resolution_result(
+        self, room_id, state_groups, prev_group, delta_ids
+    ):
+        self._state_resolution_results[frozenset(state_groups)] = (
+            prev_group,
+            delta_ids,
+        )
+
     def register_events(self, events):
         for e in events:
             self._event_id_to_event[e.event_id] = e
@@ -528,6 +545,38 @@ class StateTestCase(unittest.TestCase):
 
         self.assertIsNotNone(context.state_group)
 
+    @defer.inlineCallbacks
+    def test_annotate_with_prev_state_groups(self):
+        prev_event_id = "prev_event_id"
+        event = create_event(
+            type="test_message", name="event2", prev_events=[(prev_event_id, {})]
+        )
+
+        old_state = [
+            create_event(type="test1", state_key="1"),
+            create_event(type="test2", state_key=""),
+        ]
+        old_state_ids = {(e.type, e.state_key): e.event_id for e in old_state}
+
+        group_name = yield defer.ensureDeferred(
+            self.store.store_state_group(
+                prev_event_id, event.room_id, None, None, old_state_ids
+            )
+        )
+
+        # we don't register the state group of the prev event, as the state
+        # groups we pass in should be used instead.
+        context = yield defer.ensureDeferred(
+            self.state.compute_event_context(
+                event, prev_state_groups={group_name: old_state_ids}
+            )
+        )
+
+        current_state_ids = yield defer.ensureDeferred(context.get_current_state_ids())
+
+        self.assertEqual(old_state_ids, current_state_ids)
+        self.assertEqual(group_name, context.state_group)
+
     @defer.inlineCallbacks
     def test_resolve_message_conflict(self):
         prev_event_id1 = "event_id1"
@@ -718,3 +767,126 @@ class StateTestCase(unittest.TestCase):
 
         result = yield defer.ensureDeferred(self.state.compute_event_context(event))
         return result
+
+
+class StateResolutionHandlerTestCase(unittest.HomeserverTestCase):
+    def prepare(self, reactor, clock, hs):
+        self.handler = self._make_handler(hs)
+        self.state_res_store = StateResolutionStore(hs.get_datastore())
+
+    def _make_handler(self, hs):
+        handler = StateResolutionHandler(hs)
+
+        # map from room id to the deferreds for the resolutions in progress
+        self.resolutions = {}
+
+        def resolve_events_with_store(room_id, *args, **kwargs):
+            d = defer.Deferred()
+            self.resolutions.setdefault(room_id, []).append(d)
+            return d
+
+        handler.resolve_events_with_store = resolve_events_with_store
+        return handler
+
+    def _resolve(self, room_id, state_groups_ids):
+        d = defer.ensureDeferred(
+            self.handler.resolve_state_groups(
+                room_id,
+                RoomVersions.V6.identifier,
+                state_groups_ids,
+                None,
+                self.state_res_store,
+            )
+        )
+        self.pump()
+        return d
+
+    def test_rooms_resolve_concurrently(self):
+        """A slow resolution in one room should not block other rooms, but
+        resolutions within a room should run one at a time.
+        """
+        state = {("a", ""): "$a"}
+
+        d1 = self._resolve("!room1:test", {1: state, 2: state})
+        d2 = self._resolve("!room2:test", {3: state, 4: state})
+        d3 = self._resolve("!room1:test", {5: state, 6: state})
+
+        # both rooms should have started resolving, but the second resolution
+        # in room1 should be waiting for the first.
+        self.assertEqual(len(self.resolutions["!room1:test"]), 1)
+        self.assertEqual(len(self.resolutions["!room2:test"]), 1)
+
+        self.resolutions["!room2:test"][0].callback(state)
+        self.pump()
+        self.assertEqual(self.successResultOf(d2).state, state)
+        self.assertNoResult(d1)
+
+        self.resolutions["!room1:test"][0].callback(state)
+        self.pump()
+        self.assertEqual(self.successResultOf(d1).state, state)
+
+        self.assertEqual(len(self.resolutions["!room1:test"]), 2)
+        self.resolutions["!room1:test"][1].callback(state)
+        self.pump()
+        self.assertEqual(self.successResultOf(d3).state, state)
+
+    def test_same_groups_share_result(self):
+        """Concurrent resolutions of the same state groups should only resolve once.
+        """
+        state = {("a", ""): "$a"}
+
+        d1 = self._resolve("!room1:test", {1: state, 2: state})
+        d2 = self._resolve("!room1:test", {1: state, 2: state})
+
+        self.resolutions["!room1:test"][0].callback(state)
+        self.pump()
+        self.assertIs(self.successResultOf(d1), self.successResultOf(d2))
+        self.assertEqual(len(self.resolutions["!room1:test"]), 1)
+
+    def test_quick_result_not_stored(self):
+        """Resolutions which are quick to redo shouldn't be written to the
+        database.
+        """
+        state1 = {("a", ""): "$a", ("b", ""): "$b1"}
+        state2 = {("a", ""): "$a", ("b", ""): "$b2"}
+
+        d1 = self._resolve("!room1:test", {1: state1, 2: state2})
+        self.resolutions["!room1:test"][0].callback(state2)
+        self.pump()
+        self.assertEqual(self.successResultOf(d1).state, state2)
+
+        # a fresh handler has to resolve again.
+        self.handler = self._make_handler(self.hs)
+
+        d2 = self._resolve("!room1:test", {1: state1, 2: state2})
+        self.assertNoResult(d2)
+        self.assertEqual(len(self.resolutions["!room1:test"]), 1)
+
+    def test_result_shared_via_database(self):
+        """A resolution done by one handler should be reused by another (e.g.
+        on a different worker) without resolving again.
+        """
+        state1 = {("a", ""): "$a", ("b", ""): "$b1", ("c", ""): "$c"}
+        state2 = {("a", ""): "$a", ("b", ""): "$b2"}
+        resolved = {("a", ""): "$a", ("b", ""): "$b2", ("d", ""): "$d"}
+
+        d1 = self._resolve("!room1:test", {1: state1, 2: state2})
+        self.reactor.advance(MIN_STORED_STATE_RESOLUTION_MS / 1000)
+        self.resolutions["!room1:test"][0].callback(resolved)
+        self.pump()
+        self.assertEqual(self.successResultOf(d1).state, resolved)
+
+        # a fresh handler has nothing in memory, so should use the stored
+        # result.
+        self.handler = self._make_handler(self.hs)
+
+        d2 = self._resolve("!room1:test", {2: state2, 1: state1})
+        result = self.successResultOf(d2)
+        self.assertEqual(result.state, resolved)
+        self.assertEqual(result.prev_group, 2)
+        self.assertEqual(self.resolutions, {})
+
+        # but a different set of groups should still be resolved.
+        d3 = self._resolve("!room1:test", {1: state1, 3: state2})
+        self.assertNoResult(d3)
+        self.assertEqual(len(self.resolutions["!room1:test"]), 1)
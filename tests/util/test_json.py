@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from canonicaljson import encode_canonical_json
+
+from synapse.util import fast_encode_json, json_decoder, json_encoder
+from synapse.util.frozenutils import freeze
+
+from tests import unittest
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class FastEncodeJsonTestCase(unittest.TestCase):
+    # orjson is an optional dependency so we don't want to require it for running
+    # the tests.
+    if not orjson:
+        skip = "Requires orjson"
+
+    def test_matches_json_encoder(self):
+        obj = {"b": [1, "two", None, True], "a": {"unicode": "☃"}}
+        # The stdlib encoder escapes non-ASCII characters, so compare the
+        # decoded results.
+        self.assertEqual(
+            json_decoder.decode(fast_encode_json(obj).decode("utf-8")),
+            json_decoder.decode(json_encoder.encode(obj)),
+        )
+
+    def test_canonical(self):
+        obj = {"b": 1, "a": {"d": "☃", "c": [3, 2, 1]}, "é": "e"}
+        self.assertEqual(
+            fast_encode_json(obj, canonical=True), encode_canonical_json(obj)
+        )
+
+    def test_frozen(self):
+        obj = {"a": 1, "b": [{"c": 2}]}
+        self.assertEqual(
+            fast_encode_json(freeze(obj), canonical=True), encode_canonical_json(obj),
+        )
+
+    def test_fallback(self):
+        # orjson can't encode integers outside of the 64-bit range.
+        self.assertIsNone(fast_encode_json({"a": 2 ** 70}))
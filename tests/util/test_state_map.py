@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from synapse.util.state_map import MAX_STATE_MAP_DEPTH, FrozenStateMap
+
+from tests.unittest import TestCase
+
+
+def _make_state(count):
+    return {
+        ("m.room.member", "@user%d:test" % (i,)): "$%d" % (i,) for i in range(count)
+    }
+
+
+class FrozenStateMapTestCase(TestCase):
+    def test_mapping(self):
+        state = _make_state(10)
+        state_map = FrozenStateMap(state)
+
+        self.assertEqual(state_map, state)
+        self.assertEqual(len(state_map), 10)
+        self.assertEqual(state_map[("m.room.member", "@user3:test")], "$3")
+        self.assertIn(("m.room.member", "@user3:test"), state_map)
+        self.assertNotIn(("m.room.member", "@other:test"), state_map)
+        self.assertIsNone(state_map.get(("m.room.member", "@other:test")))
+        with self.assertRaises(KeyError):
+            state_map[("m.room.member", "@other:test")]
+
+    def test_with_delta(self):
+        state = _make_state(10)
+        state_map = FrozenStateMap(state)
+
+        delta = {
+            ("m.room.member", "@user3:test"): "$new3",
+            ("m.room.name", ""): "$name",
+        }
+        new_map = state_map.with_delta(delta)
+
+        expected = dict(state)
+        expected.update(delta)
+        self.assertEqual(new_map, expected)
+        self.assertEqual(len(new_map), 11)
+        self.assertEqual(sorted(new_map), sorted(expected))
+        self.assertEqual(dict(new_map.items()), expected)
+
+        # the new map should share the entries of the original, which should be
+        # unchanged.
+        self.assertIs(new_map._parent, state_map)
+        self.assertEqual(state_map, state)
+
+    def test_to_dict(self):
+        state = _make_state(10)
+        state_map = FrozenStateMap(state)
+        new_map = state_map.with_delta({("m.room.member", "@user3:test"): "$new3"})
+        new_map = new_map.with_delta({("m.room.name", ""): "$name"})
+
+        expected = dict(state)
+        expected[("m.room.member", "@user3:test")] = "$new3"
+        expected[("m.room.name", "")] = "$name"
+
+        flat = new_map.to_dict()
+        self.assertIs(type(flat), dict)
+        self.assertEqual(flat, expected)
+
+        # the copy should be independent of the map.
+        flat[("m.room.topic", "")] = "$topic"
+        self.assertNotIn(("m.room.topic", ""), new_map)
+        self.assertEqual(state_map.to_dict(), state)
+
+    def test_large_delta_is_flattened(self):
+        state_map = FrozenStateMap(_make_state(4))
+        new_map = state_map.with_delta(
+            {
+                ("m.room.name", ""): "$name",
+                ("m.room.topic", ""): "$topic",
+                ("m.room.avatar", ""): "$avatar",
+            }
+        )
+
+        self.assertIsNone(new_map._parent)
+        self.assertEqual(len(new_map), 7)
+
+    def test_depth_is_bounded(self):
+        state = _make_state(100)
+        state_map = FrozenStateMap(state)
+
+        for i in range(3 * MAX_STATE_MAP_DEPTH):
+            delta = {("m.room.name", ""): "$name%d" % (i,)}
+            state_map = state_map.with_delta(delta)
+            state.update(delta)
+
+            self.assertLessEqual(state_map._depth, MAX_STATE_MAP_DEPTH)
+            self.assertEqual(state_map, state)
+            self.assertEqual(len(state_map), 101)
+
+    def test_interned(self):
+        state_key = "".join(["@user", ":test"])
+        event_id = "".join(["$", "event"])
+
+        map1 = FrozenStateMap({("m.room.member", state_key): event_id})
+        map2 = FrozenStateMap({("m.room.member", "@user:test"): "$event"})
+
+        ((key1, value1),) = map1.items()
+        ((key2, value2),) = map2.items()
+        self.assertIs(key1[1], key2[1])
+        self.assertIs(value1, value2)
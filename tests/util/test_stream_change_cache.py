@@ -244,3 +244,16 @@ class StreamChangeCacheTests(unittest.HomeserverTestCase):
 
         # Unknown entities will return the stream start position.
         self.assertEqual(cache.get_max_pos_of_last_change("not@here.website"), 1)
+
+    def test_last_change_pos(self):
+        """
+        StreamChangeCache.get_last_change_pos will return the point where a known
+        entity was last changed, or None if the entity is not known.
+        """
+        cache = StreamChangeCache("#test", 1)
+
+        cache.entity_has_changed("user@foo.com", 2)
+        cache.entity_has_changed("user@foo.com", 3)
+
+        self.assertEqual(cache.get_last_change_pos("user@foo.com"), 3)
+        self.assertIsNone(cache.get_last_change_pos("not@here.website"))